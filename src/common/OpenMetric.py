@@ -50,17 +50,15 @@ class Metric:
     def get_family(self) -> MetricFamily:
         return MetricFamily(self.get_family_name(), mtype = self.mtype, munit = self.munit, mhelp = self.mhelp)
 
+    def get_label_string(self) -> str:
+        if not self.labels:
+            return ""
+        return "{" + ",".join(f'{label}="{value}"' for label, value in self.labels.items()) + "}"
+
     def __str__(self):
         res = []
         res.append(self.name)
-
-        if self.labels:
-            res.append("{")
-            for label, value in self.labels.items():
-                res.append(f'{label}="{value}"')
-                res.append(",")
-            res.pop()
-            res.append("}")
+        res.append(self.get_label_string())
 
         res.append(" ")
         res.append(str(self.value))
@@ -121,6 +119,18 @@ class MetricSet:
                 "timestamp": metric.timestamp
             }
 
+    def to_frame(self) -> pl.DataFrame:
+        """One row per metric point with its name, rendered labels, numeric value and timestamp"""
+        return pl.DataFrame(
+            {
+                "name": [m.name for m in self.metrics],
+                "labels": [m.get_label_string() for m in self.metrics],
+                "value": [str(m.value) for m in self.metrics],
+                "timestamp": [int(m.timestamp) if m.timestamp else None for m in self.metrics],
+            },
+            schema={"name": pl.String, "labels": pl.String, "value": pl.String, "timestamp": pl.Int64}
+        ).with_columns(pl.col("value").cast(pl.Float64, strict=False))
+
     def __str__(self):
         if not self.metrics:
             return ""
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+"""Catalogue of all series written during ingest.
+
+Every conversion appends a small parquet file with the label sets it has seen
+and their first and last timestamp to the catalogue directory, so parallel
+conversions never write the same file. Reading the catalogue merges these files,
+`compact` replaces them by a single one.
+
+Besides listing series, the catalogue maps target names to NAIF IDs, dishes and
+stations, which lets queries select only the series of the requested targets.
+"""
+
+import argparse
+import logging
+import polars as pl
+from os import path, listdir, makedirs, remove
+from uuid import uuid4
+from .OpenMetric import MetricSet
+
+logger = logging.getLogger(__name__)
+
+DATA_DIR = path.abspath(path.join(path.dirname(__file__),"../../data/"))
+CATALOGUE_DIR = path.join(DATA_DIR, "catalogue/")
+
+# Labels identifying targets, dishes and stations
+LABELS = ["data_source", "station_name", "dish_name", "target_name", "target_id"]
+
+SCHEMA = {
+    "name": pl.String,
+    "labels": pl.String,
+    "data_source": pl.String,
+    "station_name": pl.String,
+    "dish_name": pl.String,
+    "target_name": pl.String,
+    "target_id": pl.Int32,
+    "first_seen": pl.Int64,
+    "last_seen": pl.Int64,
+}
+
+
+def label_string(labels: dict[str, str] | None) -> str:
+    """Labels rendered in sorted order, so equal label sets compare equal"""
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in sorted(labels.items())) + "}"
+
+
+def summarize(df: pl.LazyFrame) -> pl.LazyFrame:
+    """One row per series of df, which has the columns of SCHEMA with timestamps in first_seen and last_seen"""
+    return df\
+        .group_by("name", "labels")\
+        .agg(
+            *[pl.col(l).first() for l in LABELS],
+            pl.col("first_seen").min(),
+            pl.col("last_seen").max(),
+        )\
+        .select(SCHEMA.keys())\
+        .cast(SCHEMA)
+
+
+def record(df: pl.LazyFrame | pl.DataFrame, catalogue_dir: str = CATALOGUE_DIR) -> int:
+    """Add the series of df to the catalogue, returns the number of series"""
+    series = summarize(df.lazy()).collect()
+    if len(series):
+        makedirs(catalogue_dir, exist_ok=True)
+        series.write_parquet(path.join(catalogue_dir, f"{uuid4().hex}.parquet"))
+    logger.debug(f"Recorded {len(series)} series in the catalogue")
+    return len(series)
+
+
+def record_metric_set(ms: MetricSet, catalogue_dir: str = CATALOGUE_DIR) -> int:
+    """Add the series of an OpenMetrics conversion to the catalogue"""
+    rows = [
+        (m.name, label_string(m.labels), *[str(m.labels.get(l)) if m.labels and l in m.labels else None for l in LABELS], m.timestamp)
+        for m in ms.metrics
+    ]
+    df = pl.DataFrame(rows, schema=[*["name", "labels"], *LABELS, "timestamp"], orient="row").lazy()
+    return record(df.with_columns(
+        pl.col("target_id").cast(pl.Int32, strict=False),
+        pl.col("timestamp").cast(pl.Int64, strict=False).alias("first_seen"),
+        pl.col("timestamp").cast(pl.Int64, strict=False).alias("last_seen"),
+    ), catalogue_dir)
+
+
+def record_frame(df: pl.LazyFrame, keys: list[str], name: str | None = None, time_col: str = "timestamp", catalogue_dir: str = CATALOGUE_DIR) -> int:
+    """Add the series of a frame with one column per label in keys to the catalogue, e.g. parquetify output"""
+    return record(df.select(
+        pl.lit(name, pl.String).alias("name"),
+        pl.concat_str(
+            pl.lit("{"),
+            pl.concat_str([pl.format(f'{k}="{{}}"', pl.col(k).cast(pl.String)) for k in sorted(keys)], separator=",", ignore_nulls=True),
+            pl.lit("}"),
+        ).alias("labels"),
+        *[(pl.col(l) if l in keys else pl.lit(None)).cast(SCHEMA[l]).alias(l) for l in LABELS],
+        pl.col(time_col).alias("first_seen"),
+        pl.col(time_col).alias("last_seen"),
+    ), catalogue_dir)
+
+
+def scan(catalogue_dir: str = CATALOGUE_DIR) -> pl.LazyFrame:
+    """All series recorded so far"""
+    if not path.isdir(catalogue_dir) or not any(f.endswith(".parquet") for f in listdir(catalogue_dir)):
+        return pl.LazyFrame(schema=SCHEMA)
+    return summarize(pl.scan_parquet(path.join(catalogue_dir, "*.parquet")))
+
+
+def compact(catalogue_dir: str = CATALOGUE_DIR) -> int:
+    """Merge all files of the catalogue into one, returns the number of series"""
+    files = [path.join(catalogue_dir, f) for f in listdir(catalogue_dir) if f.endswith(".parquet")] if path.isdir(catalogue_dir) else []
+    if len(files) < 2:
+        return scan(catalogue_dir).select(pl.len()).collect().item()
+    series = summarize(pl.scan_parquet(files)).collect()
+    series.write_parquet(path.join(catalogue_dir, f"{uuid4().hex}.parquet"))
+    for f in files:
+        remove(f)
+    return len(series)
+
+
+def targets(catalogue_dir: str = CATALOGUE_DIR, names: list[str] | None = None, start: int | None = None, end: int | None = None) -> pl.DataFrame:
+    """Targets seen by DSN Now with their NAIF IDs, dishes and stations
+
+    names are regular expressions matching the whole target name, start and end
+    limit the result to targets seen in between.
+    """
+    df = scan(catalogue_dir).filter(pl.col("data_source") == "DSN Now", pl.col("target_name").is_not_null())
+    if names:
+        df = df.filter(pl.col("target_name").str.contains(f"^(?:{'|'.join(names)})$"))
+    if start is not None:
+        df = df.filter(pl.col("last_seen") >= start)
+    if end is not None:
+        df = df.filter(pl.col("first_seen") <= end)
+    return df\
+        .group_by("target_name", "target_id")\
+        .agg(
+            pl.col("dish_name").drop_nulls().unique().sort(),
+            pl.col("station_name").drop_nulls().unique().sort(),
+            pl.col("first_seen").min(),
+            pl.col("last_seen").max(),
+        )\
+        .sort("target_name", "target_id")\
+        .collect()
+
+
+def target_ids(catalogue_dir: str = CATALOGUE_DIR, names: list[str] | None = None, start: int | None = None, end: int | None = None) -> list[int]:
+    """NAIF IDs of the targets seen by DSN Now, see targets"""
+    return targets(catalogue_dir, names, start, end)["target_id"].drop_nulls().unique().sort().to_list()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect the catalogue of ingested series")
+    parser.add_argument("--dir", help="Catalogue directory", default=CATALOGUE_DIR)
+    parser.add_argument("-l", "--log", help="Loglevel", default="info")
+    subparsers = parser.add_subparsers(help="Subcommand help", dest="subparser_name")
+
+    parser_targets = subparsers.add_parser("targets", help="List targets with their NAIF IDs, dishes and stations")
+    parser_targets.add_argument("names", help="Regular expressions of target names", nargs="*")
+
+    parser_series = subparsers.add_parser("series", help="List series with their first and last timestamp")
+    parser_series.add_argument("-n", "--name", help="Only series of this metric")
+
+    subparsers.add_parser("compact", help="Merge all catalogue files into one")
+    args = parser.parse_args()
+
+    if args.log:
+        numeric_level = getattr(logging, args.log.upper(), None)
+        if not isinstance(numeric_level, int):
+            raise ValueError('Invalid log level: %s' % args.log)
+    else:
+        numeric_level = logging.INFO
+    logging.basicConfig(level=numeric_level)
+
+    pl.Config.set_tbl_rows(-1)
+    pl.Config.set_tbl_width_chars(200)
+    pl.Config.set_fmt_str_lengths(120)
+
+    match args.subparser_name:
+        case "targets":
+            print(targets(args.dir, args.names))
+        case "series":
+            df = scan(args.dir)
+            if args.name:
+                df = df.filter(pl.col("name") == args.name)
+            print(df.sort("name", "labels").select("name", "labels", "first_seen", "last_seen").collect())
+        case "compact":
+            logger.info(f"Catalogue holds {compact(args.dir)} series")
+        case _:
+            logger.error("Specify a subcommand")
+            exit(1)
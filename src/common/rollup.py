@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+import polars as pl
+from .OpenMetric import MetricSet
+
+# Rollup tiers as suffix: bucket width in seconds
+ROLLUP_TIERS = {
+    "1m": 60,
+    "1h": 60*60
+}
+
+ROLLUP_STATS = ["min", "max", "mean", "last", "count"]
+
+
+def _stat_exprs(value: pl.Expr, time_col: str) -> list[pl.Expr]:
+    # NaN marks missing values in the DSN Now data and must not leak into min/max/mean
+    value = value.cast(pl.Float64).fill_nan(None)
+    return [
+        value.min(),
+        value.max(),
+        value.mean(),
+        value.sort_by(time_col).drop_nulls().last(),
+        value.count(),
+    ]
+
+
+def rollup(df: pl.LazyFrame, keys: list[str], values: list[str], every: int, time_col: str = "timestamp") -> pl.LazyFrame:
+    """Downsample values into buckets of every seconds per combination of keys.
+
+    Buckets are labeled with their start time, each value column becomes one
+    column per statistic, e.g. signal_data_rate_b_per_s_max.
+    """
+    aggs = []
+    for value in values:
+        for stat, expr in zip(ROLLUP_STATS, _stat_exprs(pl.col(value), time_col)):
+            aggs.append(expr.alias(f"{value}_{stat}"))
+
+    return df\
+        .with_columns((pl.col(time_col) // every * every).alias("bucket"))\
+        .group_by(keys + ["bucket"])\
+        .agg(aggs)\
+        .rename({"bucket": time_col})\
+        .sort(keys + [time_col], nulls_last=True)
+
+
+def rollup_metric_set(ms: MetricSet, tier: str) -> str:
+    """Rollup of all metric points in ms as OpenMetrics gauge families.
+
+    Families are named <metric>:<tier>_<stat>, e.g. signal_data_rate_b_per_s:1m_max,
+    following the convention for aggregated metric names.
+    """
+    if not ms.metrics:
+        return ""
+    every = ROLLUP_TIERS[tier]
+
+    df = ms.to_frame().lazy()\
+        .filter(pl.col("timestamp").is_not_null())\
+        .with_columns((pl.col("timestamp") // every * every).alias("bucket"))\
+        .group_by("name", "labels", "bucket")\
+        .agg([expr.alias(stat) for stat, expr in zip(ROLLUP_STATS, _stat_exprs(pl.col("value"), "timestamp"))])\
+        .unpivot(index=["name", "labels", "bucket"], on=ROLLUP_STATS, variable_name="stat")\
+        .with_columns(
+            pl.concat_str(pl.col("name"), pl.lit(f":{tier}_"), pl.col("stat")).alias("family"),
+            # Empty buckets only contain NaN values
+            pl.col("value").fill_null(float("nan")),
+        )\
+        .with_columns(
+            pl.concat_str(
+                pl.col("family"),
+                pl.col("labels"),
+                pl.lit(" "),
+                pl.when(pl.col("stat") == "count")
+                  .then(pl.col("value").cast(pl.Int64).cast(pl.String))
+                  .otherwise(pl.col("value").cast(pl.String)),
+                pl.lit(" "),
+                pl.col("bucket").cast(pl.String)
+            ).alias("line")
+        )\
+        .sort("family", "labels", "bucket")\
+        .group_by("family", maintain_order=True)\
+        .agg(pl.col("line").str.join("\n"))\
+        .select(
+            pl.concat_str(
+                pl.lit("# TYPE "), pl.col("family"), pl.lit(" gauge\n"), pl.col("line")
+            ).str.join("\n")
+        )\
+        .collect()
+
+    return df.item() + "\n# EOF"
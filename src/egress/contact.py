@@ -1,10 +1,17 @@
 #!/usr/bin/env python3
 
 import polars as pl
-import json
+import io
+import re
+import sys
 import argparse
 from enum import Enum
-from extract import query_prometheus_CSV
+from os import path, makedirs, listdir
+from typing import Callable, IO
+from extract import query_prometheus_CSV, parse_step
+from querycache import QueryCache, to_timestamp, to_iso
+from contactstream import ContactDetector
+from intervals import IntervalIndex, contacts_to_intervals, INDEX_FILE
 import logging
 
 logger = logging.getLogger(__name__)
@@ -15,6 +22,18 @@ LIGHT_SECOND = 299792.458
 # URL of the running Prometheus instance
 PROMETHEUS_URL = "http://localhost:9090"
 
+DATA_DIR = path.abspath(path.join(path.dirname(__file__),"../../data/"))
+# Output of parquetify and distances.py used by the lake source
+LAKE_DIR = path.join(DATA_DIR, "exports/direct/")
+DISTANCES_FILE = path.join(DATA_DIR, "distances-full.csv")
+# State of the contact detector and the contacts closed by previous updates
+CONTACT_DIR = path.join(DATA_DIR, "contacts/")
+# Series catalogue written during ingest, see src/common/catalogue.py
+CATALOGUE_DIR = path.join(DATA_DIR, "catalogue/")
+# Distance tile cache, see src/ingress/distance/tiles.py
+TILE_DIR = path.join(DATA_DIR, "cache/distances/")
+REPO_DIR = path.abspath(path.join(path.dirname(__file__),"../.."))
+
 SCHEMA = {
     'Time': pl.Datetime,
     'dish_name': pl.String,
@@ -100,7 +119,8 @@ def get_contacts(df: pl.LazyFrame):
     return df
 
 
-def format_contacts(df: pl.LazyFrame, form: Format, start_time_string: str | None) -> str:
+def plan_frame(df: pl.LazyFrame, start_time_string: str | None) -> pl.LazyFrame:
+    """Contacts as plan entries between source and dest nodes"""
     if start_time_string:
         start_time = pl.Series([start_time_string]).str.to_datetime().item()
     else:
@@ -142,52 +162,117 @@ def format_contacts(df: pl.LazyFrame, form: Format, start_time_string: str | Non
         (pl.col("range_km") / LIGHT_SECOND).round().cast(pl.UInt64).alias("owlt"),
     )
 
-    result = ""
+    return df
+
+
+def json_value(column: str, dtype: pl.DataType) -> pl.Expr:
+    """JSON literal of each value in column"""
+    value = pl.col(column)
+    if dtype == pl.String:
+        escaped = value.str.replace_all("\\", "\\\\", literal=True).str.replace_all('"', '\\"', literal=True)
+        return pl.when(value.is_null()).then(pl.lit("null")).otherwise(pl.concat_str(pl.lit('"'), escaped, pl.lit('"')))
+    return value.cast(pl.String).fill_null("null")
+
+
+def plan_lines(df: pl.DataFrame, form: Format, relative: bool) -> pl.DataFrame:
+    """Lines of the ION or HDTN contact plan as single column frame"""
+    if form == Format.ION:
+        prefix = "+" if relative else ""
+        fields = lambda mode, value: pl.concat_str(
+            pl.lit(f"a {mode} {prefix}"), pl.col("startTime").cast(pl.String),
+            pl.lit(f" {prefix}"), pl.col("endTime").cast(pl.String),
+            pl.lit(" "), pl.col("source"),
+            pl.lit(" "), pl.col("dest"),
+            pl.lit(" "), value.cast(pl.String),
+        ).alias("line")
+        return pl.concat([
+            df.select(fields("contact", pl.col("rateBitsPerSec") // 8)),
+            df.select(fields("range", pl.col("owlt"))),
+        ])
+
+    # Same layout as json.dumps(..., indent=4) of the list of contacts
+    df = df.drop("range_km")
+    members = [
+        pl.concat_str(pl.lit(f'        "{name}": '), json_value(name, dtype))
+        for name, dtype in df.schema.items()
+    ]
+    objects = df.select(
+        pl.concat_str(
+            pl.lit("    {\n"),
+            pl.concat_str(members, separator=",\n"),
+            pl.lit("\n    }"),
+            pl.when(pl.int_range(pl.len()) < pl.len() - 1).then(pl.lit(",")).otherwise(pl.lit("")),
+        ).alias("line")
+    )
+    return pl.concat([pl.DataFrame({"line": ["["]}), objects, pl.DataFrame({"line": ["]"]})])
+
+
+def write_contacts(df: pl.LazyFrame, form: Format, start_time_string: str | None, out: str | IO):
+    """Writes the contact plan to the file path or file object out"""
+    plan = plan_frame(df, start_time_string).collect()
     if form == Format.RAW:
-        result = df.collect().write_csv()
-    if form == Format.HDTN:
-        df = df.drop("range_km")
-        result = json.dumps(json.loads(df.collect().write_json()), indent=4)
-
-    elif form == Format.ION:
-        def row_to_string(row: dict, mode: str) -> str:
-            if mode == "contact":
-                val = str(int(row["rateBitsPerSec"] / 8))
-            elif mode == "range":
-                val = str(row["owlt"])
-            else:
-                exit(1)
-            if start_time:
-                return " ".join(
-                    (
-                        f"a {mode}",
-                        "+"+str(row["startTime"]),
-                        "+"+str(row["endTime"]),
-                        str(row["source"]),
-                        str(row["dest"]),
-                        val)
-                    )
-            else:
-                return " ".join(
-                    (
-                        f"a {mode}",
-                        str(row["startTime"]),
-                        str(row["endTime"]),
-                        str(row["source"]),
-                        str(row["dest"]),
-                        val
-                    )
-                )
-
-
-        contacts = "\n".join(
-            [row_to_string(row, "contact") for row in df.collect().iter_rows(named=True)]
-        ) + "\n" + "\n".join(
-            [row_to_string(row, "range") for row in df.collect().iter_rows(named=True)]
+        plan.write_csv(out)
+        return
+    if form == Format.HDTN and plan.is_empty():
+        lines = pl.DataFrame({"line": ["[]"]})
+    else:
+        lines = plan_lines(plan, form, start_time_string is not None)
+    lines.write_csv(out, include_header=False, quote_style="never")
+
+
+def format_contacts(df: pl.LazyFrame, form: Format, start_time_string: str | None) -> str:
+    plan = io.StringIO()
+    write_contacts(df, form, start_time_string, plan)
+    return plan.getvalue()
+
+
+def resolve_target_ids(targets: list[str], start: str, end: str, catalogue_dir: str = CATALOGUE_DIR) -> list[int] | None:
+    """NAIF IDs of the targets matching the target name regexes, None if all targets are requested or the catalogue does not know them"""
+    if targets == [".+"]:
+        return None
+    files = path.join(catalogue_dir, "*.parquet")
+    if not path.isdir(catalogue_dir) or not any(f.endswith(".parquet") for f in listdir(catalogue_dir)):
+        logger.warning(f"No series catalogue at {catalogue_dir}, querying SPICE ranges of all targets")
+        return None
+    ids = pl.scan_parquet(files)\
+        .filter(
+            pl.col("data_source") == "DSN Now",
+            pl.col("target_name").str.contains(f"^(?:{'|'.join(targets)})$"),
+            pl.col("last_seen") >= to_timestamp(start),
+            pl.col("first_seen") <= to_timestamp(end),
+        )\
+        .select(pl.col("target_id").drop_nulls().unique().sort())\
+        .collect()["target_id"].to_list()
+    if not ids:
+        logger.warning(f"Targets {', '.join(targets)} not in the series catalogue, querying SPICE ranges of all targets")
+        return None
+    logger.debug(f"Resolved targets {', '.join(targets)} to NAIF IDs {ids}")
+    return ids
+
+
+def spice_tile_query(start: str, end: str, step: str, stations: list[str], target_ids: list[int], tile_dir: str = TILE_DIR) -> pl.LazyFrame:
+    """SPICE ranges of all dishes of the DSN stations matching the station regexes from the distance tile cache, computing missing tiles"""
+    if REPO_DIR not in sys.path:
+        sys.path.append(REPO_DIR)
+    # Imported here, so contact plans without tiles do not need spiceypy
+    from src.ingress.distance.tiles import DistanceTiles
+    from src.ingress.distance.distances import DSN_DISHES
+
+    station_names = [s for s in DSN_DISHES if re.fullmatch(f"(?:{'|'.join(stations)})", s)]
+    # Tiles exclude the end, queries include it
+    return DistanceTiles(tile_dir)\
+        .distances(station_names, target_ids, int(to_timestamp(start)), int(to_timestamp(end)) + 1, int(parse_step(step)))\
+        .select(
+            pl.from_epoch("time", time_unit="s").dt.replace_time_zone("UTC").alias("Time"),
+            pl.col("target").cast(pl.Int64).alias("target_id"),
+            pl.col("dish").alias("dish_name"),
+            pl.col("distance").alias("Value #SPICE Distance"),
         )
-        return contacts
 
-    return result
+
+def rate_target_ids(df_data_rate: pl.LazyFrame) -> list[int]:
+    """NAIF IDs of the targets with data rate samples"""
+    return df_data_rate.select(pl.col("target_id").cast(pl.Int64, strict=False).drop_nulls().unique().sort()).collect()["target_id"].to_list()
 
 
 def contact_query(
@@ -195,8 +280,16 @@ def contact_query(
         end: str,
         step: str,
         stations: list[str],
-        targets: list[str]) -> pl.LazyFrame:
-    """Querys Prometheus to acquire data for the given time period"""
+        targets: list[str],
+        cache: QueryCache | None = None,
+        tolerance: str | None = None,
+        interpolate: bool = False,
+        tile_dir: str | None = None,
+        report: bool = False) -> pl.LazyFrame:
+    """Querys Prometheus to acquire data for the given time period, reusing cached results if a cache is given
+
+    With tile_dir, SPICE ranges are taken from the distance tile cache instead of Prometheus.
+    """
 
     alt_str = lambda l : "|".join(l)
 
@@ -205,50 +298,224 @@ def contact_query(
 
     q_data_rate = f'signal_data_rate_b_per_s{{station_name=~"{station_string}", target_name=~"{target_string}", dish_activity="Spacecraft Telemetry, Tracking, and Command",signal_activity="true"}}'
     q_range_dsn = f'target_range_km{{data_source=~"DSN Now", station_name=~"{station_string}", target_name=~"{target_string}"}}'
-    # TODO: query target IDs based on provided names
-    q_range_spice =   f'target_range_km{{data_source=~"SPICE", station_name=~"{station_string}"}}'
+    # SPICE ranges are only labeled with NAIF IDs
+    target_ids = resolve_target_ids(targets, start, end)
+    id_selector = f', target_id=~"{alt_str(map(str, target_ids))}"' if target_ids else ""
+    q_range_spice =   f'target_range_km{{data_source=~"SPICE", station_name=~"{station_string}"{id_selector}}}'
+
+    if cache:
+        query = cache.query
+    else:
+        query = lambda q, *time_range: query_prometheus_CSV(PROMETHEUS_URL, q, *time_range)
+    df_data_rate = query(q_data_rate, start, end, step)
+    df_range_dsn = query(q_range_dsn, start, end, step)
+    if tile_dir is None:
+        df_range_spice = query(q_range_spice, start, end, step)
 
-    df_data_rate = query_prometheus_CSV(PROMETHEUS_URL, q_data_rate, start, end, step)
-    df_range_dsn = query_prometheus_CSV(PROMETHEUS_URL, q_range_dsn, start, end, step)
-    df_range_spice = query_prometheus_CSV(PROMETHEUS_URL, q_range_spice, start, end, step)
+    to_time = pl.from_epoch("Time", time_unit="s").dt.replace_time_zone("UTC")
+    labels = lambda l: [pl.col(c).cast(pl.String) for c in l]
 
+    # Up- and downleg ranges are reported as separate series
     df_range_dsn = (df_range_dsn
-                    .rename({"target_range_km": 'Value #DSN Distance'})
-                    .select(["Time", "dish_name", "station_name", "target_id", "target_name", "Value #DSN Distance"])
-                    .with_columns(pl.from_epoch(pl.col("Time").floordiv(5).mul(5), time_unit="s").dt.replace_time_zone("UTC")))
-    df_range_spice = (df_range_spice
-                      .rename({"target_range_km": 'Value #SPICE Distance'})
-                      .select(["Time", "target_id", "station_name", "Value #SPICE Distance"])
-                      .with_columns(pl.from_epoch(pl.col("Time").floordiv(5).mul(5), time_unit="s").dt.replace_time_zone("UTC")))
+                    .group_by(["Time", "dish_name", "station_name", "target_id", "target_name"])
+                    .agg(pl.mean("target_range_km").alias('Value #DSN Distance'))
+                    .with_columns(to_time, *labels(["dish_name", "station_name", "target_id", "target_name"])))
     df_data_rate = (df_data_rate
                     .rename({"signal_data_rate_b_per_s": 'Value #Data Rate'})
                     .select(["Time", "dish_name", "signal_direction", "signal_band", "station_name", "target_id", "target_name", "Value #Data Rate"])
-                    .with_columns(pl.from_epoch(pl.col("Time").floordiv(5).mul(5), time_unit="s").dt.replace_time_zone("UTC")))
+                    .with_columns(to_time, *labels(["dish_name", "signal_direction", "signal_band", "station_name", "target_id", "target_name"])))
+    if tile_dir is None:
+        # Series imported before SPICE ranges were calculated per dish only carry the station
+        spice_labels = [l for l in ["dish_name", "station_name"] if l in df_range_spice.collect_schema().names()][:1]
+        df_range_spice = (df_range_spice
+                          .rename({"target_range_km": 'Value #SPICE Distance'})
+                          .select(["Time", "target_id", *spice_labels, "Value #SPICE Distance"])
+                          .with_columns(to_time, *labels(["target_id", *spice_labels])))
+    else:
+        df_range_spice = spice_tile_query(start, end, step, stations, target_ids or rate_target_ids(df_data_rate), tile_dir)\
+            .with_columns(*labels(["target_id"]))
+
+    return align_contact_data(df_range_dsn, df_range_spice, df_data_rate, tolerance or step, interpolate, report)
 
-    # print(df_range_dsn.head(10).collect())
-    # print(df_range_spice.head(10).collect())
-    # print(df_data_rate.head(10).collect())
 
-    df_range = df_range_dsn.join(
-        other = df_range_spice,
-        on = ['Time','station_name','target_id'],
-        how = "full",
-        coalesce = True
+def contact_lake_query(
+        start: str,
+        end: str,
+        step: str,
+        stations: list[str],
+        targets: list[str],
+        lake_dir: str = LAKE_DIR,
+        distances_file: str = DISTANCES_FILE,
+        tolerance: str | None = None,
+        interpolate: bool = False,
+        tile_dir: str | None = None,
+        report: bool = False) -> pl.LazyFrame:
+    """Reads the data for the given time period from the parquet lake and the SPICE distances
+
+    With tile_dir, SPICE ranges are taken from the distance tile cache instead of distances_file.
+    """
+
+    alt_regex = lambda l : f"^(?:{'|'.join(l)})$"
+
+    step_seconds = int(parse_step(step))
+    start_ts = to_timestamp(start)
+    end_ts = to_timestamp(end)
+    to_time = lambda col : pl.from_epoch(pl.col(col).floordiv(step_seconds).mul(step_seconds), time_unit="s").dt.replace_time_zone("UTC").alias("Time")
+
+    # Time, station and target filters are pushed down into the parquet scan
+    lake = pl.scan_parquet(path.join(lake_dir, "*.parquet")).filter(
+        pl.col("timestamp").is_between(start_ts, end_ts),
+        pl.col("station_name").str.contains(alt_regex(stations)),
+        pl.col("target_name").str.contains(alt_regex(targets)),
+    ).with_columns(
+        to_time("timestamp"),
+        pl.col("target_id").cast(pl.Int64),
     )
 
-    # print(df_range.head(50).collect())
-    # print(df_range.tail(50).collect())
+    # Dish and target values repeat for every signal of a snapshot, keep the last snapshot per step.
+    # Up- and downleg ranges are averaged like the separate series in contact_query.
+    dsn_keys = ["Time", "dish_name", "station_name", "target_id", "target_name"]
+    df_range_dsn = lake\
+        .group_by(dsn_keys)\
+        .agg(
+            pl.mean_horizontal("target_downleg_range_km", "target_upleg_range_km")
+              .sort_by("timestamp").last().alias("Value #DSN Distance")
+        )
+
+    rate_keys = ["Time", "dish_name", "signal_direction", "signal_band", "station_name", "target_id", "target_name"]
+    df_data_rate = lake\
+        .filter(
+            pl.col("dish_activity") == "Spacecraft Telemetry, Tracking, and Command",
+            pl.col("signal_activity") == "true",
+        )\
+        .group_by(rate_keys)\
+        .agg(pl.col("signal_data_rate_b_per_s").cast(pl.Float64).sort_by("timestamp").last().alias("Value #Data Rate"))
+
+    spice_schema = {"Time": pl.Datetime("us", "UTC"), "target_id": pl.Int64, "dish_name": pl.String, "Value #SPICE Distance": pl.Float64}
+    if tile_dir is not None:
+        target_ids = resolve_target_ids(targets, start, end) or rate_target_ids(df_data_rate)
+        df_range_spice = spice_tile_query(start, end, step, stations, target_ids, tile_dir)
+    elif path.isfile(distances_file):
+        df_range_spice = pl.scan_csv(distances_file, schema_overrides={"time": pl.Int64, "station": pl.String, "dish": pl.String, "target": pl.Int64, "distance": pl.Float64})
+        # Files written before distances were calculated per dish only have the station
+        spice_label = pl.col("dish").alias("dish_name") if "dish" in df_range_spice.collect_schema().names() else pl.col("station").alias("station_name")
+        df_range_spice = df_range_spice\
+            .filter(
+                pl.col("time").is_between(start_ts, end_ts),
+                pl.col("station").str.contains(alt_regex(stations)),
+            )
+        target_ids = resolve_target_ids(targets, start, end)
+        if target_ids:
+            df_range_spice = df_range_spice.filter(pl.col("target").is_in(target_ids))
+        df_range_spice = df_range_spice\
+            .select(
+                pl.from_epoch("time", time_unit="s").dt.replace_time_zone("UTC").alias("Time"),
+                pl.col("target").alias("target_id"),
+                spice_label,
+                pl.col("distance").alias("Value #SPICE Distance"),
+            )
+    else:
+        logger.warning(f"No SPICE distances at {distances_file}")
+        df_range_spice = pl.LazyFrame(schema=spice_schema)
+
+    return align_contact_data(df_range_dsn, df_range_spice, df_data_rate, tolerance or step, interpolate, report)
+
+
+def align_contact_data(
+        df_range_dsn: pl.LazyFrame,
+        df_range_spice: pl.LazyFrame,
+        df_data_rate: pl.LazyFrame,
+        tolerance: str,
+        interpolate: bool = False,
+        report: bool = False) -> pl.LazyFrame:
+    """Adds the nearest DSN and SPICE ranges within tolerance to every data rate sample
+
+    With interpolate, SPICE ranges are interpolated linearly between the samples
+    before and after each data rate sample, if both are within tolerance. With
+    report, the number of samples without ranges is logged, which evaluates the
+    alignment once more.
+    """
+    dsn_keys = ["dish_name", "station_name", "target_id", "target_name"]
+    # SPICE ranges are calculated for every dish, older ones only per station
+    if "dish_name" in df_range_spice.collect_schema().names():
+        spice_keys = ["dish_name", "target_id"]
+    else:
+        logger.info("SPICE ranges are not labeled with dishes, aligning them by station")
+        spice_keys = ["station_name", "target_id"]
+    spice = "Value #SPICE Distance"
+
+    df = df_data_rate\
+        .filter(pl.col("Value #Data Rate").is_not_null())\
+        .sort("Time")\
+        .join_asof(df_range_dsn.sort("Time"), on="Time", by=dsn_keys, strategy="nearest", tolerance=tolerance, check_sortedness=False)
+
+    df_range_spice = df_range_spice.filter(pl.col(spice).is_not_null()).sort("Time")
+    if interpolate:
+        side = lambda suffix: df_range_spice.select(
+            *spice_keys, "Time", pl.col("Time").alias(f"t{suffix}"), pl.col(spice).alias(f"d{suffix}")
+        )
+        elapsed = (pl.col("Time") - pl.col("t0")).dt.total_microseconds()
+        width = (pl.col("t1") - pl.col("t0")).dt.total_microseconds()
+        df = df\
+            .join_asof(side(0), on="Time", by=spice_keys, strategy="backward", tolerance=tolerance, check_sortedness=False)\
+            .join_asof(side(1), on="Time", by=spice_keys, strategy="forward", tolerance=tolerance, check_sortedness=False)\
+            .with_columns(
+                pl.when(width > 0)
+                  .then(pl.col("d0") + (pl.col("d1") - pl.col("d0")) * elapsed / width)
+                  .otherwise(pl.coalesce("d0", "d1"))
+                  .alias(spice)
+            )\
+            .drop("t0", "d0", "t1", "d1")
+    else:
+        df = df.join_asof(df_range_spice, on="Time", by=spice_keys, strategy="nearest", tolerance=tolerance, check_sortedness=False)
 
-    df = df_range.join(
-        other = df_data_rate,
-        on = ['Time','dish_name', 'station_name','target_id','target_name'],
-        how = "full",
-        coalesce = True
-    ).filter(pl.col("Value #Data Rate").is_null().not_())
+    if report:
+        counts = df.select(
+            pl.len().alias("samples"),
+            pl.col("Value #DSN Distance").null_count().alias("dsn"),
+            pl.col(spice).null_count().alias("spice"),
+        ).collect(engine="streaming").row(0, named=True)
+        logger.info(f"Of {counts['samples']} data rate samples {counts['dsn']} have no DSN range "
+                    f"and {counts['spice']} no SPICE range within {tolerance}")
 
     return df
 
 
+def update_contacts(
+        end: str,
+        step: str,
+        load: Callable[[str, str], pl.LazyFrame],
+        start: str | None = None,
+        contact_dir: str = CONTACT_DIR) -> pl.LazyFrame:
+    """Feeds the samples since the last update to the contact detector, returns all closed contacts
+
+    load returns the samples between a start and end time, e.g. contact_lake_query.
+    """
+    state_dir = path.join(contact_dir, "state")
+    plan_dir = path.join(contact_dir, "plan")
+    detector = ContactDetector.load(state_dir, int(parse_step(step)))
+    if detector.watermark is not None:
+        # The detector ignores samples up to the watermark
+        start = to_iso(detector.watermark + 1)
+    elif start is None:
+        logger.error("The first update requires a start time")
+        exit(1)
+
+    end_ts = int(to_timestamp(end))
+    if end_ts >= to_timestamp(start):
+        closed = detector.update(load(start, end), watermark=end_ts)
+        logger.info(f"{len(closed)} contacts closed, {len(detector.state)} open")
+        makedirs(plan_dir, exist_ok=True)
+        if len(closed):
+            closed.write_parquet(path.join(plan_dir, f"{end_ts}.parquet"))
+        detector.save(state_dir)
+    else:
+        logger.info("Contacts are up to date")
+
+    if not path.isdir(plan_dir) or not listdir(plan_dir):
+        return detector.empty().lazy()
+    return pl.scan_parquet(path.join(plan_dir, "*.parquet"))
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
@@ -257,6 +524,7 @@ if __name__ == "__main__":
     parser.add_argument("-o","--output", help="Path to output file; printing to console otherwise")
     parser.add_argument("-r", "--relative_time", action="store_true", help="Output real timestamps or duration relative to specified start time")
     parser.add_argument("-f","--format",help="DTN contact plan format (RAW, HDTN, ION)", type=lambda x: Format[x], default = Format.RAW)
+    parser.add_argument("-i", "--index", nargs="?", const=INDEX_FILE, help="Also add the contacts to the interval index, see intervals.py")
     parser.add_argument("-l", "--log", help="Loglevel", default="info")
     subparsers = parser.add_subparsers(help="Subcommand help", dest="subparser_name")
 
@@ -264,12 +532,28 @@ if __name__ == "__main__":
     parser_grafana.add_argument("input", help="Path to contacts CSV exported from Grafana")
     parser_grafana.add_argument("-s","--start_time", help="Start time")
 
-    parser_prom = subparsers.add_parser("create", help="Query Prometheus automatically")
+    # Options shared by all subcommands reading samples
+    parser_query = argparse.ArgumentParser(add_help=False)
+    parser_query.add_argument("-t","--targets", help="Comma separated string of target names", default=[".+"], type=lambda x: [str(item) for item in x.split(",")])
+    parser_query.add_argument("-s","--stations", help="Comma separated string of station names", default=[".+"], type=lambda x: [str(item) for item in x.split(",")])
+    parser_query.add_argument("--step", help="Step size", default="5s")
+    parser_query.add_argument("--no-cache", action="store_true", help="Query Prometheus without the local query cache")
+    parser_query.add_argument("--source", help="Read from Prometheus or directly from the parquet lake", choices=["prometheus", "lake"], default="prometheus")
+    parser_query.add_argument("--lake", help="Directory containing parquetify output", default=LAKE_DIR)
+    parser_query.add_argument("--distances", help="Path to SPICE distances CSV", default=DISTANCES_FILE)
+    parser_query.add_argument("--spice-tiles", nargs="?", const=TILE_DIR, help="Compute SPICE ranges on demand in this distance tile cache instead of reading them from Prometheus or the distances CSV")
+    parser_query.add_argument("--tolerance", help="Maximum time between a data rate sample and its ranges, the step size by default")
+    parser_query.add_argument("--interpolate", action="store_true", help="Interpolate SPICE ranges to the data rate sample times")
+    parser_query.add_argument("--report", action="store_true", help="Log the number of data rate samples without ranges, reads the samples twice")
+
+    parser_prom = subparsers.add_parser("create", help="Query Prometheus automatically", parents=[parser_query])
     parser_prom.add_argument("start_time", help="Start time")
     parser_prom.add_argument("end_time", help="End time")
-    parser_prom.add_argument("-t","--targets", help="Comma separated string of target names", default=[".+"], type=lambda x: [str(item) for item in x.split(",")])
-    parser_prom.add_argument("-s","--stations", help="Comma separated string of station names", default=[".+"], type=lambda x: [str(item) for item in x.split(",")])
-    parser_prom.add_argument("--step", help="Step size", default="5s")
+
+    parser_update = subparsers.add_parser("update", help="Add contacts closed since the last update to a rolling plan", parents=[parser_query])
+    parser_update.add_argument("end_time", help="End time of the update")
+    parser_update.add_argument("--start_time", help="Start time of the first update")
+    parser_update.add_argument("--dir", help="Directory holding the detector state and closed contacts", default=CONTACT_DIR)
     args = parser.parse_args()
 
     if args.log:
@@ -285,28 +569,34 @@ if __name__ == "__main__":
     pl.Config.set_tbl_rows(50)
     pl.Config.set_tbl_cols(-1)
 
-    # Parse args
+    def load(start: str, end: str) -> pl.LazyFrame:
+        """Query Prometheus or the lake for specified parameters"""
+        if args.source == "lake":
+            # Months of 5 s samples do not fit into memory
+            pl.Config.set_engine_affinity("streaming")
+            return contact_lake_query(start, end, args.step, args.stations, args.targets, args.lake, args.distances, args.tolerance, args.interpolate, args.spice_tiles, args.report)
+        cache = None if args.no_cache else QueryCache(PROMETHEUS_URL)
+        return contact_query(start, end, args.step, args.stations, args.targets, cache, args.tolerance, args.interpolate, args.spice_tiles, args.report)
+
+    # Parse args and find contacts
     match args.subparser_name:
         case "parse":
             # Read CSV exported from Grafana
-            df = pl.scan_csv(args.input, schema=SCHEMA)
+            contacts = get_contacts(pl.scan_csv(args.input, schema=SCHEMA))
         case "create":
-            # Query Prometheus for specified parameters
-            df = contact_query(args.start_time, args.end_time, args.step, args.stations, args.targets)
+            contacts = get_contacts(load(args.start_time, args.end_time))
+        case "update":
+            contacts = update_contacts(args.end_time, args.step, load, args.start_time, args.dir)
         case _:
-            logger.error("Specify one of parse of create")
+            logger.error("Specify one of parse, create or update")
             exit(1)
 
-    # Find contacts and build plan
-    contacts = get_contacts(df)
-    if args.relative_time:
-        plan = format_contacts(contacts, args.format, args.start_time)
-    else:
-        plan = format_contacts(contacts, args.format, None)
+    if args.index:
+        contacts = contacts.collect().lazy()
+        index = IntervalIndex.load(args.index).add(contacts_to_intervals(contacts.collect()))
+        index.save(args.index)
+        logger.info(f"Interval index holds {len(index)} intervals")
 
-    # Write output
-    if args.output:
-        with open(args.output, "w") as out_file:
-            out_file.write(plan)
-    else:
-        print(plan)
+    # Build plan and write output
+    start_time = args.start_time if args.relative_time else None
+    write_contacts(contacts, args.format, start_time, args.output or sys.stdout)
@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+"""Incremental contact detection.
+
+ContactDetector consumes batches of samples in time order and keeps one open
+contact per dish, target, direction and band. Contacts are split by the same
+rules as contact.get_contacts: a gap between samples other than the sampling
+interval, or the cumulated range change within a contact passing another
+LIGHT_SECOND. Closed contacts are returned as soon as a batch shows they
+ended, so the cost of an update only depends on the new samples.
+"""
+
+import json
+import logging
+import polars as pl
+from os import path, makedirs, replace
+
+logger = logging.getLogger(__name__)
+
+# Distance light travels in one second in km
+LIGHT_SECOND = 299792.458
+
+KEYS = ["dish_name", "target_name", "signal_direction", "signal_band"]
+STATE_FILE = "state.parquet"
+# Key of the watermark and counters in the metadata of STATE_FILE
+META_KEY = "contact_detector"
+# Separate watermark file of state saved before it moved into STATE_FILE
+META_FILE = "state.json"
+
+STATE_SCHEMA = {
+    **{k: pl.String for k in KEYS},
+    "contact": pl.Int64,
+    "start": pl.Int64,
+    "last": pl.Int64,
+    "last_dsn": pl.Float64,
+    "last_spice": pl.Float64,
+    "cum_dsn": pl.Float64,
+    "cum_spice": pl.Float64,
+    "segment": pl.Int64,
+    "sum_rate": pl.Float64,
+    "n_rate": pl.UInt32,
+    "sum_dsn": pl.Float64,
+    "n_dsn": pl.UInt32,
+    "sum_spice": pl.Float64,
+    "n_spice": pl.UInt32,
+}
+
+
+class ContactDetector:
+    """Online version of contact.get_contacts for samples arriving in time order"""
+
+    def __init__(self, interval: int = 5):
+        self.interval = interval
+        self.watermark: int | None = None
+        self.next_contact = 0
+        self.state = pl.DataFrame(schema=STATE_SCHEMA)
+
+    def update(self, df: pl.LazyFrame | pl.DataFrame, watermark: int | None = None) -> pl.DataFrame:
+        """Add samples newer than the watermark, returns the contacts they closed
+
+        The watermark is the time up to which all samples have been passed,
+        the latest sample time by default.
+        """
+        samples = df.lazy().select(
+            *[pl.col(k).cast(pl.String) for k in KEYS],
+            pl.col("Time").dt.epoch("s").alias("t"),
+            pl.col("Value #Data Rate").cast(pl.Float64).alias("rate"),
+            pl.col("Value #DSN Distance").cast(pl.Float64).alias("dsn"),
+            pl.col("Value #SPICE Distance").cast(pl.Float64).alias("spice"),
+            pl.lit(False).alias("is_state"),
+        )
+        if self.watermark is not None:
+            samples = samples.filter(pl.col("t") > self.watermark)
+        samples = samples.collect()
+
+        if watermark is None:
+            watermark = samples["t"].max() if len(samples) else self.watermark
+        if watermark is None:
+            return self.empty()
+        self.watermark = watermark
+
+        # The last sample of every open contact continues its gap and range rules
+        state_rows = self.state.select(
+            *KEYS,
+            pl.col("last").alias("t"),
+            pl.lit(None, pl.Float64).alias("rate"),
+            pl.col("last_dsn").alias("dsn"),
+            pl.col("last_spice").alias("spice"),
+            pl.lit(True).alias("is_state"),
+        )
+        combined = pl.concat([state_rows, samples]).lazy()\
+            .join(self.state.lazy().select(*KEYS, "cum_dsn", "cum_spice", "segment"), on=KEYS, how="left", nulls_equal=True)\
+            .sort(*KEYS, "t", pl.col("is_state").not_(), nulls_last=True)
+
+        gap = pl.col("t").diff().over(KEYS)
+        combined = combined.with_columns(
+            (gap.is_null() | ((gap != self.interval) & (gap != 0))).cum_sum().alias("run")
+        )
+        step = lambda c: pl.when(pl.col("is_state")).then(pl.col(f"cum_{c}")).otherwise((pl.col(c) - pl.col(c).shift()).abs().over("run"))
+        combined = combined.with_columns(
+            step("spice").cum_sum().over("run").alias("row_spice"),
+            step("dsn").cum_sum().over("run").alias("row_dsn"),
+            step("spice").fill_null(0).sum().over("run").alias("run_spice"),
+            step("dsn").fill_null(0).sum().over("run").alias("run_dsn"),
+        ).with_columns(
+            pl.when(pl.col("is_state")).then(pl.col("segment"))
+              .when(pl.col("row_spice").is_not_null()).then(pl.col("row_spice").floordiv(LIGHT_SECOND).cast(pl.Int64))
+              .when(pl.col("row_dsn").is_not_null()).then(pl.col("row_dsn").floordiv(LIGHT_SECOND).cast(pl.Int64))
+              .forward_fill().over("run").fill_null(0)
+              .alias("k")
+        ).with_columns(
+            (pl.col("run") != pl.col("run").shift()).fill_null(True)
+            .or_((pl.col("k") != pl.col("k").shift().over("run")).fill_null(False))
+            .cum_sum().alias("sub")
+        )
+
+        sample = lambda c: pl.when(pl.col("is_state").not_()).then(pl.col(c))
+        subs = combined.group_by("sub", maintain_order=True).agg(
+            *[pl.col(k).first() for k in KEYS],
+            pl.col("is_state").any().alias("has_state"),
+            pl.col("t").first().alias("start"),
+            pl.col("t").last().alias("last"),
+            pl.col("dsn").last().alias("last_dsn"),
+            pl.col("spice").last().alias("last_spice"),
+            pl.col("run_dsn").last().alias("cum_dsn"),
+            pl.col("run_spice").last().alias("cum_spice"),
+            pl.col("k").last().alias("segment"),
+            sample("rate").sum().alias("sum_rate"),
+            sample("rate").count().alias("n_rate"),
+            sample("dsn").sum().alias("sum_dsn"),
+            sample("dsn").count().alias("n_dsn"),
+            sample("spice").sum().alias("sum_spice"),
+            sample("spice").count().alias("n_spice"),
+        ).with_columns(
+            ((pl.col("sub") != pl.col("sub").max().over(KEYS))
+             | (pl.col("last") + self.interval <= watermark)).alias("closed")
+        ).collect()
+
+        # Contacts continued from the state keep their id, start and sums
+        subs = subs.join(
+            self.state.select(*KEYS, "contact", pl.col("start").alias("state_start"),
+                              *[pl.col(c).alias(f"state_{c}") for c in ("sum_rate", "n_rate", "sum_dsn", "n_dsn", "sum_spice", "n_spice")]),
+            on=KEYS, how="left", nulls_equal=True
+        ).with_columns(
+            pl.when(pl.col("has_state")).then(pl.col("contact"))
+              .otherwise(pl.lit(self.next_contact) + pl.int_range(pl.len()) - pl.col("has_state").cum_sum())
+              .alias("contact"),
+            pl.when(pl.col("has_state")).then(pl.col("state_start")).otherwise(pl.col("start")).alias("start"),
+            *[pl.when(pl.col("has_state")).then(pl.col(c) + pl.col(f"state_{c}")).otherwise(pl.col(c)).alias(c)
+              for c in ("sum_rate", "n_rate", "sum_dsn", "n_dsn", "sum_spice", "n_spice")],
+        )
+        self.next_contact += int((~subs["has_state"]).sum())
+
+        self.state = subs.filter(pl.col("closed").not_()).select(STATE_SCHEMA.keys()).cast(STATE_SCHEMA)
+        closed = subs.filter(pl.col("closed"))
+        logger.debug(f"Closed {len(closed)} contacts, {len(self.state)} open")
+        return self._contacts(closed)
+
+    def flush(self) -> pl.DataFrame:
+        """Close all open contacts, e.g. at the end of the data"""
+        closed = self._contacts(self.state)
+        self.state = pl.DataFrame(schema=STATE_SCHEMA)
+        return closed
+
+    def _contacts(self, df: pl.DataFrame) -> pl.DataFrame:
+        """Contacts in the layout of contact.get_contacts"""
+        mean = lambda c: pl.when(pl.col(f"n_{c}") > 0).then(pl.col(f"sum_{c}") / pl.col(f"n_{c}"))
+        return df.select(
+            *KEYS,
+            "contact",
+            pl.from_epoch("start", time_unit="s").dt.replace_time_zone("UTC").alias("start_time"),
+            pl.from_epoch("last", time_unit="s").dt.replace_time_zone("UTC").alias("end_time"),
+            mean("rate").alias("mean_data_rate"),
+            mean("dsn").alias("mean_dsn_range"),
+            mean("spice").alias("mean_spice_range"),
+        )
+
+    def empty(self) -> pl.DataFrame:
+        return self._contacts(pl.DataFrame(schema=STATE_SCHEMA))
+
+    def save(self, state_dir: str):
+        """Write open contacts and watermark to one file, replaced at once so both always match"""
+        makedirs(state_dir, exist_ok=True)
+        state_path = path.join(state_dir, STATE_FILE)
+        meta = {"interval": self.interval, "watermark": self.watermark, "next_contact": self.next_contact}
+        self.state.write_parquet(state_path + ".tmp", metadata={META_KEY: json.dumps(meta)})
+        replace(state_path + ".tmp", state_path)
+
+    @classmethod
+    def load(cls, state_dir: str, interval: int = 5) -> "ContactDetector":
+        """Detector saved in state_dir, or a new one if there is none"""
+        detector = cls(interval)
+        state_path = path.join(state_dir, STATE_FILE)
+        try:
+            meta = json.loads(pl.read_parquet_metadata(state_path)[META_KEY])
+        except (OSError, KeyError):
+            try:
+                with open(path.join(state_dir, META_FILE)) as f:
+                    meta = json.load(f)
+            except (OSError, ValueError):
+                return detector
+        if meta["interval"] != interval:
+            logger.warning(f"Keeping saved interval of {meta['interval']} s instead of {interval} s")
+        detector.interval = meta["interval"]
+        detector.watermark = meta["watermark"]
+        detector.next_contact = meta["next_contact"]
+        detector.state = pl.read_parquet(state_path).cast(STATE_SCHEMA)
+        return detector
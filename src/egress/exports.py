@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+"""Incremental parquet exports of Prometheus queries.
+
+The jobs are declared in config/exports.toml. Every run only queries the time
+after the last export of a dataset and appends the result to a parquet dataset
+partitioned by day, so a daily refresh fetches a single day.
+"""
+
+import argparse
+import datetime as dt
+import json
+import logging
+import tomllib
+import polars as pl
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from os import path, makedirs
+from shutil import rmtree
+from extract import query_prometheus_split, parse_step, MAX_WORKERS
+from lakeserver import Lake, Parser, DATA_SOURCE, LAKE_DIR, ROLLUP_DIR
+from promToCSV import matrixToCSV
+from querycache import to_timestamp, to_iso
+
+logger = logging.getLogger(__name__)
+
+DATA_DIR = path.abspath(path.join(path.dirname(__file__),"../../data/"))
+CONFIG_FILE = path.abspath(path.join(path.dirname(__file__),"../../config/exports.toml"))
+STATE_FILE = "_export_state.json"
+
+
+@dataclass
+class Job:
+    name: str
+    query: str
+    output: str
+    prometheus: str
+    step: str
+    start: str
+    end: str | None = None
+    columns: list[str] = field(default_factory=list)
+    # Either "prometheus" or "lake" to evaluate the query on the parquet lake
+    source: str = "prometheus"
+    lake: str = LAKE_DIR
+    rollups: str = ROLLUP_DIR
+
+    @property
+    def dataset(self) -> str:
+        return path.join(DATA_DIR, self.output)
+
+
+def load_jobs(config_file: str = CONFIG_FILE) -> list[Job]:
+    with open(config_file, "rb") as f:
+        config = tomllib.load(f)
+    defaults = config.get("defaults", {})
+    return [Job(**(defaults | job)) for job in config.get("job", [])]
+
+
+def exported_until(dataset: str) -> float | None:
+    """Timestamp of the last step covered by previous exports of dataset"""
+    try:
+        with open(path.join(dataset, STATE_FILE)) as f:
+            return json.load(f)["end"]
+    except (OSError, ValueError, KeyError):
+        pass
+    # Datasets without state, e.g. if the state file was removed. Partitions
+    # of jobs without fixed columns differ in the labels present on that day.
+    if path.isdir(dataset):
+        last = pl.scan_parquet(path.join(dataset, "**/*.parquet"), missing_columns="insert", extra_columns="ignore")\
+            .select(pl.col("Time").max())\
+            .collect()\
+            .item()
+        if last is not None:
+            return float(last)
+    return None
+
+
+def write_partitions(df: pl.DataFrame, dataset: str, name: str):
+    """Append df to dataset as one new file per day"""
+    df = df.with_columns(pl.from_epoch("Time", time_unit="s").dt.date().alias("day"))
+    for (day,), part in df.partition_by("day", as_dict=True, include_key=False).items():
+        day_dir = path.join(dataset, f"day={day}")
+        makedirs(day_dir, exist_ok=True)
+        part.write_parquet(path.join(day_dir, f"{name}.parquet"))
+
+
+def select_columns(df: pl.DataFrame, columns: list[str]) -> pl.DataFrame:
+    """df with exactly columns, labels absent from this export are added as nulls"""
+    return df.select(pl.col(c) if c in df.columns else pl.lit(None, pl.String).alias(c) for c in columns)
+
+
+def day_ranges(start: float, end: float, step: float) -> list[tuple[float, float]]:
+    """Split the steps from start to end into one range per UTC day"""
+    ranges = []
+    while start <= end:
+        day = dt.datetime.fromtimestamp(start, dt.timezone.utc).date() + dt.timedelta(days=1)
+        next_day = dt.datetime.combine(day, dt.time(), dt.timezone.utc).timestamp()
+        next_start = start + -(-(next_day - start) // step) * step
+        ranges.append((start, min(next_start - step, end)))
+        start = next_start
+    return ranges
+
+
+def query_prometheus(job: Job, start: float, end: float, workers: int) -> pl.DataFrame:
+    responses = query_prometheus_split(job.prometheus, job.query, to_iso(start), to_iso(end), job.step, workers, raw=True)
+    frames = [matrixToCSV(content) for content in responses.values()]
+    return pl.concat(frames, how="diagonal_relaxed").collect() if frames else pl.DataFrame()
+
+
+def query_lake(job: Job, start: float, end: float) -> pl.DataFrame:
+    """Evaluates the query on the parquet lake, in the same layout as query results from Prometheus"""
+    step = int(parse_step(job.step))
+    df, labels, name = Lake(job.lake, job.rollups).evaluate(Parser(job.query).parse(), int(start), int(end), step)
+    # Prometheus omits empty labels
+    label_columns = [pl.when(pl.col(l) != "").then(pl.col(l)).alias(l) for l in labels]
+    if name:
+        label_columns.insert(0, pl.lit(DATA_SOURCE).alias("data_source"))
+    return df\
+        .select(pl.col("timestamp").alias("Time"), pl.col("value").alias(name or "value"), *label_columns)\
+        .sort("Time")\
+        .collect(engine="streaming")
+
+
+def export_range(job: Job, start: float, end: float, workers: int = MAX_WORKERS) -> int:
+    """Append the results between start and end to the dataset of job, returns the number of rows"""
+    logger.info(f"Exporting {job.name} between {to_iso(start)} and {to_iso(end)} from {job.source}")
+    match job.source:
+        case "prometheus":
+            df = query_prometheus(job, start, end, workers)
+        case "lake":
+            df = query_lake(job, start, end)
+        case _:
+            raise ValueError(f"Unknown source {job.source} of job {job.name}")
+
+    rows = len(df)
+    if rows:
+        if job.columns:
+            df = select_columns(df, job.columns)
+        write_partitions(df, job.dataset, f"{int(start)}-{int(end)}")
+    else:
+        logger.warning(f"No data for {job.name} between {to_iso(start)} and {to_iso(end)}")
+
+    makedirs(job.dataset, exist_ok=True)
+    with open(path.join(job.dataset, STATE_FILE), "w") as f:
+        json.dump({"query": job.query, "step": job.step, "end": end}, f)
+    logger.info(f"Appended {rows} rows to {job.dataset}")
+    return rows
+
+
+def run_job(job: Job, end: float, workers: int = MAX_WORKERS) -> int:
+    """Export job up to end, returns the number of rows appended
+
+    The time since the last export is queried one day at a time, so the first
+    run of a job catches up on its backlog without holding it in memory and an
+    interrupted run resumes after the last completed day.
+    """
+    step = parse_step(job.step)
+    if job.end is not None:
+        end = min(end, to_timestamp(job.end))
+    last = exported_until(job.dataset)
+    start = to_timestamp(job.start) if last is None else last + step
+    # Keep the step grid of previous exports
+    end = start + (end - start) // step * step
+    if end < start:
+        logger.info(f"{job.name} is up to date")
+        return 0
+    return sum(export_range(job, day_start, day_end, workers) for day_start, day_end in day_ranges(start, end, step))
+
+
+def run_jobs(jobs: list[Job], end: float, concurrency: int, workers: int = MAX_WORKERS) -> dict[str, int]:
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {job.name: executor.submit(run_job, job, end, workers) for job in jobs}
+        return {name: future.result() for name, future in futures.items()}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export Prometheus queries to parquet datasets incrementally")
+    parser.add_argument("jobs", help="Names of the jobs to run, all by default", nargs="*")
+    parser.add_argument("-c", "--config", help="Path to the job configuration", default=CONFIG_FILE)
+    parser.add_argument("-e", "--end", help="Export until this time instead of now")
+    parser.add_argument("-j", "--concurrency", help="Number of jobs run at once", type=int, default=2)
+    parser.add_argument("-w", "--workers", help="Number of concurrent queries per job", type=int, default=MAX_WORKERS)
+    parser.add_argument("--rebuild", action="store_true", help="Remove the datasets and export from the start")
+    parser.add_argument("-l", "--log", help="Loglevel", default="info")
+    args = parser.parse_args()
+
+    if args.log:
+        numeric_level = getattr(logging, args.log.upper(), None)
+        if not isinstance(numeric_level, int):
+            raise ValueError('Invalid log level: %s' % args.log)
+    else:
+        numeric_level = logging.INFO
+    logging.basicConfig(level=numeric_level)
+
+    jobs = load_jobs(args.config)
+    if args.jobs:
+        unknown = set(args.jobs) - {job.name for job in jobs}
+        if unknown:
+            logger.error(f"Unknown jobs: {', '.join(sorted(unknown))}")
+            exit(1)
+        jobs = [job for job in jobs if job.name in args.jobs]
+
+    if args.rebuild:
+        for job in jobs:
+            if path.isdir(job.dataset):
+                rmtree(job.dataset)
+
+    end = to_timestamp(args.end) if args.end else dt.datetime.now(dt.timezone.utc).timestamp()
+    for name, rows in run_jobs(jobs, end, args.concurrency, args.workers).items():
+        print(f"{name}: {rows}")
@@ -7,10 +7,27 @@ import re
 import json
 import datetime as dt
 import polars as pl
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from promToCSV import matrixToCSV
 from os import path, mkdir
 
-MAX_INTERVAL_COUNT = 1024
+# Prometheus rejects range queries returning more points per series than this
+MAX_POINTS = 11000
+MAX_WORKERS = 8
+TIMEOUT = 120
+RETRIES = 3
+
+DURATION_UNITS = {
+    "ms": 0.001,
+    "s": 1,
+    "m": 60,
+    "h": 60*60,
+    "d": 24*60*60,
+    "w": 7*24*60*60,
+    "y": 365*24*60*60,
+}
 
 logger = logging.getLogger(__name__)
 
@@ -18,25 +35,77 @@ def prepare_query_string(query) -> str:
     """Add quotation marks around label values, in case the console ate them"""
     return re.sub(r'(\w+)=[~]["]([^,}]+)["]', r'\1=~"\2"', query)
 
-def split_time_range(start, end, count) -> list[str]:
-    start = dt.datetime.fromisoformat(start)
-    end = dt.datetime.fromisoformat(end)
-
-    splits = [start + i*(end-start)/count for i in range(count+1)]
+def parse_step(step: str) -> float:
+    """Step in seconds, given as Prometheus duration (e.g. 1m30s) or number"""
+    try:
+        return float(step)
+    except ValueError:
+        pass
+    parts = re.findall(r"(\d+(?:\.\d+)?)(ms|s|m|h|d|w|y)", step)
+    if not parts or "".join(n + u for n, u in parts) != step:
+        raise ValueError(f"Invalid step: {step}")
+    return sum(float(n) * DURATION_UNITS[u] for n, u in parts)
+
+def to_timestamp(time_string: str) -> float:
+    """Seconds since epoch of a unix timestamp or an ISO 8601 time, UTC unless the time zone is given"""
+    try:
+        return float(time_string)
+    except ValueError:
+        pass
+    time = dt.datetime.fromisoformat(time_string)
+    if time.tzinfo is None:
+        time = time.replace(tzinfo=dt.timezone.utc)
+    return time.timestamp()
+
+def split_time_range(start, end, step, max_points=MAX_POINTS) -> list[list[str]]:
+    """Split start to end into the fewest ranges with at most max_points steps each
+
+    Ranges are aligned to the step of the full query and do not overlap, so the
+    concatenated results equal a single query without resolution limit. Start
+    and end are unix timestamps or ISO 8601 times and passed on as they are if
+    no split is needed.
+    """
+    points = int((to_timestamp(end) - to_timestamp(start)) / step) + 1
+    if points <= max_points:
+        return [[start, end]]
+
+    start = dt.datetime.fromtimestamp(to_timestamp(start), dt.timezone.utc)
+    end = dt.datetime.fromtimestamp(to_timestamp(end), dt.timezone.utc)
+    step = dt.timedelta(seconds=step)
+    chunk = max_points * step
 
     intervals = []
-    for i in range(len(splits) - 1):
-        intervals.append([splits[i].isoformat(), splits[i+1].isoformat()])
+    for i in range(-(-points // max_points)):
+        chunk_start = start + i*chunk
+        chunk_end = min(chunk_start + chunk - step, end)
+        intervals.append([chunk_start.isoformat(), chunk_end.isoformat()])
 
     logger.debug(f"New time intervals: {intervals}")
     return intervals
 
+def create_session(workers: int = MAX_WORKERS, retries: int = RETRIES) -> requests.Session:
+    """Session with a connection pool for workers and retries on transient errors"""
+    retry = Retry(
+        total=retries,
+        backoff_factor=0.5,
+        status_forcelist=[429, 502, 503, 504],
+        allowed_methods=["GET"],
+    )
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers, max_retries=retry)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
 def query_prometheus(
         prometheus: str,
         query: str,
         start: str,
         end: str,
-        step: str) -> dict | requests.Response:
+        step: str,
+        session: requests.Session | None = None,
+        raw: bool = False) -> dict | bytes | requests.Response:
+    """Data of a range query, or the undecoded response body if raw is set"""
 
     params = {
         "query": query,
@@ -46,11 +115,13 @@ def query_prometheus(
     }
 
     logger.debug(f"Params: {params}")
-    response = requests.get(url=f"{prometheus}/api/v1/query_range", params=params)
+    response = (session or requests).get(url=f"{prometheus}/api/v1/query_range", params=params, timeout=TIMEOUT)
 
     match response.status_code:
         case 200:
             logger.debug(f"Query for {query} between {start} and {end} succesful")
+            if raw:
+                return response.content
             return response.json()['data']
         case 404:
             logger.error(f"No Prometheus instance at {prometheus}")
@@ -61,7 +132,10 @@ def query_prometheus(
 
 
 def is_step_size_error(response: requests.Response) -> bool:
-    return "exceeded maximum resolution" in response.json()["error"]
+    try:
+        return "exceeded maximum resolution" in response.json()["error"]
+    except (ValueError, KeyError):
+        return False
 
 
 def query_prometheus_split(
@@ -69,50 +143,61 @@ def query_prometheus_split(
         query: str,
         start: str,
         end: str,
-        step: str) -> dict:
+        step: str,
+        workers: int = MAX_WORKERS,
+        raw: bool = False) -> dict:
 
     logger.info(f"Querying for {query}")
 
-    response = query_prometheus(prometheus, query, start, end, step)
-
-    if isinstance(response, dict):
-        return {0: response}
-
-    interval_count = 2
-    step_size_error = is_step_size_error(response)
-    response_dict = {}
-    while step_size_error and interval_count < MAX_INTERVAL_COUNT:
-        step_size_error = False
-        logger.info(f"Step size requires multiple queries, trying {interval_count} intervals")
-
-        for index, interval in enumerate(split_time_range(start, end, interval_count)):
-            response = query_prometheus(prometheus, query, interval[0], interval[1], step)
-
-            if isinstance(response, dict):
-                response_dict[index] = response
-            else:
-                step_size_error = is_step_size_error(response)
-                if step_size_error:
-                    logger.debug("Exceeding query limits")
-                    response_dict.clear()
-                    break
-
-        interval_count *= 2
-
-    if step_size_error and interval_count >= MAX_INTERVAL_COUNT:
-        logger.error("You should probably increase the step size")
+    step_seconds = parse_step(step)
+    max_points = MAX_POINTS
+    while True:
+        intervals = split_time_range(start, end, step_seconds, max_points)
+        if len(intervals) > 1:
+            logger.info(f"Step size requires {len(intervals)} queries")
+
+        with create_session(workers) as session, ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(query_prometheus, prometheus, query, interval[0], interval[1], step, session, raw)
+                for interval in intervals
+            ]
+            responses = []
+            errors = []
+            for interval, future in zip(intervals, futures):
+                # Raised once the retries of the session are exhausted
+                try:
+                    responses.append(future.result())
+                except requests.exceptions.RequestException as e:
+                    logger.error(f"Query between {interval[0]} and {interval[1]} failed: {e}")
+                    errors.append(interval)
+
+        if errors:
+            logger.error(f"{len(errors)} of {len(intervals)} queries failed: {', '.join(f'{s} - {e}' for s, e in errors)}")
+            exit(1)
+
+        failed = [response for response in responses if isinstance(response, requests.Response)]
+        if not failed:
+            return dict(enumerate(responses))
+
+        # The server may be configured with a lower limit than the default
+        if all(is_step_size_error(response) for response in failed) and max_points > 1:
+            max_points //= 2
+            logger.info(f"Exceeding query limits, retrying with {max_points} points per query")
+            continue
+
+        response = failed[0]
+        logger.error(f"Query failed: {response.status_code}, {response.text}")
         exit(1)
 
-    return response_dict
-
 def query_prometheus_CSV(
         prometheus: str,
         query: str,
         start: str,
         end: str,
-        step: str) -> pl.LazyFrame:
+        step: str,
+        workers: int = MAX_WORKERS) -> pl.LazyFrame:
 
-    response_dict = query_prometheus_split(prometheus, query, start, end, step)
+    response_dict = query_prometheus_split(prometheus, query, start, end, step, workers, raw=True)
 
     temp_dir = f"/tmp/{uuid.uuid4()}"
     try:
@@ -139,6 +224,7 @@ if __name__ == "__main__":
     parser.add_argument("end", help="End time")
     parser.add_argument("-o", "--output", help="Path to output file")
     parser.add_argument("-s", "--step", help="Step size", default="5s")
+    parser.add_argument("-w", "--workers", help="Number of concurrent queries", type=int, default=MAX_WORKERS)
     parser.add_argument("-c", "--csv", action="store_true" , help="Convert to CSV")
     parser.add_argument("-l", "--log", help="Loglevel", default="info")
     args = parser.parse_args()
@@ -152,13 +238,13 @@ if __name__ == "__main__":
     logging.basicConfig(level=numeric_level)
 
     if args.csv:
-        csv = query_prometheus_CSV(args.prometheus, prepare_query_string(args.query), args.start, args.end, args.step)
+        csv = query_prometheus_CSV(args.prometheus, prepare_query_string(args.query), args.start, args.end, args.step, args.workers)
         if args.output:
             csv.sink_csv(args.output)
         else:
             print(csv)
     else:
-        response = query_prometheus_split(args.prometheus, prepare_query_string(args.query), args.start, args.end, args.step)
+        response = query_prometheus_split(args.prometheus, prepare_query_string(args.query), args.start, args.end, args.step, args.workers)
         if args.output:
             with open(args.output, "w") as f:
                 json.dump(response, f)
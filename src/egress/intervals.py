@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+"""Persistent interval index over DSN contacts and SOMP2B passes.
+
+Intervals are kept sorted by start together with the running maximum of their
+ends. All intervals overlapping [a, b] lie between the first position whose
+running maximum end reaches a and the last position starting before b, both
+found by binary search. Overlap joins search the bounds for all intervals of
+one side at once.
+"""
+
+import argparse
+import logging
+import polars as pl
+from os import path, replace
+from querycache import to_timestamp
+
+logger = logging.getLogger(__name__)
+
+DATA_DIR = path.abspath(path.join(path.dirname(__file__),"../../data/"))
+INDEX_FILE = path.join(DATA_DIR, "intervals.parquet")
+PASSES_FILE = path.join(DATA_DIR, "somp2b_passes.parquet")
+CONTACTS = path.join(DATA_DIR, "contacts/plan/*.parquet")
+
+INDEX_SCHEMA = {
+    "start": pl.Int64,
+    "end": pl.Int64,
+    "kind": pl.String,
+    "dish_name": pl.String,
+    "target_name": pl.String,
+    "signal_direction": pl.String,
+    "signal_band": pl.String,
+    "origin": pl.String,
+    "rate": pl.Float64,
+}
+
+
+def contacts_to_intervals(contacts: pl.DataFrame) -> pl.DataFrame:
+    """Intervals of contacts as returned by contact.get_contacts"""
+    return contacts.select(
+        pl.col("start_time").dt.epoch("s").alias("start"),
+        pl.col("end_time").dt.epoch("s").alias("end"),
+        pl.lit("contact").alias("kind"),
+        "dish_name",
+        "target_name",
+        "signal_direction",
+        "signal_band",
+        pl.lit(None, pl.String).alias("origin"),
+        pl.col("mean_data_rate").alias("rate"),
+    ).cast(INDEX_SCHEMA)
+
+
+def passes_to_intervals(passes: pl.DataFrame) -> pl.DataFrame:
+    """Intervals of the SOMP2B passes written by somp2bToOM"""
+    return passes.select(
+        pl.col("start").dt.epoch("s"),
+        pl.col("end").dt.epoch("s"),
+        pl.lit("pass").alias("kind"),
+        *[pl.lit(None, pl.String).alias(c) for c in ("dish_name", "target_name", "signal_direction", "signal_band")],
+        pl.col("file").alias("origin"),
+        pl.lit(None, pl.Float64).alias("rate"),
+    ).cast(INDEX_SCHEMA)
+
+
+class IntervalIndex:
+    """Intervals sorted by start, augmented with the running maximum end"""
+
+    def __init__(self, df: pl.DataFrame | None = None):
+        if df is None:
+            df = pl.DataFrame(schema=INDEX_SCHEMA)
+        self.df = df.select(INDEX_SCHEMA.keys())\
+            .sort("start", "end")\
+            .with_columns(pl.col("end").cum_max().alias("max_end"))
+
+    @classmethod
+    def load(cls, index_file: str = INDEX_FILE) -> "IntervalIndex":
+        if not path.isfile(index_file):
+            return cls()
+        return cls(pl.read_parquet(index_file))
+
+    def save(self, index_file: str = INDEX_FILE):
+        # Keep the previous index intact if writing fails
+        self.df.write_parquet(index_file + ".tmp")
+        replace(index_file + ".tmp", index_file)
+
+    def add(self, intervals: pl.DataFrame) -> "IntervalIndex":
+        """Index with intervals added, intervals already indexed are not repeated"""
+        df = pl.concat([self.df.drop("max_end"), intervals.select(INDEX_SCHEMA.keys())])
+        return IntervalIndex(df.unique(keep="first", maintain_order=True))
+
+    def __len__(self) -> int:
+        return len(self.df)
+
+    def _bounds(self, starts: pl.Series, ends: pl.Series) -> tuple[pl.Series, pl.Series]:
+        """Slice of candidate rows [lower, upper) for every interval [start, end]"""
+        lower = self.df["max_end"].search_sorted(starts, side="left")
+        upper = self.df["start"].search_sorted(ends, side="right")
+        return lower, upper
+
+    def range(self, start: int, end: int, **filters: str) -> pl.DataFrame:
+        """Intervals overlapping [start, end]"""
+        lower, upper = self._bounds(pl.Series([start]), pl.Series([end]))
+        lower, upper = lower[0], upper[0]
+        df = self.df.slice(lower, max(upper - lower, 0)).filter(pl.col("end") >= start)
+        return self._filter(df, filters).drop("max_end")
+
+    def point(self, time: int, **filters: str) -> pl.DataFrame:
+        """Intervals containing time"""
+        return self.range(time, time, **filters)
+
+    def overlaps(self, other: pl.DataFrame, **filters: str) -> pl.DataFrame:
+        """Pairs of intervals in other and the index that overlap
+
+        Columns of the index rows are suffixed with _right.
+        """
+        lower, upper = self._bounds(other["start"], other["end"])
+        pairs = other.with_columns(
+            pl.int_ranges(lower, pl.max_horizontal(lower, upper)).alias("_row")
+        ).explode("_row").drop_nulls("_row")
+        matches = self.df.drop("max_end").with_row_index("_row")
+        return pairs\
+            .join(self._filter(matches, filters), on="_row", how="inner", suffix="_right")\
+            .filter(pl.col("end_right") >= pl.col("start"))\
+            .drop("_row")
+
+    @staticmethod
+    def _filter(df: pl.DataFrame, filters: dict[str, str]) -> pl.DataFrame:
+        for column, value in filters.items():
+            if value is not None:
+                df = df.filter(pl.col(column) == value)
+        return df
+
+
+def to_readable(df: pl.DataFrame) -> pl.DataFrame:
+    """Epoch columns as UTC datetimes"""
+    times = [c for c in df.columns if c.split("_")[0] in ("start", "end") and df.schema[c] == pl.Int64]
+    return df.with_columns(pl.from_epoch(c, time_unit="s").dt.replace_time_zone("UTC") for c in times)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Maintain and query the interval index over contacts and SOMP2B passes")
+    parser.add_argument("-i", "--index", help="Path to the index file", default=INDEX_FILE)
+    parser.add_argument("-l", "--log", help="Loglevel", default="info")
+    subparsers = parser.add_subparsers(help="Subcommand help", dest="subparser_name")
+
+    parser_contacts = subparsers.add_parser("add-contacts", help="Index contacts written by contact.py update")
+    parser_contacts.add_argument("input", help="Parquet file or glob of contacts", nargs="?", default=CONTACTS)
+
+    parser_passes = subparsers.add_parser("add-passes", help="Index SOMP2B passes written by somp2bToOM")
+    parser_passes.add_argument("input", help="Parquet file of passes", nargs="?", default=PASSES_FILE)
+
+    # Filters shared by all queries
+    parser_filter = argparse.ArgumentParser(add_help=False)
+    parser_filter.add_argument("-k", "--kind", help="Only intervals of this kind (contact, pass)")
+    parser_filter.add_argument("-t", "--target", help="Only intervals of this target name")
+    parser_filter.add_argument("-d", "--dish", help="Only intervals of this dish")
+
+    parser_point = subparsers.add_parser("point", help="Intervals containing a time", parents=[parser_filter])
+    parser_point.add_argument("time", help="Time in ISO 8601")
+
+    parser_range = subparsers.add_parser("range", help="Intervals overlapping a period", parents=[parser_filter])
+    parser_range.add_argument("start", help="Start time in ISO 8601")
+    parser_range.add_argument("end", help="End time in ISO 8601")
+
+    parser_overlaps = subparsers.add_parser("overlaps", help="Intervals of one kind overlapping those of another", parents=[parser_filter])
+    parser_overlaps.add_argument("left", help="Kind of the intervals to match, e.g. pass")
+    parser_overlaps.add_argument("right", help="Kind of the matched intervals, e.g. contact")
+    args = parser.parse_args()
+
+    if args.log:
+        numeric_level = getattr(logging, args.log.upper(), None)
+        if not isinstance(numeric_level, int):
+            raise ValueError('Invalid log level: %s' % args.log)
+    else:
+        numeric_level = logging.INFO
+    logging.basicConfig(level=numeric_level)
+
+    pl.Config.set_tbl_rows(-1)
+    pl.Config.set_tbl_cols(-1)
+    pl.Config.set_tbl_width_chars(200)
+
+    index = IntervalIndex.load(args.index)
+    match args.subparser_name:
+        case "add-contacts":
+            index = index.add(contacts_to_intervals(pl.read_parquet(args.input)))
+            index.save(args.index)
+            logger.info(f"Index holds {len(index)} intervals")
+        case "add-passes":
+            index = index.add(passes_to_intervals(pl.read_parquet(args.input)))
+            index.save(args.index)
+            logger.info(f"Index holds {len(index)} intervals")
+        case "point":
+            print(to_readable(index.point(int(to_timestamp(args.time)), kind=args.kind, target_name=args.target, dish_name=args.dish)))
+        case "range":
+            print(to_readable(index.range(int(to_timestamp(args.start)), int(to_timestamp(args.end)), kind=args.kind, target_name=args.target, dish_name=args.dish)))
+        case "overlaps":
+            left = index.df.filter(pl.col("kind") == args.left).drop("max_end")
+            right = index.range(-2**62, 2**62, kind=args.right, target_name=args.target, dish_name=args.dish)
+            print(to_readable(IntervalIndex(right).overlaps(left)))
+        case _:
+            logger.error("Specify a subcommand")
+            exit(1)
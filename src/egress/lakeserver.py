@@ -0,0 +1,593 @@
+#!/usr/bin/env python3
+"""Prometheus compatible HTTP API on top of the parquet lake written by parquetify.
+
+Supports /api/v1/query_range, /api/v1/query, /api/v1/series, /api/v1/labels and
+/api/v1/label/<name>/values for a subset of PromQL:
+
+    selector      metric{label="value", label=~"regex", label!="value", label!~"regex"}
+    range         rate(selector[5m]), <avg|min|max|sum|count|last>_over_time(selector[5m])
+    aggregation   <sum|avg|max|min|count> [by (label, ...)] (expression)
+
+Rollup series written by parquetify -r are available as <metric>:<tier>_<stat>,
+e.g. signal_data_rate_b_per_s:1h_max.
+"""
+
+import argparse
+import json
+import logging
+import re
+import threading
+import datetime as dt
+import polars as pl
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os import path
+from urllib.parse import urlparse, parse_qs
+
+logger = logging.getLogger(__name__)
+
+DATA_DIR = path.abspath(path.join(path.dirname(__file__),"../../data/"))
+LAKE_DIR = path.join(DATA_DIR, "exports/direct/")
+ROLLUP_DIR = path.join(DATA_DIR, "exports/rollup/")
+PORT = 9091
+
+# Same staleness as Prometheus for instant vector selectors
+LOOKBACK = 5*60
+# Points per series limit of Prometheus, kept so that clients split queries the same way
+MAX_POINTS = 11000
+CACHE_SIZE = 128
+
+DATA_SOURCE = "DSN Now"
+DISH_LABELS = ["station_name", "dish_name", "dish_activity"]
+TARGET_LABELS = DISH_LABELS + ["target_name", "target_id"]
+SIGNAL_LABELS = TARGET_LABELS + ["signal_direction", "signal_activity", "signal_type", "signal_band"]
+
+# Metric name: (parquet column or {label value: column}, extra label, series labels)
+METRICS = {
+    "dish_azimuth_angle_degrees": ("dish_azimuth_angle_degrees", None, DISH_LABELS),
+    "dish_elevation_angle_degrees": ("dish_elevation_angel_degrees", None, DISH_LABELS),
+    "dish_wind_speed_km_per_h": ("dish_wind_speed_km_per_h", None, DISH_LABELS),
+    "dish_mspa_bool": ("dish_mspa_bool", None, DISH_LABELS),
+    "dish_array_bool": ("dish_array_bool", None, DISH_LABELS),
+    "dish_ddor_bool": ("dish_ddor_bool", None, DISH_LABELS),
+    "target_round_trip_seconds": ("target_round_trip_seconds", None, TARGET_LABELS),
+    "target_range_km": ({"up": "target_upleg_range_km", "down": "target_downleg_range_km"}, "target_direction", TARGET_LABELS),
+    "signal_data_rate_b_per_s": ("signal_data_rate_b_per_s", None, SIGNAL_LABELS),
+    "signal_frequency_Hz": ("signal_frequency_Hz", None, SIGNAL_LABELS),
+    "signal_power_received_dBm": ("signal_power_received_dBm", None, SIGNAL_LABELS),
+    "signal_power_sent_kW": ("signal_power_sent_kW", None, SIGNAL_LABELS),
+}
+ROLLUP_PATTERN = re.compile(r"^(\w+):(\w+)_(min|max|mean|last|count)$")
+
+DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 60*60, "d": 24*60*60, "w": 7*24*60*60, "y": 365*24*60*60}
+
+
+class QueryError(Exception):
+    pass
+
+
+def parse_duration(string: str) -> int:
+    """Seconds of a Prometheus duration like 5m or 1h30m, or of a plain number"""
+    if not isinstance(string, str):
+        raise QueryError(f"Invalid duration: {string}")
+    try:
+        return int(float(string))
+    except (ValueError, OverflowError):
+        pass
+    parts = re.findall(r"(\d+)(ms|s|m|h|d|w|y)", string)
+    if not parts or "".join(n + u for n, u in parts) != string:
+        raise QueryError(f"Invalid duration: {string}")
+    return int(sum(int(n) * DURATION_UNITS[u] for n, u in parts))
+
+
+def parse_timestamp(string: str) -> int:
+    """Seconds since epoch of a RFC 3339 or unix timestamp, UTC unless the time zone is given"""
+    if not isinstance(string, str):
+        raise QueryError(f"Invalid timestamp: {string}")
+    try:
+        return int(float(string))
+    except (ValueError, OverflowError):
+        pass
+    try:
+        time = dt.datetime.fromisoformat(string.replace("Z", "+00:00"))
+    except ValueError:
+        raise QueryError(f"Invalid timestamp: {string}")
+    if time.tzinfo is None:
+        time = time.replace(tzinfo=dt.timezone.utc)
+    return int(time.timestamp())
+
+
+@dataclass
+class Matcher:
+    label: str
+    op: str
+    value: str
+
+    def expr(self, column: pl.Expr) -> pl.Expr:
+        match self.op:
+            case "=":
+                return column == self.value
+            case "!=":
+                return column != self.value
+            case "=~":
+                return column.str.contains(f"^(?:{self.value})$")
+            case "!~":
+                return column.str.contains(f"^(?:{self.value})$").not_()
+        raise QueryError(f"Unknown matcher {self.op}")
+
+    def matches(self, value: str) -> bool:
+        return pl.select(self.expr(pl.lit(value))).item()
+
+
+@dataclass
+class Selector:
+    name: str
+    matchers: list[Matcher] = field(default_factory=list)
+    range: int | None = None
+
+
+@dataclass
+class Function:
+    name: str
+    arg: Selector
+
+
+@dataclass
+class Aggregation:
+    op: str
+    by: list[str]
+    arg: object
+
+
+TOKEN_PATTERN = re.compile(r'\s*(?:(?P<string>"(?:[^"\\]|\\.)*")|(?P<op>=~|!~|!=|=)|(?P<punct>[{}()\[\],])|(?P<ident>[a-zA-Z_:][a-zA-Z0-9_:]*)|(?P<duration>\d+[a-z0-9]*))')
+AGGREGATIONS = {"sum", "avg", "max", "min", "count"}
+OVER_TIME = {"avg_over_time", "min_over_time", "max_over_time", "sum_over_time", "count_over_time", "last_over_time"}
+FUNCTIONS = OVER_TIME | {"rate"}
+
+
+def tokenize(query: str) -> list[tuple[str, str]]:
+    tokens = []
+    pos = 0
+    query = query.strip()
+    while pos < len(query):
+        match = TOKEN_PATTERN.match(query, pos)
+        if not match or match.end() == pos:
+            raise QueryError(f"Unexpected character at {pos}: {query[pos:]}")
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == "string":
+            value = json.loads(value)
+        tokens.append((kind, value))
+        pos = match.end()
+    return tokens
+
+
+class Parser:
+    """Recursive descent parser for the supported PromQL subset"""
+
+    def __init__(self, query: str):
+        self.tokens = tokenize(query)
+        self.pos = 0
+
+    def peek(self) -> tuple[str, str] | None:
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else None
+
+    def take(self, value: str | None = None, kind: str | None = None) -> str:
+        token = self.peek()
+        if token is None or (value is not None and token[1] != value) or (kind is not None and token[0] != kind):
+            raise QueryError(f"Expected {value or kind}, got {token[1] if token else 'end of query'}")
+        self.pos += 1
+        return token[1]
+
+    def parse(self):
+        expr = self.expression()
+        if self.peek() is not None:
+            raise QueryError(f"Unexpected {self.peek()[1]}")
+        return expr
+
+    def expression(self):
+        token = self.peek()
+        if token is None:
+            raise QueryError("Empty query")
+        if token[0] == "ident" and token[1] in AGGREGATIONS:
+            return self.aggregation()
+        if token[0] == "ident" and token[1] in FUNCTIONS:
+            name = self.take()
+            self.take("(")
+            arg = self.selector()
+            self.take(")")
+            if arg.range is None:
+                raise QueryError(f"{name} expects a range vector")
+            return Function(name, arg)
+        return self.selector()
+
+    def labels(self) -> list[str]:
+        self.take("(")
+        labels = []
+        while self.peek() and self.peek()[1] != ")":
+            labels.append(self.take(kind="ident"))
+            if self.peek() and self.peek()[1] == ",":
+                self.take(",")
+        self.take(")")
+        return labels
+
+    def aggregation(self) -> Aggregation:
+        op = self.take()
+        by = []
+        if self.peek() and self.peek()[1] == "by":
+            self.take("by")
+            by = self.labels()
+        self.take("(")
+        arg = self.expression()
+        self.take(")")
+        if self.peek() and self.peek()[1] == "by":
+            self.take("by")
+            by = self.labels()
+        return Aggregation(op, by, arg)
+
+    def selector(self) -> Selector:
+        name = ""
+        if self.peek() and self.peek()[0] == "ident":
+            name = self.take()
+        matchers = []
+        if self.peek() and self.peek()[1] == "{":
+            self.take("{")
+            while self.peek() and self.peek()[1] != "}":
+                label = self.take(kind="ident")
+                op = self.take(kind="op")
+                value = self.take(kind="string")
+                if label == "__name__":
+                    if op != "=":
+                        raise QueryError("Only __name__= is supported")
+                    name = value
+                else:
+                    matchers.append(Matcher(label, op, value))
+                if self.peek() and self.peek()[1] == ",":
+                    self.take(",")
+            self.take("}")
+        if not name:
+            raise QueryError("Selectors require a metric name")
+        selector = Selector(name, matchers)
+        if self.peek() and self.peek()[1] == "[":
+            self.take("[")
+            selector.range = parse_duration(self.take(kind="duration"))
+            self.take("]")
+        return selector
+
+
+def format_values(values: pl.Expr) -> pl.Expr:
+    """Render floats the way Prometheus does, e.g. 160000 instead of 160000.0"""
+    return pl.when(values.is_nan()).then(pl.lit("NaN"))\
+        .when(values == float("inf")).then(pl.lit("+Inf"))\
+        .when(values == float("-inf")).then(pl.lit("-Inf"))\
+        .otherwise(values.cast(pl.String).str.replace(r"\.0$", ""))
+
+
+class Lake:
+    """Evaluates queries directly on the parquet datasets using lazy scans"""
+
+    def __init__(self, lake_dir: str = LAKE_DIR, rollup_dir: str | None = ROLLUP_DIR, cache_size: int = CACHE_SIZE):
+        self.lake_dir = lake_dir
+        self.rollup_dir = rollup_dir
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def scan(self, tier: str | None = None) -> pl.LazyFrame:
+        if tier is None:
+            return pl.scan_parquet(path.join(self.lake_dir, "*.parquet"))
+        if self.rollup_dir is None:
+            raise QueryError("No rollup directory configured")
+        return pl.scan_parquet(path.join(self.rollup_dir, tier, "*.parquet"))
+
+    def metric_names(self) -> list[str]:
+        return sorted(METRICS)
+
+    def select(self, selector: Selector, start: int, end: int) -> tuple[pl.LazyFrame, list[str]]:
+        """Samples matching selector as (labels..., timestamp, value) and the label names"""
+        name = selector.name
+        tier = None
+        stat = None
+        rollup = ROLLUP_PATTERN.match(name)
+        if rollup:
+            name, tier, stat = rollup.groups()
+        if name not in METRICS:
+            raise QueryError(f"Unknown metric {selector.name}")
+        columns, extra_label, labels = METRICS[name]
+        if not isinstance(columns, dict):
+            columns = {None: columns}
+        if stat:
+            columns = {k: f"{v}_{stat}" for k, v in columns.items()}
+        all_labels = labels + ([extra_label] if extra_label else [])
+
+        # Constant labels and label values are resolved before touching any data
+        filters = [pl.col("timestamp").is_between(start, end)]
+        for matcher in selector.matchers:
+            if matcher.label == "data_source":
+                if not matcher.matches(DATA_SOURCE):
+                    return pl.LazyFrame(schema={**{l: pl.String for l in all_labels}, "timestamp": pl.Int64, "value": pl.Float64}), all_labels
+            elif matcher.label == extra_label:
+                columns = {k: v for k, v in columns.items() if matcher.matches(k)}
+            elif matcher.label in labels:
+                filters.append(matcher.expr(pl.col(matcher.label).cast(pl.String).fill_null("")))
+            elif not matcher.matches(""):
+                return pl.LazyFrame(schema={**{l: pl.String for l in all_labels}, "timestamp": pl.Int64, "value": pl.Float64}), all_labels
+
+        # Filters and column selection are pushed down into the parquet scan
+        scan = self.scan(tier)
+        if tier is not None:
+            missing = set(columns.values()) - set(scan.collect_schema().names())
+            if missing:
+                raise QueryError(f"No {tier} rollup of {name} in {self.rollup_dir}, rerun parquetify with --rollups")
+        scan = scan.filter(pl.all_horizontal(filters))
+        parts = []
+        for label_value, column in columns.items():
+            part = scan.select(
+                *[pl.col(l).cast(pl.String).fill_null("") for l in labels],
+                pl.col("timestamp"),
+                pl.col(column).cast(pl.Float64).alias("value"),
+            )
+            if extra_label:
+                part = part.with_columns(pl.lit(label_value).alias(extra_label))
+            parts.append(part)
+        if not parts:
+            return pl.LazyFrame(schema={**{l: pl.String for l in all_labels}, "timestamp": pl.Int64, "value": pl.Float64}), all_labels
+
+        # Dish and target values are repeated for every signal of a snapshot
+        df = pl.concat(parts, how="diagonal")\
+            .filter(pl.col("value").is_not_null())\
+            .unique(subset=all_labels + ["timestamp"], keep="first")
+        return df, all_labels
+
+    def instant(self, df: pl.LazyFrame, labels: list[str], start: int, end: int, step: int) -> pl.LazyFrame:
+        """Latest sample within LOOKBACK for every step"""
+        steps = pl.LazyFrame({"timestamp": pl.int_range(start, end + 1, step, eager=True)})
+        series = df.select(labels).unique().with_row_index("series_id")
+        samples = df.join(series, on=labels).select("series_id", "timestamp", "value").sort("timestamp")
+        grid = series.select("series_id").join(steps, how="cross").sort("timestamp")
+        return grid.join_asof(
+            samples.with_columns(pl.col("timestamp").alias("sample_time")),
+            on="timestamp",
+            by="series_id",
+            strategy="backward",
+            tolerance=LOOKBACK,
+            check_sortedness=False,
+        ).filter(pl.col("sample_time").is_not_null())\
+         .join(series, on="series_id")\
+         .select(*labels, "timestamp", "value")
+
+    def range_function(self, function: str, df: pl.LazyFrame, labels: list[str], window: int, start: int, end: int, step: int) -> pl.LazyFrame:
+        """Evaluate function over the samples in (t - window, t] for every step t"""
+        match function:
+            case "rate":
+                # Counter resets restart the increase at the new value
+                diff = pl.col("value").diff()
+                agg = pl.when(diff < 0).then(pl.col("value")).otherwise(diff).sum() / window
+            case "avg_over_time":
+                agg = pl.col("value").mean()
+            case "min_over_time":
+                agg = pl.col("value").min()
+            case "max_over_time":
+                agg = pl.col("value").max()
+            case "sum_over_time":
+                agg = pl.col("value").sum()
+            case "count_over_time":
+                agg = pl.col("value").count().cast(pl.Float64)
+            case "last_over_time":
+                agg = pl.col("value").last()
+            case _:
+                raise QueryError(f"Unsupported function {function}")
+
+        series = df.select(labels).unique().with_row_index("series_id")
+        # Windows end on the steps, right edge = start + n * step. Polars starts
+        # the first window at the first sample, shift it back by more than a window.
+        offset = (start - window) % step - (-(-window // step) + 1) * step
+        result = df.join(series, on=labels)\
+            .select("series_id", "timestamp", "value")\
+            .sort("series_id", "timestamp")\
+            .group_by_dynamic(
+                "timestamp",
+                every=f"{step}i",
+                period=f"{window}i",
+                offset=f"{offset}i",
+                closed="right",
+                label="right",
+                group_by="series_id",
+                start_by="window",
+            ).agg(agg.alias("value"), pl.len().alias("samples"))
+        if function == "rate":
+            result = result.filter(pl.col("samples") > 1)
+        return result\
+            .filter(pl.col("timestamp").is_between(start, end))\
+            .join(series, on="series_id")\
+            .select(*labels, "timestamp", "value")
+
+    def evaluate(self, expr, start: int, end: int, step: int) -> tuple[pl.LazyFrame, list[str], str | None]:
+        """Returns the result frame, its label names and the metric name to report"""
+        if isinstance(expr, Selector):
+            if expr.range is not None:
+                raise QueryError("Range vectors can only be used in functions")
+            df, labels = self.select(expr, start - LOOKBACK, end)
+            return self.instant(df, labels, start, end, step), labels, expr.name
+        if isinstance(expr, Function):
+            df, labels = self.select(expr.arg, start - expr.arg.range, end)
+            return self.range_function(expr.name, df, labels, expr.arg.range, start, end, step), labels, None
+        if isinstance(expr, Aggregation):
+            df, labels, _ = self.evaluate(expr.arg, start, end, step)
+            by = [l for l in expr.by if l in labels]
+            value = pl.col("value")
+            agg = {
+                "sum": value.sum(),
+                "avg": value.mean(),
+                "max": value.max(),
+                "min": value.min(),
+                "count": value.count().cast(pl.Float64),
+            }[expr.op]
+            return df.group_by(*by, "timestamp").agg(agg.alias("value")), by, None
+        raise QueryError("Unsupported expression")
+
+    def query_range(self, query: str, start: int, end: int, step: int) -> dict:
+        if step <= 0:
+            raise QueryError("Step must be positive")
+        if end < start:
+            raise QueryError("End must not be before start")
+        if (end - start) // step + 1 > MAX_POINTS:
+            raise QueryError(f"exceeded maximum resolution of {MAX_POINTS} points per timeseries. Try decreasing the query resolution (?step=XX)")
+        key = (query, start, end, step)
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return self._cache[key]
+            self.misses += 1
+
+        df, labels, name = self.evaluate(Parser(query).parse(), start, end, step)
+        result = self.to_matrix(df.collect(), labels, name)
+
+        with self._lock:
+            self._cache[key] = result
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        logger.debug(f"Cache hits: {self.hits}, misses: {self.misses}")
+        return result
+
+    def to_matrix(self, df: pl.DataFrame, labels: list[str], name: str | None) -> dict:
+        grouped = df.sort("timestamp")\
+            .with_columns(format_values(pl.col("value")).alias("value"))\
+            .group_by(labels or pl.lit(0).alias("_"), maintain_order=True)\
+            .agg("timestamp", "value")
+        result = []
+        for row in grouped.iter_rows(named=True):
+            metric = {"__name__": name} if name else {}
+            if name:
+                metric["data_source"] = DATA_SOURCE
+            metric.update({l: row[l] for l in labels if row[l]})
+            result.append({"metric": metric, "values": [[t, v] for t, v in zip(row["timestamp"], row["value"])]})
+        return {"resultType": "matrix", "result": result}
+
+    def series(self, selectors: list[str], start: int, end: int) -> list[dict]:
+        result = []
+        for query in selectors:
+            selector = Parser(query).parse()
+            if not isinstance(selector, Selector):
+                raise QueryError("match[] expects a series selector")
+            df, labels = self.select(selector, start, end)
+            for row in df.select(labels).unique().collect().iter_rows(named=True):
+                metric = {"__name__": selector.name, "data_source": DATA_SOURCE}
+                metric.update({l: v for l, v in row.items() if v})
+                result.append(metric)
+        return result
+
+    def label_values(self, label: str) -> list[str]:
+        if label == "__name__":
+            return self.metric_names()
+        if label == "data_source":
+            return [DATA_SOURCE]
+        if label == "target_direction":
+            return ["down", "up"]
+        if label not in SIGNAL_LABELS:
+            return []
+        return self.scan().select(pl.col(label).cast(pl.String).drop_nulls().unique().sort()).collect().to_series().to_list()
+
+
+class Handler(BaseHTTPRequestHandler):
+    lake: Lake
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def reply(self, code: int, body: dict):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def params(self) -> dict[str, list[str]]:
+        params = parse_qs(urlparse(self.path).query)
+        if self.command == "POST":
+            length = int(self.headers.get("Content-Length", 0))
+            params.update(parse_qs(self.rfile.read(length).decode()))
+        return params
+
+    def handle_api(self):
+        route = urlparse(self.path).path
+        params = self.params()
+        get = lambda key, default=None: params.get(key, [default])[0]
+
+        def require(key: str) -> str:
+            value = get(key)
+            if not value:
+                raise QueryError(f'invalid parameter "{key}": missing')
+            return value
+
+        try:
+            match route:
+                case "/api/v1/query_range":
+                    data = self.lake.query_range(
+                        require("query"),
+                        parse_timestamp(require("start")),
+                        parse_timestamp(require("end")),
+                        parse_duration(require("step")))
+                case "/api/v1/query":
+                    time = parse_timestamp(get("time")) if get("time") else int(dt.datetime.now().timestamp())
+                    matrix = self.lake.query_range(require("query"), time, time, 1)
+                    data = {
+                        "resultType": "vector",
+                        "result": [{"metric": s["metric"], "value": s["values"][-1]} for s in matrix["result"]]
+                    }
+                case "/api/v1/series":
+                    data = self.lake.series(params.get("match[]", []), parse_timestamp(get("start", "0")), parse_timestamp(get("end", str(2**40))))
+                case "/api/v1/labels":
+                    data = sorted(set(SIGNAL_LABELS) | {"__name__", "data_source", "target_direction"})
+                case "/api/v1/status/buildinfo":
+                    data = {"version": "2.0.0", "application": "dsn-analysis lake"}
+                case _ if route.startswith("/api/v1/label/") and route.endswith("/values"):
+                    data = self.lake.label_values(route.split("/")[4])
+                case _:
+                    self.reply(404, {"status": "error", "errorType": "not_found", "error": f"Unknown endpoint {route}"})
+                    return
+        except QueryError as e:
+            self.reply(400, {"status": "error", "errorType": "bad_data", "error": str(e)})
+            return
+        except Exception as e:
+            logger.error(f"Failed to answer {self.path}", exc_info=True)
+            self.reply(500, {"status": "error", "errorType": "internal", "error": str(e)})
+            return
+        self.reply(200, {"status": "success", "data": data})
+
+    def do_GET(self):
+        self.handle_api()
+
+    def do_POST(self):
+        self.handle_api()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve the Prometheus query API from the parquet lake")
+    parser.add_argument("--lake", help="Directory containing parquetify output", default=LAKE_DIR)
+    parser.add_argument("--rollups", help="Directory containing parquetify rollups", default=ROLLUP_DIR)
+    parser.add_argument("-p", "--port", help="Port to listen on", type=int, default=PORT)
+    parser.add_argument("--cache", help="Number of cached query results", type=int, default=CACHE_SIZE)
+    parser.add_argument("-l", "--log", help="Loglevel", default="info")
+    args = parser.parse_args()
+
+    if args.log:
+        numeric_level = getattr(logging, args.log.upper(), None)
+        if not isinstance(numeric_level, int):
+            raise ValueError('Invalid log level: %s' % args.log)
+    else:
+        numeric_level = logging.INFO
+    logging.basicConfig(level=numeric_level)
+
+    Handler.lake = Lake(args.lake, args.rollups, args.cache)
+    server = ThreadingHTTPServer(("", args.port), Handler)
+    logger.info(f"Serving {args.lake} on port {args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.shutdown()
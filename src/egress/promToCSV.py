@@ -1,32 +1,63 @@
 #!/usr/bin/env python3
 
+import io
+import json
 import logging
 import polars as pl
-from collections import defaultdict
 
 logger = logging.getLogger(__name__)
 
-def matrixToCSV(matrix: dict) -> pl.LazyFrame:
-    if matrix["resultType"] != "matrix":
-        logger.error("Result is not a matrix")
-        exit(1)
-
-    result = pl.LazyFrame({})
-    for metric in matrix["result"]:
-        metric_name = metric["metric"]["__name__"]
-        labels = [(k,v) for k, v in metric["metric"].items() if k != "__name__"]
+def read_matrix(content: bytes) -> tuple[str, pl.DataFrame]:
+    """Result type and series of a query_range response body, parsed by polars"""
+    response = pl.read_json(io.BytesIO(content))
+    data = response.select(pl.col("data").struct.field("resultType", "result"))
+    return data["resultType"].item(), data.select(pl.col("result").explode()).drop_nulls()
 
-        metric_as_table = defaultdict(list)
-        for vals in metric["values"]:
-            metric_as_table["Time"].append(int(vals[0]))
-            metric_as_table[metric_name].append(float(vals[1]))
 
-        new_table_size = len(metric_as_table["Time"])
-        for label in labels:
-            metric_as_table[label[0]].extend([label[1]]*new_table_size)
+def matrixToCSV(matrix: dict | bytes) -> pl.LazyFrame:
+    """Table of all samples in a matrix, one column per metric name and label
 
-        df = pl.LazyFrame(metric_as_table)
+    The matrix is either the data of a query_range response or the raw response
+    body. Labels are kept once per series as categoricals and joined to the
+    samples by series index, values are cast in bulk.
+    """
+    if isinstance(matrix, dict):
+        content = json.dumps({"data": matrix}).encode()
+    else:
+        content = matrix
+    result_type, result = read_matrix(content)
 
-        result = pl.concat([result, df], how="diagonal_relaxed")
+    if result_type != "matrix":
+        logger.error("Result is not a matrix")
+        exit(1)
 
-    return result
+    if result.is_empty() or result.schema["result"] == pl.Null:
+        return pl.LazyFrame({})
+
+    result = result.unnest("result").with_row_index("series")
+    label_names = [f.name for f in result.schema["metric"].fields]
+
+    series = result\
+        .select("series", pl.col("metric").struct.unnest())\
+        .with_columns(pl.exclude("series").cast(pl.Categorical))
+    samples = result.lazy()\
+        .select("series", "values")\
+        .explode("values")\
+        .drop_nulls("values")\
+        .select(
+            "series",
+            pl.col("values").list.get(0).cast(pl.Float64).cast(pl.Int64).alias("Time"),
+            pl.col("values").list.get(1).cast(pl.Float64).alias("value"),
+        )
+
+    # One value column per metric name, aggregations drop the name
+    if "__name__" in label_names:
+        names = series["__name__"].drop_nulls().unique(maintain_order=True).cast(pl.String).to_list()
+        values = [pl.when(pl.col("__name__") == name).then(pl.col("value")).alias(name) for name in names]
+    else:
+        values = [pl.col("value")]
+    labels = [label for label in label_names if label != "__name__"]
+
+    return samples\
+        .join(series.lazy(), on="series", how="left")\
+        .select([pl.col("Time")] + values + [pl.col(label) for label in labels])
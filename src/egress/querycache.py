@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+"""Persistent cache for Prometheus range query results.
+
+Results are stored per normalized query, Prometheus URL and step as parquet
+files covering one bucket of about a day each. Buckets are aligned to the
+epoch and the step, so overlapping requests share them and only buckets
+missing from the cache are fetched. Buckets that may still receive samples
+are fetched on every request and never stored.
+"""
+
+import argparse
+import datetime as dt
+import hashlib
+import json
+import logging
+import re
+import threading
+import time
+import polars as pl
+from os import path, listdir, makedirs, remove, replace, stat, utime, walk
+from shutil import rmtree
+from extract import query_prometheus_split, parse_step, to_timestamp, MAX_WORKERS
+from promToCSV import matrixToCSV
+
+logger = logging.getLogger(__name__)
+
+DATA_DIR = path.abspath(path.join(path.dirname(__file__),"../../data/"))
+CACHE_DIR = path.join(DATA_DIR, "cache/prometheus/")
+META_FILE = "meta.json"
+STATS_FILE = "stats.json"
+
+BUCKET_SECONDS = 24*60*60
+MAX_SIZE = 2*1024**3
+# Buckets ending less than this many seconds ago may still change
+FRESHNESS = 10*60
+
+QUOTED = r'"(?:[^"\\]|\\.)*"'
+
+
+def normalize_query(query: str) -> str:
+    """Query without insignificant whitespace and with sorted label matchers"""
+    query = "".join(
+        token for token in re.findall(rf'{QUOTED}|\s+|[^"\s]+', query) if not token.isspace()
+    )
+
+    def sort_matchers(match: re.Match) -> str:
+        matchers = re.findall(rf'(?:{QUOTED}|[^,"])+', match.group(1))
+        return "{" + ",".join(sorted(matchers)) + "}"
+
+    return re.sub(r"\{([^{}]*)\}", sort_matchers, query)
+
+
+def to_iso(timestamp: float) -> str:
+    return dt.datetime.fromtimestamp(timestamp, dt.timezone.utc).isoformat()
+
+
+class QueryCache:
+    """Range query results cached in time buckets below cache_dir"""
+
+    def __init__(self, prometheus: str, cache_dir: str = CACHE_DIR, max_size: int = MAX_SIZE,
+                 workers: int = MAX_WORKERS):
+        self.prometheus = prometheus
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.workers = workers
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        makedirs(cache_dir, exist_ok=True)
+
+    def key(self, query: str, step: float) -> str:
+        ident = f"{self.prometheus}\n{normalize_query(query)}\n{step:g}"
+        return hashlib.sha256(ident.encode()).hexdigest()[:16]
+
+    def bucket_width(self, step: float) -> int:
+        """Bucket width as multiple of step closest to BUCKET_SECONDS"""
+        return int(step * max(1, round(BUCKET_SECONDS / step)))
+
+    def query(self, query: str, start: str, end: str, step: str) -> pl.LazyFrame:
+        """Like query_prometheus_CSV, with samples on the epoch aligned step grid"""
+        step_seconds = parse_step(step)
+        width = self.bucket_width(step_seconds)
+        if width % step_seconds:
+            raise ValueError(f"Step {step} does not divide into whole second buckets")
+        start_ts = to_timestamp(start)
+        end_ts = to_timestamp(end)
+
+        key_dir = path.join(self.cache_dir, self.key(query, step_seconds))
+        makedirs(key_dir, exist_ok=True)
+        meta_path = path.join(key_dir, META_FILE)
+        if not path.isfile(meta_path):
+            with open(meta_path, "w") as f:
+                json.dump({"prometheus": self.prometheus, "query": normalize_query(query), "step": step_seconds}, f)
+
+        buckets = range(int(start_ts // width * width), int(end_ts) + 1, width)
+        stable_before = time.time() - FRESHNESS
+
+        frames = []
+        missing = []
+        hit_files = set()
+        for bucket in buckets:
+            cached = self._cached_file(key_dir, bucket)
+            if cached is None:
+                missing.append(bucket)
+                continue
+            utime(cached)
+            hit_files.add(cached)
+            if cached.endswith(".parquet"):
+                frames.append(pl.scan_parquet(cached))
+
+        hits = len(buckets) - len(missing)
+        with self._lock:
+            self.hits += hits
+            self.misses += len(missing)
+        logger.info(f"Cache hit for {hits} of {len(buckets)} buckets of {query}")
+
+        for range_start, range_end in self._contiguous(missing, width):
+            df = self._fetch(query, range_start, range_end - step_seconds, step)
+            stable = [b for b in range(range_start, range_end, width) if b + width <= stable_before]
+            self._store(key_dir, df, stable, width)
+            frames.append(df.lazy())
+
+        self._update_stats(hits, len(missing))
+        if missing:
+            # The returned frame still scans the hit buckets
+            self.evict(keep=hit_files)
+
+        if not frames:
+            return pl.LazyFrame({})
+        return pl.concat(frames, how="diagonal_relaxed")\
+            .filter(pl.col("Time").is_between(start_ts, end_ts))\
+            .sort("Time")
+
+    def _cached_file(self, key_dir: str, bucket: int) -> str | None:
+        for suffix in (".parquet", ".empty"):
+            file_path = path.join(key_dir, f"{bucket}{suffix}")
+            if path.isfile(file_path):
+                return file_path
+        return None
+
+    @staticmethod
+    def _contiguous(buckets: list[int], width: int) -> list[tuple[int, int]]:
+        """Merge consecutive buckets into [start, end) ranges"""
+        ranges = []
+        for bucket in buckets:
+            if ranges and ranges[-1][1] == bucket:
+                ranges[-1][1] = bucket + width
+            else:
+                ranges.append([bucket, bucket + width])
+        return [(s, e) for s, e in ranges]
+
+    def _fetch(self, query: str, start: float, end: float, step: str) -> pl.DataFrame:
+        logger.debug(f"Fetching {query} between {to_iso(start)} and {to_iso(end)}")
+        responses = query_prometheus_split(self.prometheus, query, to_iso(start), to_iso(end), step, self.workers, raw=True)
+        frames = [matrixToCSV(content) for content in responses.values()]
+        if not frames:
+            return pl.DataFrame()
+        return pl.concat(frames, how="diagonal_relaxed").collect()
+
+    def _store(self, key_dir: str, df: pl.DataFrame, buckets: list[int], width: int):
+        if not buckets:
+            return
+        if df.is_empty():
+            parts = {}
+        else:
+            parts = {
+                bucket: part
+                for (bucket,), part in df.with_columns((pl.col("Time") // width * width).alias("bucket"))
+                                         .partition_by("bucket", as_dict=True, include_key=False).items()
+            }
+        for bucket in buckets:
+            part = parts.get(bucket)
+            # Only complete files get their final name, any existing one is a cache hit
+            if part is None:
+                file_path = path.join(key_dir, f"{bucket}.empty")
+                open(file_path + ".tmp", "w").close()
+            else:
+                file_path = path.join(key_dir, f"{bucket}.parquet")
+                part.write_parquet(file_path + ".tmp")
+            replace(file_path + ".tmp", file_path)
+
+    def _update_stats(self, hits: int, misses: int):
+        stats_path = path.join(self.cache_dir, STATS_FILE)
+        with self._lock:
+            stats = read_stats(self.cache_dir)
+            stats["hits"] += hits
+            stats["misses"] += misses
+            with open(stats_path, "w") as f:
+                json.dump(stats, f)
+
+    def evict(self, keep: set[str] = set()) -> int:
+        """Remove least recently used buckets, except those in keep, until the cache fits max_size"""
+        files = []
+        for root, _, names in walk(self.cache_dir):
+            for name in names:
+                if name.endswith((".parquet", ".empty")):
+                    file_path = path.join(root, name)
+                    file_stat = stat(file_path)
+                    files.append((file_stat.st_mtime, file_stat.st_size, file_path))
+
+        size = sum(f[1] for f in files)
+        evicted = 0
+        for _, file_size, file_path in sorted(files):
+            if size <= self.max_size:
+                break
+            if file_path in keep:
+                continue
+            remove(file_path)
+            size -= file_size
+            evicted += 1
+        if evicted:
+            logger.info(f"Evicted {evicted} cached buckets")
+        return evicted
+
+    def invalidate(self, query: str | None = None, step: str | None = None) -> int:
+        """Drop cached results of query, of all steps unless step is given, or everything"""
+        removed = 0
+        for key in listdir(self.cache_dir):
+            key_dir = path.join(self.cache_dir, key)
+            if not path.isdir(key_dir):
+                continue
+            if query is not None:
+                try:
+                    with open(path.join(key_dir, META_FILE)) as f:
+                        meta = json.load(f)
+                except (OSError, ValueError):
+                    continue
+                if meta["prometheus"] != self.prometheus or meta["query"] != normalize_query(query):
+                    continue
+                if step is not None and meta["step"] != parse_step(step):
+                    continue
+            rmtree(key_dir)
+            removed += 1
+        return removed
+
+
+def read_stats(cache_dir: str = CACHE_DIR) -> dict:
+    try:
+        with open(path.join(cache_dir, STATS_FILE)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {"hits": 0, "misses": 0}
+
+
+def cache_size(cache_dir: str = CACHE_DIR) -> int:
+    return sum(
+        stat(path.join(root, name)).st_size
+        for root, _, names in walk(cache_dir)
+        for name in names
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect and maintain the Prometheus query cache")
+    parser.add_argument("-u", "--url", help="URL of the Prometheus instance", default="http://localhost:9090")
+    parser.add_argument("-d", "--dir", help="Cache directory", default=CACHE_DIR)
+    parser.add_argument("-l", "--log", help="Loglevel", default="info")
+    subparsers = parser.add_subparsers(help="Subcommand help", dest="subparser_name")
+
+    subparsers.add_parser("stats", help="Show size and hit rate of the cache")
+
+    parser_clear = subparsers.add_parser("clear", help="Invalidate cached results")
+    parser_clear.add_argument("query", help="Only results of this query", nargs="?")
+    parser_clear.add_argument("-s", "--step", help="Only results of this step size")
+
+    parser_evict = subparsers.add_parser("evict", help="Shrink the cache to the given size")
+    parser_evict.add_argument("size", help="Maximum size in MiB", type=int)
+    args = parser.parse_args()
+
+    if args.log:
+        numeric_level = getattr(logging, args.log.upper(), None)
+        if not isinstance(numeric_level, int):
+            raise ValueError('Invalid log level: %s' % args.log)
+    else:
+        numeric_level = logging.INFO
+    logging.basicConfig(level=numeric_level)
+
+    match args.subparser_name:
+        case "stats":
+            stats = read_stats(args.dir)
+            total = stats["hits"] + stats["misses"]
+            print(f"size_bytes: {cache_size(args.dir)}")
+            print(f"hits: {stats['hits']}")
+            print(f"misses: {stats['misses']}")
+            print(f"hit_ratio: {stats['hits'] / total if total else 0.0}")
+        case "clear":
+            cache = QueryCache(args.url, args.dir)
+            logger.info(f"Removed {cache.invalidate(args.query, args.step)} cached queries")
+        case "evict":
+            QueryCache(args.url, args.dir, max_size=args.size*1024**2).evict()
+        case _:
+            logger.error("Specify a subcommand")
+            exit(1)
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+"""Coverage index of the SPK kernels in data/kernels.
+
+The time windows every SPK file covers per NAIF ID are read once with spkcov
+and cached in the kernel directory, keyed by the SHA-256 hash of the kernel.
+Files are only hashed again if their size or modification time changed.
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import numpy as np
+import spiceypy as spice
+from spiceypy.utils.exceptions import SpiceyError
+from os import path, listdir, replace
+
+logger = logging.getLogger(__name__)
+
+DATA_DIR = path.abspath(path.join(path.dirname(__file__),"../../../data/"))
+KERNEL_DIR = path.join(DATA_DIR,"kernels/")
+CACHE_FILE = ".coverage.json"
+
+# Capacity of the SPICE cells receiving IDs and coverage windows of one file
+MAX_OBJECTS = 10000
+MAX_WINDOWS = 200000
+
+
+def file_hash(file_path: str) -> str:
+    sha = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        while chunk := f.read(1 << 20):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def spk_coverage(file_path: str) -> dict[int, list[tuple[float, float]]]:
+    """ET windows covered by file per NAIF ID, empty for files other than SPK"""
+    try:
+        if spice.getfat(file_path) != ("DAF", "SPK"):
+            return {}
+    except SpiceyError:
+        return {}
+    ids = spice.spkobj(file_path, spice.cell_int(MAX_OBJECTS))
+    coverage = {}
+    for naif_id in ids:
+        cover = spice.spkcov(file_path, int(naif_id), spice.cell_double(2 * MAX_WINDOWS))
+        coverage[int(naif_id)] = [spice.wnfetd(cover, i) for i in range(spice.wncard(cover))]
+    return coverage
+
+
+def merge(windows: list[tuple[float, float]]) -> np.ndarray:
+    """Union of windows as sorted, disjoint intervals of shape (n, 2)"""
+    if not windows:
+        return np.empty((0, 2))
+    windows = np.array(sorted(windows), dtype=np.float64)
+    merged = [windows[0]]
+    for start, end in windows[1:]:
+        if start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append(np.array([start, end]))
+    return np.array(merged)
+
+
+def load_coverage(kernel_dir: str = KERNEL_DIR) -> dict[int, np.ndarray]:
+    """Merged coverage windows of all SPK files in kernel_dir per NAIF ID"""
+    cache_path = path.join(kernel_dir, CACHE_FILE)
+    try:
+        with open(cache_path) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = {"files": {}, "coverage": {}}
+
+    files = {}
+    coverage = {}
+    for name in sorted(listdir(kernel_dir)):
+        file_path = path.join(kernel_dir, name)
+        if name == CACHE_FILE or not path.isfile(file_path):
+            continue
+        stat = (path.getsize(file_path), path.getmtime(file_path))
+        known = cache["files"].get(name)
+        digest = known["hash"] if known and (known["size"], known["mtime"]) == stat else file_hash(file_path)
+        if digest not in cache["coverage"]:
+            logger.info(f"Reading coverage of {name}")
+            cache["coverage"][digest] = {str(k): v for k, v in spk_coverage(file_path).items()}
+        files[name] = {"size": stat[0], "mtime": stat[1], "hash": digest}
+        coverage[digest] = cache["coverage"][digest]
+
+    if files != cache["files"] or coverage.keys() != cache["coverage"].keys():
+        with open(cache_path + ".tmp", "w") as f:
+            json.dump({"files": files, "coverage": coverage}, f)
+        replace(cache_path + ".tmp", cache_path)
+
+    windows: dict[int, list] = {}
+    for file_coverage in coverage.values():
+        for naif_id, file_windows in file_coverage.items():
+            windows.setdefault(int(naif_id), []).extend(tuple(w) for w in file_windows)
+    return {naif_id: merge(w) for naif_id, w in windows.items()}
+
+
+def kernel_digests(kernel_dir: str = KERNEL_DIR) -> dict[str, str]:
+    """SHA-256 hashes of the kernels in kernel_dir by file name, updated like the coverage"""
+    load_coverage(kernel_dir)
+    with open(path.join(kernel_dir, CACHE_FILE)) as f:
+        return {name: file["hash"] for name, file in json.load(f)["files"].items()}
+
+
+def covered(windows: np.ndarray, ets: np.ndarray) -> np.ndarray:
+    """Mask of the ets within windows"""
+    if not len(windows):
+        return np.zeros(len(ets), dtype=bool)
+    index = np.searchsorted(windows[:, 0], ets, side="right") - 1
+    return (index >= 0) & (ets <= windows[np.maximum(index, 0), 1])
+
+
+def covered_seconds(windows: np.ndarray, start: float, end: float) -> float:
+    """Seconds between start and end covered by windows"""
+    return float(np.clip(np.minimum(windows[:, 1], end) - np.maximum(windows[:, 0], start), 0, None).sum())
+
+
+def report(coverage: dict[int, np.ndarray], naif_ids: list[int], start: float, end: float) -> list[tuple[int, float, int]]:
+    """Fraction of start to end in ET covered and number of coverage windows for each ID"""
+    rows = []
+    for naif_id in naif_ids:
+        windows = coverage.get(naif_id, np.empty((0, 2)))
+        overlapping = windows[(windows[:, 1] >= start) & (windows[:, 0] <= end)]
+        rows.append((naif_id, covered_seconds(overlapping, start, end) / max(end - start, 1), len(overlapping)))
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Report the coverage of the SPK kernels")
+    parser.add_argument("--kernels", help="Kernel directory", default=KERNEL_DIR)
+    parser.add_argument("--start", help="Start date in ISO 8601")
+    parser.add_argument("--end", help="End date in ISO 8601")
+    parser.add_argument("ids", help="NAIF IDs to report, all by default", nargs="*", type=int)
+    parser.add_argument("-l", "--log", help="Loglevel", default="info")
+    args = parser.parse_args()
+
+    if args.log:
+        numeric_level = getattr(logging, args.log.upper(), None)
+        if not isinstance(numeric_level, int):
+            raise ValueError('Invalid log level: %s' % args.log)
+    else:
+        numeric_level = logging.INFO
+    logging.basicConfig(level=numeric_level)
+
+    coverage = load_coverage(args.kernels)
+    spice.furnsh(path.join(args.kernels, "naif0012.tls"))
+    for naif_id, windows in sorted(coverage.items()):
+        if (args.ids and naif_id not in args.ids) or not len(windows):
+            continue
+        start = spice.str2et(args.start) if args.start else windows[0, 0]
+        end = spice.str2et(args.end) if args.end else windows[-1, 1]
+        _, fraction, count = report(coverage, [naif_id], start, end)[0]
+        print(f"{naif_id}: {fraction:.1%} of {spice.et2utc(start, 'ISOC', 0)} to {spice.et2utc(end, 'ISOC', 0)} in {count} windows")
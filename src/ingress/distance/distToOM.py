@@ -2,52 +2,96 @@
 
 import polars as pl
 from os import path
-from ...common.OpenMetric import Metric, MetricSet
+from concurrent.futures import ThreadPoolExecutor
+from ...common.OpenMetric import MetricFamily
+from ...common.catalogue import record_frame
 import argparse
 from time import time
 
 DATA_DIR = path.abspath(path.join(path.dirname(__file__),"../../../data/"))
 CSV_PATH = path.join(DATA_DIR,"distances-full.csv")
 OUT_PATH = path.join(DATA_DIR,"../data/openmetric/")
+MAX_WORKERS = 8
+
+FAMILY = MetricFamily("target_range_km", mtype="gauge", munit="km")
+SCHEMA = {"time": pl.Int64, "station": pl.String, "dish": pl.String, "target": pl.Int64, "distance": pl.Float64}
+
+
+def scan_distances(input_path: str) -> pl.LazyFrame:
+     """Distances written by distances.py, as CSV or parquet
+
+     Files written before distances were calculated per dish have no dish column.
+     """
+     df = pl.scan_parquet(input_path) if input_path.endswith(".parquet") else pl.scan_csv(input_path, schema_overrides=SCHEMA)
+     columns = df.collect_schema().names()
+     schema = {c: t for c, t in SCHEMA.items() if c != "dish" or c in columns}
+     return df.select(schema.keys()).cast(schema)
+
+
+def to_lines(df: pl.LazyFrame) -> pl.LazyFrame:
+     """OpenMetrics sample line of every distance, in the order MetricSet writes them"""
+     if "dish" not in df.collect_schema().names():
+          labels = [pl.lit(f'{FAMILY.name}{{data_source="SPICE",station_name="'), pl.col("station")]
+          df = df.sort("target", "station", "time")
+     else:
+          labels = [pl.lit(f'{FAMILY.name}{{data_source="SPICE",dish_name="'), pl.col("dish"), pl.lit('",station_name="'), pl.col("station")]
+          df = df.sort("target", "dish", "station", "time")
+     return df\
+          .select(
+               "target",
+               pl.concat_str(
+                    *labels,
+                    pl.lit('",target_id="'),
+                    pl.col("target").cast(pl.String),
+                    pl.lit('"} '),
+                    pl.col("distance").cast(pl.String),
+                    pl.lit(" "),
+                    pl.col("time").cast(pl.String),
+               ).alias("line")
+          )
 
-def to_metrics(df):
-     ms = MetricSet()
-     for row in df.iter_rows(named=True):
-          timestamp = row["time"]
-          station = row["station"]
-          target = row["target"]
-          distance = row["distance"]
-          labels = {
-               "data_source": "SPICE",
-               "station_name": station,
-               "target_id": target
-          }
-          om = Metric(name="target_range", value=distance, labels=labels, mtype="gauge", munit="km", timestamp=timestamp)
-          ms.insert(om)
-     return ms
+
+def write_target(lines: pl.DataFrame, om_path: str) -> int:
+     """Writes the lines of one target as OpenMetrics file, returns the number of samples"""
+     with open(om_path, "w") as om_file:
+          om_file.write(f"{FAMILY}\n")
+          om_file.write(lines["line"].str.join("\n").item())
+          om_file.write("\n# EOF")
+     return len(lines)
 
 
 if __name__ == "__main__":
      parser = argparse.ArgumentParser(
           description="Convert distance CSV to OpenMetrics file"
      )
-     parser.add_argument("--input", help="Path to CSV", default=CSV_PATH)
+     parser.add_argument("--input", help="Path to CSV or parquet file", default=CSV_PATH)
      parser.add_argument("--output", help="Path to output directory", default=OUT_PATH)
+     parser.add_argument("-w", "--workers", help="Number of files written in parallel", type=int, default=MAX_WORKERS)
      args = parser.parse_args()
 
+     # Read the input once, all targets are split from the same frame
+     time_start = time()
+     df = scan_distances(args.input).collect()
+     print(f"Reading {len(df)} distances took {time() - time_start}")
+
      time_start = time()
-     df = pl.read_csv(args.input)
-     targets = pl.Series(df.select("target").unique()).to_list()
-     print(f"Reading CSV for target IDs took {time() - time_start}")
-
-     for target in targets:
-          time_start = time()
-          df_part = pl.scan_csv(args.input).filter(pl.col("target") == target).collect()
-          target = df_part.select("target").head(1).item()
-          ms = to_metrics(df_part)
-          print(f"Creating MetricSet for target {target} took {time() - time_start}")
-          time_start = time()
-          om_path = path.join(args.output, f"{path.basename(args.input)}{target}.om")
-          with open(om_path, "w") as om_file:
-               om_file.write(str(ms))
-               print(f"String creation and writing for {target} took {time() - time_start}")
+     labels = {"station": "station_name", "dish": "dish_name"}
+     labels = {c: l for c, l in labels.items() if c in df.columns}
+     record_frame(df.lazy().select(
+          pl.lit("SPICE").alias("data_source"),
+          *[pl.col(c).alias(l) for c, l in labels.items()],
+          pl.col("target").alias("target_id"),
+          "time"
+     ), ["data_source", *labels.values(), "target_id"], FAMILY.name, "time")
+     parts = to_lines(df.lazy()).collect().partition_by("target", as_dict=True, include_key=False)
+     print(f"Formatting {len(parts)} targets took {time() - time_start}")
+
+     time_start = time()
+     with ThreadPoolExecutor(max_workers=args.workers) as executor:
+          futures = {
+               target: executor.submit(write_target, lines, path.join(args.output, f"{path.basename(args.input)}{target}.om"))
+               for (target,), lines in parts.items()
+          }
+          for target, future in futures.items():
+               print(f"Wrote {future.result()} samples for target {target}")
+     print(f"Writing took {time() - time_start}")
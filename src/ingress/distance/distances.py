@@ -1,103 +1,289 @@
 #!/usr/bin/env python3
 
 import spiceypy as spice
+import numpy as np
 import polars as pl
-from collections import defaultdict
+from spiceypy.utils.exceptions import SpiceyError
 import datetime as dt
 import multiprocessing as mp
-from os import listdir, path
+import json
+from functools import partial
+from os import listdir, path, makedirs, remove, replace
 import argparse
 from time import time
+from ...common.catalogue import target_ids, CATALOGUE_DIR
+from .coverage import load_coverage, covered, report
 
 DATA_DIR = path.abspath(path.join(path.dirname(__file__),"../../../data/"))
 KERNEL_DIR = path.join(DATA_DIR,"kernels/")
 OUT_PATH = path.join(DATA_DIR)
+# Part files of all chunks per target and the manifest of finished parts
+PARTS_DIR = path.join(DATA_DIR,"distances/")
+MANIFEST_FILE = "_manifest.json"
 THREAD_COUNT = mp.cpu_count()
 STEP = 5
+# Seconds of every chunk of work written to its own part file
+CHUNK_SECONDS = 24*60*60
+# Number of epochs evaluated at once per target
+BATCH_SIZE = 17280
+# Default interpolation error bound in km of the adaptive mode and the number
+# of random spot checks per body and batch
+MAX_ERROR = 0.01
+SPOT_CHECKS = 16
+# 2000-01-01T12:00:00 UTC as unix time, the epoch of UTC seconds past J2000
+J2000_UNIX = 946728000
+# Earth-fixed frame of the DSN station kernels (earthstns_itrf93_*.bsp)
+EARTH_FRAME = "ITRF93"
 
-# All DSN dish numbers
-DSN_DISH_NUMS = [
-    63,65,53,54,55,56,
-    14,24,25,26,
-    43,34,35,36
-]
-
-# 70-m DSN dish numbers to represent each of the three stations
-DSN_STATIONS = {
-    "mdscc": 63,
-    "gdscc": 14,
-    "cdscc": 43
+# All DSN dish numbers per station
+DSN_DISHES = {
+    "mdscc": [63,65,53,54,55,56],
+    "gdscc": [14,24,25,26],
+    "cdscc": [43,34,35,36]
 }
-
-# Missions as extracted from a prometheus query: count(target_range_km) by (target_name)
-# ONLY FOR REFERENCE, missing kernels
-# MISSIONS = [
-#     "ACE", "AGM1", "BEPI", "BIOS", "CAPS",
-#     "CGO", "CHDR", "DSCO", "DSN", "DSS",
-#     "EMM", "ESCB", "EURC", "GBRA", "GSSR",
-#     "HYB2", "JNO", "JWST", "KPLO", "LRO",
-#     "LTB", "LUCY", "M01O", "M20", "MEX",
-#     "MMS1", "MMS2", "MMS3", "MMS4", "MRO",
-#     "MSL", "MVN", "NHPC", "ORX", "PSYC",
-#     "SOHO", "SPP", "STA", "SWFO", "TDR8",
-#     "TESS", "TEST", "TGO", "THB", "THC",
-#     "VGR1", "VGR2", "WIND", "XMM"
-# ]
-# # Remove bogus missions
-# BOGUS = [
-#     "TEST", "DSN", "DSS", "GBRA", "GSSR",
-# ]
-# MISSIONS_ALL = list(set(MISSIONS) - set(BOGUS))
-
-# Missions for which kernels are available
-MISSIONS = [
-    "-49", "-61", "-170", "-159", "-121",
-    "-53", "-202", "-168", "-41", "-255",
-    "-64", "-96", "-98", "-76", "-74",
-    "-31", "-32"
-]
+DSN_DISH_NUMS = [dish for dishes in DSN_DISHES.values() for dish in dishes]
 
 SCHEME = {
     "time": pl.Int64,
     "station": pl.String,
+    "dish": pl.String,
     "target": pl.Int32,
     "distance": pl.Float64
 }
 
-def process(ets, kernel_files):
-    # Load necessary SPICE kernels
+def dish_name(dish: int) -> str:
+    """Name of a dish as labeled by DSN Now, e.g. DSS14"""
+    return f"DSS{dish}"
+
+
+def dish_station(dish: int) -> str:
+    return next(station for station, dishes in DSN_DISHES.items() if dish in dishes)
+
+
+def utc_to_et(times: np.ndarray) -> np.ndarray:
+    """Ephemeris times of UTC unix timestamps, the same as str2et for each of them
+
+    Follows deltet_c with the constants of the loaded leapseconds kernel, so the
+    whole grid is converted at once instead of formatting and parsing every time.
+    """
+    delta_t_a = spice.gdpool("DELTET/DELTA_T_A", 0, 1)[0]
+    k = spice.gdpool("DELTET/K", 0, 1)[0]
+    eb = spice.gdpool("DELTET/EB", 0, 1)[0]
+    m0, m1 = spice.gdpool("DELTET/M", 0, 2)
+    # Pairs of leap seconds and the UTC seconds past J2000 they apply from
+    leaps = spice.gdpool("DELTET/DELTA_AT", 0, spice.dtpool("DELTET/DELTA_AT")[0]).reshape(-1, 2)
+
+    utc = np.asarray(times, dtype=np.float64) - J2000_UNIX
+    delta_at = leaps[np.maximum(np.searchsorted(leaps[:, 1], utc, side="right") - 1, 0), 0]
+    aet = utc + delta_t_a + delta_at
+    m = m0 + m1 * aet
+    return aet + k * np.sin(m + eb * np.sin(m))
+
+
+def positions(body: str, ets: np.ndarray) -> np.ndarray:
+    """Positions of body relative to Earth in J2000 as an array of shape (len(ets), 3)"""
+    return spice.spkpos(body, ets, "J2000", "NONE", "EARTH")[0].reshape(-1, 3)
+
+
+def states(body: str, ets: np.ndarray) -> np.ndarray:
+    """Positions and velocities of body relative to Earth in J2000 as an array of shape (len(ets), 6)"""
+    return np.asarray(spice.spkezr(body, ets, "J2000", "NONE", "EARTH")[0]).reshape(-1, 6)
+
+
+def hermite(nodes: np.ndarray, node_states: np.ndarray, ets: np.ndarray) -> np.ndarray:
+    """Cubic Hermite interpolation of positions at ets from the states at the sorted nodes"""
+    i = np.clip(np.searchsorted(nodes, ets, side="right") - 1, 0, len(nodes) - 2)
+    h = (nodes[i + 1] - nodes[i])[:, None]
+    s = (ets - nodes[i])[:, None] / h
+    p0, v0 = node_states[i, :3], node_states[i, 3:]
+    p1, v1 = node_states[i + 1, :3], node_states[i + 1, 3:]
+    return (2*s**3 - 3*s**2 + 1) * p0 + (s**3 - 2*s**2 + s) * h * v0 + (-2*s**3 + 3*s**2) * p1 + (s**3 - s**2) * h * v1
+
+
+def sample(body: str, ets: np.ndarray, coarse_step: float, max_error: float, min_step: float = STEP) -> tuple[np.ndarray, int]:
+    """Positions of body at the sorted ets, interpolated from states at a coarse step
+
+    Every interval between two states is checked at its midpoint and halved as
+    long as the interpolation is off by more than max_error km there, the
+    state at the midpoint becomes a new node. Returns the positions and the
+    number of evaluated states.
+    """
+    if len(ets) < 2 or ets[-1] - ets[0] <= coarse_step:
+        return states(body, ets)[:, :3], len(ets)
+    count = int(np.ceil((ets[-1] - ets[0]) / coarse_step))
+    nodes = np.linspace(ets[0], ets[-1], count + 1)
+    node_states = states(body, nodes)
+    evaluations = len(nodes)
+    unchecked = np.ones(count, dtype=bool)
+    while unchecked.any():
+        i = np.flatnonzero(unchecked)
+        mids = (nodes[i] + nodes[i + 1]) / 2
+        mid_states = states(body, mids)
+        evaluations += len(mids)
+        error = np.linalg.norm(hermite(nodes, node_states, mids) - mid_states[:, :3], axis=1)
+        split = (error > max_error) & (nodes[i + 1] - nodes[i] > 2 * min_step)
+        # Halved intervals are checked again, all others are final
+        order = np.argsort(np.concatenate([nodes, mids[split]]), kind="stable")
+        nodes = np.concatenate([nodes, mids[split]])[order]
+        node_states = np.concatenate([node_states, mid_states[split]])[order]
+        is_new = np.concatenate([np.zeros(len(unchecked) + 1, dtype=bool), np.ones(split.sum(), dtype=bool)])[order]
+        unchecked = is_new[1:] | is_new[:-1]
+    return hermite(nodes, node_states, ets), evaluations
+
+
+def init_worker(kernel_files):
+    # Load necessary SPICE kernels once per worker process
     for f in kernel_files:
       spice.furnsh(f)
 
-    data = defaultdict(list)
-    for t, et in ets.items():
-            # Get the position of a DSN station
-            station_pos_dict = {}
-            for station, dish in DSN_STATIONS.items():
+
+def process(times, missions, coverage, coarse_step=None, max_error=MAX_ERROR, dishes=None, earth_frame=EARTH_FRAME):
+    """Distances between all dishes and missions at times, only evaluated where coverage holds their ephemeris
+
+    dishes are dish numbers, all of DSN_DISH_NUMS by default. Dishes are fixed
+    in earth_frame, so their positions come from a single rotation of that
+    frame per time. Without orientation data for earth_frame, every dish is
+    evaluated on its own.
+
+    With a coarse_step, positions are interpolated from states at that step,
+    refined until the interpolation error of every position stays below
+    max_error km, so distances are off by at most twice as much. Times do not
+    need to be on a grid, e.g. exact DSN Now sample times. The kernels must be
+    loaded, see init_worker.
+    """
+    dish_ids = {dish: spice.bodn2c(f"DSS-{dish}") for dish in (dishes or DSN_DISH_NUMS)}
+    frames = []
+    evaluations = 0
+    spot_error = 0.0
+    for i in range(0, len(times), BATCH_SIZE):
+        batch = times[i:i + BATCH_SIZE]
+        ets = utc_to_et(batch)
+
+        def evaluate(naif_id: int, label: str) -> np.ndarray:
+            """Positions at the covered ets, NaN elsewhere"""
+            nonlocal evaluations, spot_error
+            pos = np.full((len(ets), 3), np.nan)
+            mask = covered(coverage.get(naif_id, np.empty((0, 2))), ets)
+            if mask.any():
                 try:
-                    station_pos_dict[station] = spice.spkpos(f"DSS-{dish}", et, "J2000", "NONE", "EARTH")[0]
-                except Exception:
-                    print(f"Failed to compute position for {t}, {station}")
+                    if coarse_step:
+                        # Interpolate separately between gaps in the coverage
+                        covered_index = np.flatnonzero(mask)
+                        for run in np.split(covered_index, np.flatnonzero(np.diff(covered_index) > 1) + 1):
+                            pos[run], count = sample(str(naif_id), ets[run], coarse_step, max_error)
+                            evaluations += count
+                        # Spot check the interpolation at a few random times
+                        spots = np.random.default_rng(i).choice(covered_index, min(SPOT_CHECKS, len(covered_index)), replace=False)
+                        spot_error = max(spot_error, float(np.linalg.norm(pos[spots] - positions(str(naif_id), ets[spots]), axis=1).max()))
+                    else:
+                        pos[mask] = positions(str(naif_id), ets[mask])
+                except SpiceyError as e:
+                    # E.g. gaps in the ephemeris of the center the body is given relative to
+                    print(f"Failed to compute position for {batch[0]}, {label}: {e.short}")
+            return pos
+
+        try:
+            # Rotations from earth_frame to J2000 of shape (times, 3, 3), shared by all dishes
+            rotations = np.stack([spice.pxform(earth_frame, "J2000", et) for et in ets])
+        except SpiceyError as e:
+            rotations = None
+            if i == 0:
+                print(f"No orientation of {earth_frame}, evaluating every dish separately: {e.short}")
 
-            # Get the position of a satellite
-            sat_pos_dict = {}
-            for sat in MISSIONS:
+        def place(naif_id: int, label: str) -> np.ndarray:
+            """Positions of a dish at the covered ets from its offset in earth_frame, NaN elsewhere"""
+            if rotations is None:
+                return evaluate(naif_id, label)
+            pos = np.full((len(ets), 3), np.nan)
+            mask = covered(coverage.get(naif_id, np.empty((0, 2))), ets)
+            if mask.any():
                 try:
-                    sat_pos_dict[sat] = spice.spkpos(sat, et, "J2000", "NONE", "EARTH")[0]
-                except Exception:
-                    print(f"Failed to compute position for {t}, id: {sat} \nRemoving {sat} from further processing")
-                    # Assume that sat will not be available at future time stamps
-                    MISSIONS.remove(sat)
-
-            # Calculate distances between all stations and targets
-            data["time"].extend([t]*len(station_pos_dict) * len(sat_pos_dict))
-            for station, station_pos in station_pos_dict.items():
-                for sat, sat_pos in sat_pos_dict.items():
-                    data["station"].append(station)
-                    data["target"].append(int(sat))
-                    data["distance"].append(spice.vdist(station_pos, sat_pos))
-    spice.kclear()
-    return pl.from_dict(data, SCHEME)
+                    # Plate motion moves the dishes by centimetres per year, one offset per batch suffices
+                    offset = spice.spkpos(str(naif_id), ets[mask][mask.sum() // 2], earth_frame, "NONE", "EARTH")[0]
+                    pos[mask] = rotations[mask] @ offset
+                except SpiceyError as e:
+                    print(f"Failed to compute position for {batch[0]}, {label}: {e.short}")
+            return pos
+
+        # Positions of shape (times, bodies, 3)
+        dish_pos = np.stack([place(naif_id, dish_name(dish)) for dish, naif_id in dish_ids.items()], axis=1)
+        sat_pos = np.stack([evaluate(int(sat), f"id: {sat}") for sat in missions], axis=1)
+
+        # Distances between all dishes and targets of shape (times, dishes, targets)
+        distances = np.linalg.norm(sat_pos[:, None, :, :] - dish_pos[:, :, None, :], axis=-1)
+        n_dishes, n_sats = len(dish_ids), len(missions)
+        frames.append(pl.DataFrame({
+            "time": np.repeat(batch, n_dishes * n_sats),
+            "station": np.tile(np.repeat([dish_station(dish) for dish in dish_ids], n_sats), len(batch)),
+            "dish": np.tile(np.repeat([dish_name(dish) for dish in dish_ids], n_sats), len(batch)),
+            "target": np.tile(np.array(missions, dtype=np.int32), n_dishes * len(batch)),
+            "distance": distances.reshape(-1),
+        }, SCHEME).filter(pl.col("distance").is_not_nan()))
+    if coarse_step:
+        print(f"Interpolated {len(times)} times from {evaluations} states, largest spot check error {spot_error:.3g} km")
+    return pl.concat(frames) if frames else pl.DataFrame(schema=SCHEME)
+
+
+def part_name(start: int, end: int, target: str) -> str:
+    """Part file of a chunk and target relative to the parts directory"""
+    return path.join(str(target), f"{start:012d}-{end:012d}.parquet")
+
+
+def plan_chunks(start: int, end: int) -> list[tuple[int, int]]:
+    """Chunks of at most CHUNK_SECONDS between start and end, aligned to multiples of CHUNK_SECONDS
+
+    Aligned chunks stay the same when a later run extends the period.
+    """
+    bounds = [start] + list(range((start // CHUNK_SECONDS + 1) * CHUNK_SECONDS, end, CHUNK_SECONDS)) + [end]
+    return [(a, b) for a, b in zip(bounds[:-1], bounds[1:]) if a < b]
+
+
+def process_chunk(task, parts_dir, coverage, coarse_step, max_error, earth_frame=EARTH_FRAME) -> tuple[list[str], int]:
+    """Writes the distances of a chunk to one part file per target, returns the part names and the number of rows
+
+    task is the chunk and the targets missing from it.
+    """
+    (start, end), missions = task
+    # Times on the STEP grid of the epoch
+    times = np.arange(-(-start // STEP) * STEP, end, STEP, dtype=np.int64)
+    df = process(times, missions, coverage, coarse_step, max_error, earth_frame=earth_frame)
+    names = []
+    for mission in missions:
+        name = part_name(start, end, mission)
+        makedirs(path.join(parts_dir, str(mission)), exist_ok=True)
+        # Only complete part files get their final name
+        df.filter(pl.col("target") == int(mission)).write_parquet(path.join(parts_dir, name + ".tmp"))
+        replace(path.join(parts_dir, name + ".tmp"), path.join(parts_dir, name))
+        names.append(name)
+    return names, len(df)
+
+
+def load_manifest(parts_dir: str, config: dict) -> set[str]:
+    """Names of the parts finished by previous runs with the same config
+
+    Parts listed by a manifest of another config are removed, other files in
+    parts_dir are left alone.
+    """
+    try:
+        with open(path.join(parts_dir, MANIFEST_FILE)) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return set()
+    done = manifest.get("done", [])
+    if manifest.get("config") == config:
+        return {name for name in done if path.isfile(path.join(parts_dir, name))}
+    print(f"Settings or kernels changed, removing {len(done)} parts of the previous run")
+    for name in done:
+        for f in (path.join(parts_dir, name), path.join(parts_dir, name + ".tmp")):
+            if path.isfile(f):
+                remove(f)
+    return set()
+
+
+def save_manifest(parts_dir: str, config: dict, done: set[str]):
+    with open(path.join(parts_dir, MANIFEST_FILE + ".tmp"), "w") as f:
+        json.dump({"config": config, "done": sorted(done)}, f)
+    replace(path.join(parts_dir, MANIFEST_FILE + ".tmp"), path.join(parts_dir, MANIFEST_FILE))
 
 
 if __name__ == "__main__":
@@ -105,11 +291,18 @@ if __name__ == "__main__":
     end_time = dt.datetime(2025,8,30).timestamp()
 
     parser = argparse.ArgumentParser(
-        description="Calculate distances between DSN stations and targets"
+        description="Calculate distances between DSN dishes and targets"
     )
     parser.add_argument("--start",help="Start date in ISO 8601", default=start_time)
     parser.add_argument("--end",help="End date in ISO 8601", default=end_time)
     parser.add_argument("--split",help="Split files by station", action="store_true")
+    parser.add_argument("--targets",help="Comma separated NAIF IDs, by default all targets the catalogue lists for the period", type=lambda x: [item.strip() for item in x.split(",")])
+    parser.add_argument("--catalogue",help="Catalogue directory written during ingest", default=CATALOGUE_DIR)
+    parser.add_argument("--coarse-step",help="Evaluate SPICE every this many seconds and interpolate in between", type=float)
+    parser.add_argument("--parts",help="Directory for the part files of all chunks, finished chunks are skipped on restart", default=PARTS_DIR)
+    parser.add_argument("--restart",help="Calculate all chunks again", action="store_true")
+    parser.add_argument("--max-error",help="Largest allowed interpolation error of positions in km, requires --coarse-step", type=float, default=MAX_ERROR)
+    parser.add_argument("--earth-frame",help="Earth-fixed frame of the station kernels", default=EARTH_FRAME)
     args = parser.parse_args()
 
     if isinstance(args.start, str):
@@ -117,6 +310,13 @@ if __name__ == "__main__":
     if isinstance(args.end, str):
         args.end = dt.datetime.fromisoformat(args.end).timestamp()
 
+    # Targets seen by DSN Now during the period, kernels for some of them may be missing
+    missions = args.targets or [str(i) for i in target_ids(args.catalogue, start=int(args.start), end=int(args.end))]
+    if not missions:
+        print(f"ERROR: no targets given and none found in the catalogue at {args.catalogue}")
+        exit(1)
+    print(f"Calculating distances for {len(missions)} targets: {', '.join(missions)}")
+
     # Load leapsecond SPICE kernel
     f_path = path.join(KERNEL_DIR, "naif0012.tls")
     if path.isfile(f_path):
@@ -126,37 +326,67 @@ if __name__ == "__main__":
         exit(1)
 
     full_timer_start = time()
-    # Define the times of interest
-    ets = {t: spice.str2et(str(dt.datetime.fromtimestamp(t))) for t in range(int(args.start), int(args.end), STEP) }
-    print(f"Creating timestamps took {time() - full_timer_start}")
+    # Plan the work from the coverage of the kernels instead of failing evaluations
+    timer_start = time()
+    coverage = load_coverage(KERNEL_DIR)
+    start_et, end_et = utc_to_et(np.array([args.start, args.end]))
+    print(f"Coverage between {spice.et2utc(start_et, 'ISOC', 0)} and {spice.et2utc(end_et, 'ISOC', 0)}:")
+    mission_coverage = report(coverage, [int(m) for m in missions], start_et, end_et)
+    for naif_id, fraction, windows in mission_coverage:
+        print(f"  {naif_id}: {fraction:.1%} in {windows} windows")
+    dish_ids = [spice.bodn2c(f"DSS-{dish}") for dish in DSN_DISH_NUMS]
+    for dish, (_, fraction, _) in zip(DSN_DISH_NUMS, report(coverage, dish_ids, start_et, end_et)):
+        if fraction < 1:
+            print(f"  {dish_name(dish)}: {fraction:.1%}")
+    missions = [m for m, (_, fraction, _) in zip(missions, mission_coverage) if fraction > 0]
+    if not missions:
+        print("ERROR: no kernel covers any of the targets during the period")
+        exit(1)
+    coverage = {naif_id: coverage[naif_id] for naif_id in [int(m) for m in missions] + dish_ids if naif_id in coverage}
+    print(f"Reading kernel coverage took {time() - timer_start}")
 
     # Find all kernel files
-    kernel_files = [path.join(KERNEL_DIR, f) for f in listdir(KERNEL_DIR) if path.isfile(path.join(KERNEL_DIR, f))]
+    kernel_files = [path.join(KERNEL_DIR, f) for f in sorted(listdir(KERNEL_DIR)) if path.isfile(path.join(KERNEL_DIR, f)) and not f.startswith(".")]
+
+    # Skip chunks and targets finished by a previous run with the same kernels and
+    # settings, the targets change whenever the period is extended
+    makedirs(args.parts, exist_ok=True)
+    config = {
+        "step": STEP,
+        "coarse_step": args.coarse_step,
+        "max_error": args.max_error if args.coarse_step else None,
+        "earth_frame": args.earth_frame,
+        "kernels": {path.basename(f): [path.getsize(f), path.getmtime(f)] for f in kernel_files},
+    }
+    done = set() if args.restart else load_manifest(args.parts, config)
+    chunks = plan_chunks(int(args.start), int(args.end))
+    todo = [(chunk, missing) for chunk in chunks if (missing := [m for m in missions if part_name(*chunk, m) not in done])]
+    print(f"Calculating {len(todo)} of {len(chunks)} chunks, {len(chunks) - len(todo)} finished before")
 
     processing_timer_start = time()
-    # Create a pool of processes
-    with mp.Pool(processes=THREAD_COUNT) as pool:
-        # Split the ets dictionary into chunks for each process
-        part_size = int(len(ets) / THREAD_COUNT)
-        ets_parts = [dict(list(ets.items())[i * part_size:(i + 1) * part_size]) for i in range(THREAD_COUNT)]
-        # Ensure the last part gets any remaining items
-        ets_parts[-1].update(dict(list(ets.items())[THREAD_COUNT * part_size:]))
-
-        # Process the data in parallel
-        results = pool.starmap(process, [(ets_part, kernel_files) for ets_part in ets_parts])
+    # Workers take chunks one at a time and write the missing targets to their own part files
+    with mp.Pool(processes=THREAD_COUNT, initializer=init_worker, initargs=(kernel_files,)) as pool:
+        func = partial(process_chunk, parts_dir=args.parts, coverage=coverage, coarse_step=args.coarse_step, max_error=args.max_error, earth_frame=args.earth_frame)
+        for finished, (names, rows) in enumerate(pool.imap_unordered(func, todo), start=len(chunks) - len(todo) + 1):
+            done.update(names)
+            save_manifest(args.parts, config, done)
+            print(f"Finished {path.basename(names[0])} for {len(names)} targets with {rows} rows, {finished} of {len(chunks)} chunks")
     print(f"Calculating distances took {time() - processing_timer_start}")
 
     timer_start = time()
-    # Collect data into a single dataframe
-    df = pl.concat(results)
-    print(f"Dataframe creation took {time() - timer_start}")
-
-    timer_start = time()
+    # Stream the parts into the CSV files in time order, ordered by dish and target within each time
+    dish_order = {dish_name(dish): i for i, dish in enumerate(DSN_DISH_NUMS)}
+    target_order = {int(m): i for i, m in enumerate(missions)}
+    parts = pl.concat([
+        pl.scan_parquet([path.join(args.parts, part_name(*chunk, m)) for m in missions], schema=SCHEME)
+          .sort("time", pl.col("dish").replace_strict(dish_order), pl.col("target").replace_strict(target_order))
+        for chunk in chunks
+    ])
     if args.split:
-        for station in DSN_STATIONS:
-            df.filter(pl.col("station") == station).write_csv(path.join(OUT_PATH,f"distances-{station}.csv"), separator=",")
+        for station in DSN_DISHES:
+            parts.filter(pl.col("station") == station).sink_csv(path.join(OUT_PATH,f"distances-{station}.csv"), separator=",")
     else:
-        df.write_csv(path.join(OUT_PATH, "distances-full.csv"), separator=",")
+        parts.sink_csv(path.join(OUT_PATH, "distances-full.csv"), separator=",")
 
-    print(f"Filtering and writing to file took {time() - timer_start}")
+    print(f"Writing to file took {time() - timer_start}")
     print(f"Complete execution took {time() - full_timer_start}")
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+"""SPICE distances computed on demand and cached in daily parquet tiles.
+
+A tile holds the distances between one dish and one target during one UTC day
+at one step, stored as TILE_DIR/<key>/<step>/<dish>/<target>/<day>.parquet.
+The key is a hash of the kernels and the sampling settings, so tiles are
+computed again once kernels are added or replaced. Requests
+only compute the tiles missing from the cache, one day per task of a process
+pool, and the least recently used tiles are evicted once the cache outgrows
+its size.
+"""
+
+import argparse
+import datetime as dt
+import hashlib
+import json
+import logging
+import multiprocessing as mp
+import re
+import sys
+import numpy as np
+import polars as pl
+import spiceypy as spice
+from functools import partial
+from os import path, listdir, makedirs, remove, replace, stat, utime, walk
+from .coverage import load_coverage, kernel_digests
+from ..dsn.rawindex import parse_time
+from .distances import init_worker, process, dish_name, DSN_DISHES, EARTH_FRAME, KERNEL_DIR, SCHEME, STEP, THREAD_COUNT, MAX_ERROR
+
+logger = logging.getLogger(__name__)
+
+DATA_DIR = path.abspath(path.join(path.dirname(__file__),"../../../data/"))
+TILE_DIR = path.join(DATA_DIR,"cache/distances/")
+MAX_SIZE = 1024**3
+DAY = 24*60*60
+
+
+def station_dishes(station: str) -> list[int]:
+    """Dish numbers of a station name such as mdscc or of a dish name such as DSS14"""
+    if station in DSN_DISHES:
+        return DSN_DISHES[station]
+    match = re.fullmatch(r"DSS-?(\d+)", station, re.IGNORECASE)
+    if match is None:
+        raise ValueError(f"Unknown station or dish {station}")
+    return [int(match.group(1))]
+
+
+def init_tile_worker(kernel_files):
+    init_worker(kernel_files)
+    # process reports with print, stdout belongs to the output of the caller, e.g. a contact plan
+    sys.stdout = sys.stderr
+
+
+def tile_key(kernel_dir: str, coarse_step: float | None, max_error: float, earth_frame: str) -> str:
+    """Hash of everything besides dish, target, day and step that the distances of a tile depend on"""
+    config = {
+        "kernels": sorted(kernel_digests(kernel_dir).values()),
+        "coarse_step": coarse_step,
+        "max_error": max_error if coarse_step else None,
+        "earth_frame": earth_frame,
+    }
+    return hashlib.sha256(json.dumps(config, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def compute_tiles(group, tile_dir, step, coverage, coarse_step, max_error, earth_frame) -> int:
+    """Computes the missing tiles of one day, pairs of dishes and targets, returns the number of rows
+
+    tile_dir is the directory of the key of the settings, see tile_key.
+    """
+    day, pairs = group
+    dishes = sorted({dish for dish, _ in pairs})
+    targets = sorted({target for _, target in pairs})
+    times = np.arange(-(-day // step) * step, day + DAY, step, dtype=np.int64)
+    # All dishes of a day share the rotations of the Earth
+    df = process(times, [str(t) for t in targets], coverage, coarse_step, max_error, dishes, earth_frame)
+    for dish, target in pairs:
+        tile = tile_path(tile_dir, dish, target, day, step)
+        makedirs(path.dirname(tile), exist_ok=True)
+        # Tiles without coverage are written empty, so they are not computed again
+        df.filter(pl.col("dish") == dish_name(dish), pl.col("target") == target).write_parquet(tile + ".tmp")
+        replace(tile + ".tmp", tile)
+    return len(df)
+
+
+def tile_path(tile_dir: str, dish: int, target: int, day: int, step: int) -> str:
+    day_string = dt.datetime.fromtimestamp(day, dt.timezone.utc).strftime("%Y-%m-%d")
+    return path.join(tile_dir, str(step), dish_name(dish), str(target), f"{day_string}.parquet")
+
+
+class DistanceTiles:
+    """Distances between dishes and targets, computed when first requested"""
+
+    def __init__(self, tile_dir: str = TILE_DIR, kernel_dir: str = KERNEL_DIR, max_size: int = MAX_SIZE,
+                 workers: int = THREAD_COUNT, coarse_step: float | None = None, max_error: float = MAX_ERROR,
+                 earth_frame: str = EARTH_FRAME):
+        self.tile_dir = tile_dir
+        self.kernel_dir = kernel_dir
+        self.max_size = max_size
+        self.workers = workers
+        self.coarse_step = coarse_step
+        self.max_error = max_error
+        self.earth_frame = earth_frame
+        makedirs(tile_dir, exist_ok=True)
+
+    def distances(self, stations: list[str], targets: list[int], start: int, end: int, step: int = STEP) -> pl.LazyFrame:
+        """Distances of all dishes of the stations at the epoch aligned step grid from start until before end
+
+        stations are station names such as mdscc or dish names such as DSS14,
+        the result has the layout of distances.py.
+        """
+        dishes = sorted({dish for station in stations for dish in station_dishes(station)})
+        key_dir = path.join(self.tile_dir, tile_key(self.kernel_dir, self.coarse_step, self.max_error, self.earth_frame))
+        days = range(start // DAY * DAY, end, DAY)
+        tiles = []
+        missing: dict[int, list[tuple[int, int]]] = {}
+        for dish in dishes:
+            for target in targets:
+                for day in days:
+                    tile = tile_path(key_dir, dish, target, day, step)
+                    tiles.append(tile)
+                    if path.isfile(tile):
+                        utime(tile)
+                    else:
+                        missing.setdefault(day, []).append((dish, target))
+        logger.info(f"Distance tile cache hit for {len(tiles) - sum(map(len, missing.values()))} of {len(tiles)} tiles")
+
+        if missing:
+            self._compute(list(missing.items()), key_dir, step)
+            self.evict(keep=set(tiles))
+
+        if not tiles:
+            return pl.LazyFrame(schema=SCHEME)
+        return pl.scan_parquet(tiles, schema=SCHEME)\
+            .filter(pl.col("time").is_between(start, end, closed="left"))\
+            .sort("time", "dish", "target")
+
+    def _compute(self, groups: list[tuple[int, list[tuple[int, int]]]], key_dir: str, step: int):
+        kernel_files = [path.join(self.kernel_dir, f) for f in sorted(listdir(self.kernel_dir))
+                        if path.isfile(path.join(self.kernel_dir, f)) and not f.startswith(".")]
+        pairs = {pair for _, day_pairs in groups for pair in day_pairs}
+        bodies = {spice.bodn2c(f"DSS-{dish}") for dish, _ in pairs} | {target for _, target in pairs}
+        coverage = {naif_id: windows for naif_id, windows in load_coverage(self.kernel_dir).items() if naif_id in bodies}
+
+        logger.info(f"Computing {sum(len(day_pairs) for _, day_pairs in groups)} distance tiles of {len(groups)} days")
+        func = partial(compute_tiles, tile_dir=key_dir, step=step, coverage=coverage,
+                       coarse_step=self.coarse_step, max_error=self.max_error, earth_frame=self.earth_frame)
+        # Callers may have started polars threads already, which forked workers would inherit in a locked state
+        with mp.get_context("spawn").Pool(processes=min(self.workers, len(groups)), initializer=init_tile_worker, initargs=(kernel_files,)) as pool:
+            pool.map(func, groups)
+
+    def evict(self, keep: set[str] = set()) -> int:
+        """Remove least recently used tiles, except those in keep, until the cache fits max_size"""
+        files = []
+        for root, _, names in walk(self.tile_dir):
+            for name in names:
+                if name.endswith(".parquet"):
+                    file_path = path.join(root, name)
+                    file_stat = stat(file_path)
+                    files.append((file_stat.st_mtime, file_stat.st_size, file_path))
+
+        size = sum(f[1] for f in files)
+        evicted = 0
+        for _, file_size, file_path in sorted(files):
+            if size <= self.max_size:
+                break
+            if file_path in keep:
+                continue
+            remove(file_path)
+            size -= file_size
+            evicted += 1
+        if evicted:
+            logger.info(f"Evicted {evicted} distance tiles")
+        return evicted
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Print SPICE distances from the tile cache, computing missing tiles")
+    parser.add_argument("start", help="Start time in ISO 8601")
+    parser.add_argument("end", help="End time in ISO 8601")
+    parser.add_argument("-s", "--stations", help="Comma separated stations (mdscc, gdscc, cdscc) or dishes (e.g. DSS14)", default=",".join(DSN_DISHES))
+    parser.add_argument("-t", "--targets", help="Comma separated NAIF IDs", required=True)
+    parser.add_argument("--step", help="Step in seconds", type=int, default=STEP)
+    parser.add_argument("--coarse-step", help="Evaluate SPICE every this many seconds and interpolate in between", type=float)
+    parser.add_argument("--earth-frame", help="Earth-fixed frame of the station kernels", default=EARTH_FRAME)
+    parser.add_argument("--dir", help="Tile directory", default=TILE_DIR)
+    parser.add_argument("-o", "--output", help="Write the distances to this CSV file instead of printing them")
+    parser.add_argument("-l", "--log", help="Loglevel", default="info")
+    args = parser.parse_args()
+
+    if args.log:
+        numeric_level = getattr(logging, args.log.upper(), None)
+        if not isinstance(numeric_level, int):
+            raise ValueError('Invalid log level: %s' % args.log)
+    else:
+        numeric_level = logging.INFO
+    logging.basicConfig(level=numeric_level)
+
+    tiles = DistanceTiles(args.dir, coarse_step=args.coarse_step, earth_frame=args.earth_frame)
+    df = tiles.distances(args.stations.split(","), [int(t) for t in args.targets.split(",")], parse_time(args.start), parse_time(args.end), args.step)
+    if args.output:
+        df.sink_csv(args.output)
+    else:
+        print(df.collect())
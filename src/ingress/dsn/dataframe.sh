@@ -10,7 +10,8 @@ cd "$WORK_DIR"
 DATA_DIR="./data"
 INPUT_DIR="$DATA_DIR/to_be_converted"
 OUTPUT_DIR="$DATA_DIR/exports/direct"
-mkdir -p "$OUTPUT_DIR"
+ROLLUP_DIR="$DATA_DIR/exports/rollup"
+mkdir -p "$OUTPUT_DIR" "$ROLLUP_DIR"
 
 # Set the number of concurrent process to the available cores
 CONCURRENCY=$(nproc)
@@ -19,4 +20,4 @@ PY_MODULE="src.ingress.dsn.parquetify"
 
 find "$INPUT_DIR/" -maxdepth 1 -type f -print0 |
   parallel -0 -j "$CONCURRENCY" \
-    'python -m '"$PY_MODULE"' -z {} '"$OUTPUT_DIR"'/{/}.parquet'
+    'python -m '"$PY_MODULE"' -z -r '"$ROLLUP_DIR"' {} '"$OUTPUT_DIR"'/{/}.parquet'
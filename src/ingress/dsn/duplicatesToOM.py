@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+
+import argparse
+import logging
+import glob
+from os import path
+from .segment import SegmentReader
+from ...common.OpenMetric import Metric, MetricSet
+
+logger = logging.getLogger(__name__)
+
+DATA_DIR = path.abspath(path.join(path.dirname(__file__),"../../../data/"))
+IN_DIR = path.join(DATA_DIR,"raw/")
+OUT_PATH = path.join(DATA_DIR,"openmetric/","dsn_snapshots.om")
+
+
+def segment_to_metrics(segment_path: str, ms: MetricSet) -> tuple[int, int]:
+    """Add cumulative stored and duplicate snapshot counters of a segment to ms"""
+    with SegmentReader(segment_path) as reader:
+        events = [(ts, "stored") for ts, _ in reader.index]
+        events.extend((ts, "duplicate") for ts, _ in reader.duplicate_index)
+    events.sort()
+
+    counts = {"stored": 0, "duplicate": 0}
+    for timestamp, result in events:
+        counts[result] += 1
+        labels = {
+            "data_source": "DSN Now",
+            "result": result
+        }
+        ms.insert(Metric(name="raw_snapshots_total", value=counts[result], labels=labels, mtype="counter", timestamp=timestamp))
+
+    if events:
+        ratio = counts["duplicate"] / len(events)
+        labels = {"data_source": "DSN Now"}
+        ms.insert(Metric(name="raw_snapshot_duplicate_ratio", value=ratio, labels=labels, mtype="gauge", timestamp=events[-1][0]))
+    return counts["stored"], counts["duplicate"]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Export the snapshot duplicate rate of raw segments as OpenMetrics"
+    )
+    parser.add_argument("-l","--log",help="Loglevel",default="info")
+    parser.add_argument("--input",help="Directory containing daily segments", default=IN_DIR)
+    parser.add_argument("--output",help="Path to output file", default=OUT_PATH)
+    args = parser.parse_args()
+
+    if args.log:
+        numeric_level = getattr(logging, args.log.upper(), None)
+        if not isinstance(numeric_level, int):
+            raise ValueError('Invalid log level: %s' % args.log)
+    else:
+        numeric_level = logging.INFO
+    logging.basicConfig(level=numeric_level)
+
+    ms = MetricSet()
+    total_stored = 0
+    total_duplicate = 0
+    for f in sorted(glob.glob(path.join(args.input, "*.seg"))):
+        stored, duplicate = segment_to_metrics(f, ms)
+        logger.info(f"{path.basename(f)}: {stored} stored, {duplicate} duplicate snapshots")
+        total_stored += stored
+        total_duplicate += duplicate
+
+    if total_stored + total_duplicate:
+        logger.info(f"Duplicate rate: {total_duplicate / (total_stored + total_duplicate):.3f}")
+
+    with open(args.output, "w") as om_file:
+        om_file.write(str(ms))
@@ -10,7 +10,11 @@ from time import time
 from os import path, listdir, mkdir
 from shutil import rmtree
 from .rewrite import xml_path_to_dict
+from .segment import is_segment, extract_all
+from .rawindex import update_index, extract_range, parse_time
 from ...common.OpenMetric import Metric, MetricSet
+from ...common.rollup import ROLLUP_TIERS, rollup_metric_set
+from ...common.catalogue import record_metric_set
 
 logger = logging.getLogger(__name__)
 
@@ -149,7 +153,13 @@ def process_batch(directory: str, is_xml: bool) -> MetricSet:
 
     return result
 
-def openmetrify(is_batch: bool, is_xml: bool, input_path: str, output_path: str):
+def rollup_path(output_path: str, tier: str) -> str:
+    """Path of a rollup tier written next to output_path, e.g. dsn_2025-06-01.zip.rollup_1m.om"""
+    root, ext = path.splitext(output_path)
+    return f"{root}.rollup_{tier}{ext or '.om'}"
+
+
+def openmetrify(is_batch: bool, is_xml: bool, input_path: str, output_path: str, rollups: bool = False):
     # Process batches separately
     if is_batch:
         file_name = path.basename(input_path)
@@ -157,7 +167,7 @@ def openmetrify(is_batch: bool, is_xml: bool, input_path: str, output_path: str)
             start = time()
             result = process_batch(input_path, is_xml)
             logger.info(f"Processing {file_name} took {time()-start}")
-        elif path.isfile(input_path) and ".zip" in input_path:
+        elif path.isfile(input_path) and (".zip" in input_path or is_segment(input_path)):
             temp_dir_base = tempfile.gettempdir() + "/openmetrify_extracted"
 
             # create random temp directory without conflict
@@ -170,8 +180,11 @@ def openmetrify(is_batch: bool, is_xml: bool, input_path: str, output_path: str)
 
             # Extract archive
             start = time()
-            with zipfile.ZipFile(input_path, "r") as zipf:
-                zipf.extractall(temp_dir)
+            if is_segment(input_path):
+                extract_all(input_path, temp_dir)
+            else:
+                with zipfile.ZipFile(input_path, "r") as zipf:
+                    zipf.extractall(temp_dir)
             logger.info(f"Extracting {file_name} took {time()-start}")
 
             # Process contents
@@ -192,6 +205,17 @@ def openmetrify(is_batch: bool, is_xml: bool, input_path: str, output_path: str)
             om_file.write(res_string)
         logger.info(f"Writing output for {file_name} took {time()-start}")
 
+        start = time()
+        series = record_metric_set(result)
+        logger.info(f"Recording {series} series in the catalogue took {time()-start}")
+
+        if rollups:
+            start = time()
+            for tier in ROLLUP_TIERS:
+                with open(rollup_path(output_path, tier), "w") as om_file:
+                    om_file.write(rollup_metric_set(result, tier))
+            logger.info(f"Writing rollups for {file_name} took {time()-start}")
+
     else: # Single file processing mode
         if is_xml:
             dic = xml_path_to_dict(input_path)
@@ -211,6 +235,14 @@ def openmetrify(is_batch: bool, is_xml: bool, input_path: str, output_path: str)
                 om_file.write(str(ms))
 
 
+def openmetrify_window(raw_dir: str, output_path: str, start: int | None, end: int | None, rollups: bool = False):
+    """Convert only the snapshots between start and end, located through the raw index"""
+    update_index(raw_dir)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        count = extract_range(raw_dir, temp_dir, start, end)
+        logger.info(f"Selected {count} snapshots from {raw_dir}")
+        openmetrify(is_batch=True, is_xml=True, input_path=temp_dir, output_path=output_path, rollups=rollups)
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
@@ -219,6 +251,9 @@ if __name__ == "__main__":
     parser.add_argument("-b","--batch", action="store_true", help="Treat input as collection and output to single file")
     parser.add_argument("-x","--xml", action="store_true", help="Work directly on DSN XML files instead of converted json")
     parser.add_argument("-l","--log",help="Loglevel")
+    parser.add_argument("-r","--rollups", action="store_true", help="Also write 1m and 1h rollups next to the output, requires -b")
+    parser.add_argument("--start",help="Only convert snapshots from this time on (ISO 8601), input is the raw archive directory")
+    parser.add_argument("--end",help="Only convert snapshots before this time (ISO 8601), input is the raw archive directory")
     parser.add_argument("input")
     parser.add_argument("output")
     args = parser.parse_args()
@@ -232,5 +267,9 @@ if __name__ == "__main__":
         numeric_level = logging.INFO
     logging.basicConfig(level=numeric_level)
 
-
-    openmetrify(is_batch=args.batch, is_xml=args.xml, input_path=args.input, output_path=args.output)
+    if args.start or args.end:
+        start = parse_time(args.start) if args.start else None
+        end = parse_time(args.end) if args.end else None
+        openmetrify_window(args.input, args.output, start, end, args.rollups)
+    else:
+        openmetrify(is_batch=args.batch, is_xml=args.xml, input_path=args.input, output_path=args.output, rollups=args.rollups)
@@ -1,5 +1,7 @@
 #!/usr/bin/env python3
 
+from __future__ import annotations
+
 import argparse
 import logging
 import tempfile
@@ -7,8 +9,12 @@ import zipfile
 import math
 import polars as pl
 from dataclasses import dataclass
-from os import listdir, path, getcwd
+from os import listdir, path, getcwd, makedirs
 from .rewrite import xml_path_to_dict
+from .segment import is_segment, extract_all
+from .rawindex import update_index, extract_range, parse_time
+from ...common.rollup import ROLLUP_TIERS, rollup
+from ...common.catalogue import record_frame
 
 WORKING_DIR = getcwd()
 logger = logging.getLogger(__name__)
@@ -39,6 +45,34 @@ POLARS_SCHEMA = {
     "signal_power_sent_kW": pl.Float64,
 }
 
+# Columns identifying a series and the numeric columns downsampled in rollups
+ROLLUP_KEYS = [
+    "station_name",
+    "dish_name",
+    "dish_activity",
+    "target_name",
+    "target_id",
+    "signal_direction",
+    "signal_activity",
+    "signal_type",
+    "signal_band",
+]
+ROLLUP_VALUES = [
+    "dish_azimuth_angle_degrees",
+    "dish_elevation_angel_degrees",
+    "dish_wind_speed_km_per_h",
+    "dish_mspa_bool",
+    "dish_array_bool",
+    "dish_ddor_bool",
+    "target_round_trip_seconds",
+    "target_upleg_range_km",
+    "target_downleg_range_km",
+    "signal_data_rate_b_per_s",
+    "signal_frequency_Hz",
+    "signal_power_received_dBm",
+    "signal_power_sent_kW",
+]
+
 @dataclass
 class dsn_file:
     timestamp: int
@@ -271,7 +305,16 @@ def parse_dsn(in_file) -> dsn_file | None:
     return dsn_file(timestamp, dsn_stations)
 
 
-def dsn_dir_to_parquet(in_dir: str, out_file: str):
+def write_rollups(in_file: str, rollup_dir: str):
+    """Write 1m and 1h rollups of a converted file to rollup_dir/<tier>/"""
+    df = pl.scan_parquet(in_file, schema=POLARS_SCHEMA)
+    for tier, every in ROLLUP_TIERS.items():
+        tier_dir = path.join(rollup_dir, tier)
+        makedirs(tier_dir, exist_ok=True)
+        rollup(df, ROLLUP_KEYS, ROLLUP_VALUES, every).sink_parquet(path.join(tier_dir, path.basename(in_file)))
+
+
+def dsn_dir_to_parquet(in_dir: str, out_file: str, rollup_dir: str | None = None):
     dir_path = path.join(in_dir)
     with tempfile.TemporaryDirectory(dir=WORKING_DIR) as tmp_dir:
         for f in listdir(dir_path):
@@ -285,16 +328,31 @@ def dsn_dir_to_parquet(in_dir: str, out_file: str):
             df_tmp.write_parquet(tmp_file)
         df = pl.scan_parquet(source = tmp_dir, schema = POLARS_SCHEMA)
         df.sink_parquet(out_file)
+    record_frame(pl.scan_parquet(out_file).with_columns(pl.lit("DSN Now").alias("data_source")), ["data_source", *ROLLUP_KEYS])
+    if rollup_dir:
+        write_rollups(out_file, rollup_dir)
 
 
-def dsn_to_parquet(in_file: str, out_file: str, is_zip: bool):
+def dsn_to_parquet(in_file: str, out_file: str, is_zip: bool, include_duplicates: bool = True, rollup_dir: str | None = None):
     if is_zip:
         with tempfile.TemporaryDirectory(dir=WORKING_DIR) as tmp_dir:
-            with zipfile.ZipFile(in_file, "r") as zipf:
-                zipf.extractall(tmp_dir)
-            dsn_dir_to_parquet(tmp_dir, out_file)
+            if is_segment(in_file):
+                extract_all(in_file, tmp_dir, include_duplicates)
+            else:
+                with zipfile.ZipFile(in_file, "r") as zipf:
+                    zipf.extractall(tmp_dir)
+            dsn_dir_to_parquet(tmp_dir, out_file, rollup_dir)
     else:
-        dsn_dir_to_parquet(in_file, out_file)
+        dsn_dir_to_parquet(in_file, out_file, rollup_dir)
+
+
+def dsn_window_to_parquet(raw_dir: str, out_file: str, start: int | None, end: int | None, include_duplicates: bool = True, rollup_dir: str | None = None):
+    """Convert only the snapshots between start and end, located through the raw index"""
+    update_index(raw_dir)
+    with tempfile.TemporaryDirectory(dir=WORKING_DIR) as tmp_dir:
+        count = extract_range(raw_dir, tmp_dir, start, end, include_duplicates)
+        logger.info(f"Selected {count} snapshots from {raw_dir}")
+        dsn_dir_to_parquet(tmp_dir, out_file, rollup_dir)
 
 
 if __name__ == "__main__":
@@ -302,7 +360,11 @@ if __name__ == "__main__":
         description="convert DSN Now XML files to parquet files"
     )
     parser.add_argument("-l","--log",help="loglevel")
-    parser.add_argument("-z","--zip", action="store_true", help="treat input as a zip compressed archive of DSN Now XML files")
+    parser.add_argument("-z","--zip", action="store_true", help="treat input as a zip archive or segment of DSN Now XML files")
+    parser.add_argument("--skip-duplicates", dest="duplicates", action="store_false", help="leave out snapshots deduplicated in segments instead of restoring them at their capture time")
+    parser.add_argument("-r","--rollups", help="also write 1m and 1h rollups into subdirectories of this directory")
+    parser.add_argument("--start", help="only convert snapshots from this time on (ISO 8601), input is the raw archive directory")
+    parser.add_argument("--end", help="only convert snapshots before this time (ISO 8601), input is the raw archive directory")
     parser.add_argument("input", help="directory containing DSN Now XML files")
     parser.add_argument("output")
     args = parser.parse_args()
@@ -316,4 +378,9 @@ if __name__ == "__main__":
         numeric_level = logging.INFO
     logging.basicConfig(level=numeric_level)
 
-    dsn_to_parquet(args.input, args.output, args.zip)
+    if args.start or args.end:
+        start = parse_time(args.start) if args.start else None
+        end = parse_time(args.end) if args.end else None
+        dsn_window_to_parquet(args.input, args.output, start, end, args.duplicates, args.rollups)
+    else:
+        dsn_to_parquet(args.input, args.output, args.zip, args.duplicates, args.rollups)
@@ -21,7 +21,7 @@ THREAD_COUNT = 3 # Number of concurrent threads
 def process_file(f, out_dir):
     date = path.basename(f)
     om_file = path.join(out_dir, f'dsn_{date}.om')
-    openmetrify(is_batch=True, is_xml=True, input_path=f, output_path=om_file)
+    openmetrify(is_batch=True, is_xml=True, input_path=f, output_path=om_file, rollups=True)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+"""Timestamp index over the raw DSN Now archives.
+
+Every daily zip archive or segment in the raw directory is indexed into its own
+parquet file below INDEX_DIR_NAME, mapping snapshot timestamps to archive and
+member offset. Only archives that changed since the last update are indexed
+again, so keeping the index current is cheap even for the scraper's live
+segment.
+"""
+
+import argparse
+import json
+import logging
+import zipfile
+import datetime as dt
+import polars as pl
+from os import path, listdir, makedirs, remove, stat
+from .segment import SegmentReader, is_segment, member_timestamp
+
+logger = logging.getLogger(__name__)
+
+DATA_DIR = path.abspath(path.join(path.dirname(__file__),"../../../data/"))
+RAW_DIR = path.join(DATA_DIR,"raw/")
+INDEX_DIR_NAME = ".index"
+MANIFEST_FILE = "manifest.json"
+
+# Nominal scraper interval and the smallest interruption reported as a gap
+SAMPLE_INTERVAL = 5
+GAP_THRESHOLD = 30
+
+INDEX_SCHEMA = {
+    "timestamp": pl.Int64,
+    "archive": pl.String,
+    "member": pl.String,
+    "offset": pl.UInt64,
+    "duplicate": pl.Boolean,
+}
+
+
+def parse_time(string: str) -> int:
+    """Unix timestamp of an ISO 8601 string, assuming UTC if no offset is given"""
+    time = dt.datetime.fromisoformat(string)
+    if time.tzinfo is None:
+        time = time.replace(tzinfo=dt.timezone.utc)
+    return int(time.timestamp())
+
+
+def is_archive(file_name: str) -> bool:
+    return file_name.endswith(".zip") or is_segment(file_name)
+
+
+def index_dir(raw_dir: str) -> str:
+    return path.join(raw_dir, INDEX_DIR_NAME)
+
+
+def index_archive(archive_path: str) -> pl.DataFrame:
+    """Index the snapshots of a single archive without decompressing them"""
+    archive = path.basename(archive_path)
+    cols: dict[str, list[object]] = {k: [] for k in INDEX_SCHEMA.keys()}
+
+    def add(timestamp, member, offset, duplicate):
+        cols["timestamp"].append(timestamp)
+        cols["archive"].append(archive)
+        cols["member"].append(member)
+        cols["offset"].append(offset)
+        cols["duplicate"].append(duplicate)
+
+    if is_segment(archive_path):
+        with SegmentReader(archive_path) as reader:
+            for timestamp, offset in reader.index:
+                add(timestamp, None, offset, False)
+            for timestamp, offset in reader.duplicate_index:
+                add(timestamp, None, offset, True)
+    else:
+        with zipfile.ZipFile(archive_path, "r") as zipf:
+            for info in zipf.infolist():
+                try:
+                    timestamp = member_timestamp(info.filename)
+                except ValueError:
+                    logger.debug(f"Skipping member without timestamp: {info.filename}")
+                    continue
+                add(timestamp, info.filename, info.header_offset, False)
+
+    return pl.DataFrame(cols, INDEX_SCHEMA).sort("timestamp")
+
+
+def update_index(raw_dir: str = RAW_DIR) -> int:
+    """Index new or changed archives in raw_dir, returns the number of archives indexed"""
+    idx_dir = index_dir(raw_dir)
+    makedirs(idx_dir, exist_ok=True)
+    manifest_path = path.join(idx_dir, MANIFEST_FILE)
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        manifest = {}
+
+    archives = sorted(f for f in listdir(raw_dir) if is_archive(f))
+    # A zip converted into a segment of the same day holds the same snapshots
+    segments = {path.splitext(f)[0] for f in archives if is_segment(f)}
+    converted = [f for f in archives if not is_segment(f) and path.splitext(f)[0] in segments]
+    if converted:
+        logger.info(f"Skipping {len(converted)} zip archives with a segment of the same day")
+    archives = [f for f in archives if f not in converted]
+    updated = 0
+    for archive in archives:
+        archive_stat = stat(path.join(raw_dir, archive))
+        signature = [archive_stat.st_size, archive_stat.st_mtime_ns]
+        if manifest.get(archive) == signature:
+            continue
+        logger.info(f"Indexing {archive}")
+        try:
+            df = index_archive(path.join(raw_dir, archive))
+        except (OSError, ValueError, zipfile.BadZipFile):
+            logger.error(f"Failed to index {archive}", exc_info=True)
+            continue
+        df.write_parquet(path.join(idx_dir, f"{archive}.parquet"))
+        manifest[archive] = signature
+        updated += 1
+
+    # Forget archives that were removed
+    for archive in set(manifest) - set(archives):
+        part = path.join(idx_dir, f"{archive}.parquet")
+        if path.isfile(part):
+            remove(part)
+        del manifest[archive]
+
+    with open(manifest_path, "w") as f:
+        json.dump(manifest, f)
+    return updated
+
+
+def scan_index(raw_dir: str = RAW_DIR, start: int | None = None, end: int | None = None) -> pl.LazyFrame:
+    """Index entries with start <= timestamp < end"""
+    idx_dir = index_dir(raw_dir)
+    if not path.isdir(idx_dir) or not any(f.endswith(".parquet") for f in listdir(idx_dir)):
+        logger.warning(f"No index for {raw_dir}, run update first")
+        return pl.LazyFrame(schema=INDEX_SCHEMA)
+    df = pl.scan_parquet(path.join(idx_dir, "*.parquet"), schema=INDEX_SCHEMA)
+    if start is not None:
+        df = df.filter(pl.col("timestamp") >= start)
+    if end is not None:
+        df = df.filter(pl.col("timestamp") < end)
+    return df
+
+
+def extract_range(raw_dir: str, out_dir: str, start: int | None, end: int | None, include_duplicates: bool = True) -> int:
+    """Write the snapshots between start and end to out_dir, returns the number written"""
+    df = scan_index(raw_dir, start, end)
+    if not include_duplicates:
+        df = df.filter(pl.col("duplicate").not_())
+    df = df.sort("archive", "timestamp").collect()
+
+    written = 0
+    for (archive,), part in df.group_by("archive", maintain_order=True):
+        archive_path = path.join(raw_dir, str(archive))
+        if is_segment(archive_path):
+            with SegmentReader(archive_path) as reader:
+                for offset in part["offset"]:
+                    sample = reader.read_sample_at(offset)
+                    if sample is None:
+                        continue
+                    with open(path.join(out_dir, path.basename(sample[1])), "wb") as out_file:
+                        out_file.write(sample[2])
+                    written += 1
+        else:
+            with zipfile.ZipFile(archive_path, "r") as zipf:
+                for member in part["member"]:
+                    zipf.extract(member, out_dir)
+                    written += 1
+    return written
+
+
+def coverage_report(raw_dir: str, start: int, end: int,
+                    interval: int = SAMPLE_INTERVAL, gap_threshold: int = GAP_THRESHOLD) -> tuple[dict, pl.DataFrame]:
+    """Coverage summary and gaps longer than gap_threshold between start and end"""
+    times = scan_index(raw_dir, start, end)\
+        .select("timestamp")\
+        .unique()\
+        .sort("timestamp")\
+        .collect()["timestamp"]
+
+    # Treat the window borders as samples so leading and trailing gaps are reported
+    bounds = pl.concat([pl.Series("timestamp", [start], pl.Int64), times, pl.Series("timestamp", [end], pl.Int64)])
+    gaps = pl.DataFrame({"gap_start": bounds.head(-1), "gap_end": bounds.tail(-1)})\
+        .with_columns((pl.col("gap_end") - pl.col("gap_start")).alias("duration_s"))\
+        .filter(pl.col("duration_s") > gap_threshold)\
+        .with_columns(
+            pl.from_epoch("gap_start", time_unit="s").dt.replace_time_zone("UTC"),
+            pl.from_epoch("gap_end", time_unit="s").dt.replace_time_zone("UTC"),
+        )
+
+    expected = max((end - start) // interval, 1)
+    gap_seconds = int(gaps["duration_s"].sum()) if len(gaps) else 0
+    summary = {
+        "samples": len(times),
+        "expected_samples": expected,
+        "sample_ratio": len(times) / expected,
+        "gap_count": len(gaps),
+        "gap_seconds": gap_seconds,
+        "covered_ratio": 1 - gap_seconds / (end - start) if end > start else 0.0,
+    }
+    return summary, gaps
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Maintain and query the timestamp index over raw DSN Now archives"
+    )
+    parser.add_argument("-l","--log",help="Loglevel",default="info")
+    parser.add_argument("--raw",help="Directory containing the daily archives", default=RAW_DIR)
+    subparsers = parser.add_subparsers(help="Subcommand help", dest="subparser_name")
+
+    subparsers.add_parser("update", help="Index new and changed archives")
+
+    parser_report = subparsers.add_parser("report", help="Coverage and gap report for a period")
+    parser_report.add_argument("start", help="Start time in ISO 8601")
+    parser_report.add_argument("end", help="End time in ISO 8601")
+    parser_report.add_argument("--gap", help="Minimum gap length in seconds", type=int, default=GAP_THRESHOLD)
+
+    parser_extract = subparsers.add_parser("extract", help="Extract the snapshots of a period")
+    parser_extract.add_argument("start", help="Start time in ISO 8601")
+    parser_extract.add_argument("end", help="End time in ISO 8601")
+    parser_extract.add_argument("output", help="Output directory")
+    args = parser.parse_args()
+
+    if args.log:
+        numeric_level = getattr(logging, args.log.upper(), None)
+        if not isinstance(numeric_level, int):
+            raise ValueError('Invalid log level: %s' % args.log)
+    else:
+        numeric_level = logging.INFO
+    logging.basicConfig(level=numeric_level)
+
+    match args.subparser_name:
+        case "update":
+            logger.info(f"Indexed {update_index(args.raw)} archives")
+        case "report":
+            update_index(args.raw)
+            summary, gaps = coverage_report(args.raw, parse_time(args.start), parse_time(args.end), gap_threshold=args.gap)
+            for key, value in summary.items():
+                print(f"{key}: {value}")
+            with pl.Config(tbl_rows=-1):
+                print(gaps)
+        case "extract":
+            update_index(args.raw)
+            makedirs(args.output, exist_ok=True)
+            count = extract_range(args.raw, args.output, parse_time(args.start), parse_time(args.end))
+            logger.info(f"Extracted {count} snapshots")
+        case _:
+            logger.error("Specify a subcommand")
+            exit(1)
@@ -6,17 +6,31 @@ ERROR_DIR="../../../data/errors"
 URL="https://eyes.nasa.gov/dsn/data/dsn.xml"
 SLEEP_DURATION=4
 
+# Archive format of the daily files: "segment" (append-only, see segment.py) or "zip"
+ARCHIVE_FORMAT="${ARCHIVE_FORMAT:-segment}"
+# Allow running the segment module from this directory
+export PYTHONPATH="../../..${PYTHONPATH:+:$PYTHONPATH}"
+SEGMENT_MODULE="src.ingress.dsn.segment"
+
+current_day=""
+
+archive_file () {
+    if [ "$ARCHIVE_FORMAT" = "zip" ]; then
+        zip -q -g "$OUT_DIR/$(date --utc -Idate).zip" "$1"
+    else
+        python3 -m "$SEGMENT_MODULE" -l warning append "$OUT_DIR" "$1"
+    fi
+}
+
 single_scrape () {
-    today_archive="$(date --utc -Idate).zip"
-    path_archive="$OUT_DIR/$today_archive"
     xml_file=$(echo "$(date --utc --iso-8601=seconds).xml" | tr : _)
 
     if curl -s -o "$xml_file" "$URL"; then
-        # Attempt to add the XML file to the zip archive
-        if zip -q -g "$path_archive" "$xml_file"; then
+        # Attempt to add the XML file to the daily archive
+        if archive_file "$xml_file"; then
             rm "$xml_file"
         else
-            echo "Failed to add $xml_file to $path_archive" >&2
+            echo "Failed to archive $xml_file in $OUT_DIR" >&2
             mkdir -p "$ERROR_DIR"
             # Move the XML file to the error directory
             mv "$xml_file" "$ERROR_DIR/"
@@ -27,6 +41,15 @@ single_scrape () {
     fi
 }
 
+# Write the index footer of all previous days once the day changes
+roll_day () {
+    today="$(date --utc -Idate)"
+    if [ "$ARCHIVE_FORMAT" != "zip" ] && [ "$today" != "$current_day" ]; then
+        python3 -m "$SEGMENT_MODULE" -l warning seal "$OUT_DIR" --keep "$today.seg"
+        current_day="$today"
+    fi
+}
+
 if [ ! -d "$OUT_DIR" ]; then
     echo "Creating output directory $OUT_DIR"
     mkdir -p "$OUT_DIR"
@@ -34,6 +57,7 @@ fi
 
 main_loop () {
     while true; do
+        roll_day
         single_scrape
         sleep "$SLEEP_DURATION"
     done
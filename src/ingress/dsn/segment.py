@@ -0,0 +1,654 @@
+#!/usr/bin/env python3
+"""Append-only segment storage for raw DSN Now snapshots.
+
+A segment holds one UTC day of snapshots. Each snapshot is written as a single
+self-delimiting frame, so appending never touches data already on disk:
+
+    file   := header frame* [index footer]
+    header := FILE_MAGIC | ZSTD_FILE_MAGIC dict_len dictionary
+    frame  := header(magic, timestamp, name_len, data_len, crc32) name data FRAME_END
+    footer := (timestamp, offset, kind)* trailer(magic, index_offset, count)
+
+The footer is only written once a day is sealed. Unsealed segments, e.g. the
+one the scraper is currently writing to, are indexed by scanning the frames.
+
+Snapshots identical to the previous one, apart from their <timestamp>, are not
+stored again. A duplicate frame instead records the capture time and the
+timestamp of the stored snapshot it repeats.
+
+Frames are compressed independently, keeping random access per snapshot. As
+single snapshots are small and very similar to each other, segments can embed
+a zstd dictionary trained on DSN Now XML, see train_dictionary().
+"""
+
+import argparse
+import bisect
+import hashlib
+import json
+import logging
+import re
+import struct
+import zipfile
+import zlib
+import datetime as dt
+from os import path, listdir, fsync, makedirs, replace
+
+try:
+    import zstandard as zstd
+except ImportError:
+    zstd = None
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_SUFFIX = ".seg"
+FILE_MAGIC = b"DSNSEG01"
+ZSTD_FILE_MAGIC = b"DSNSEGZ1"
+FRAME_MAGIC = b"DSNF"
+DUPLICATE_MAGIC = b"DSND"
+FRAME_END = b"DSNE"
+INDEX_MAGIC = b"DSNI"
+
+# length of the zstd dictionary following ZSTD_FILE_MAGIC
+DICTIONARY_HEADER = struct.Struct("<I")
+# magic, timestamp, name length, data length, crc32 of name + data
+FRAME_HEADER = struct.Struct("<4sqHII")
+# timestamp, offset of the frame header, frame kind
+INDEX_ENTRY = struct.Struct("<qQB")
+# Index entries of segments sealed before duplicate frames existed: timestamp, offset
+LEGACY_INDEX_ENTRY = struct.Struct("<qQ")
+# magic, offset of the first index entry, number of entries
+INDEX_TRAILER = struct.Struct("<4sQI")
+
+# Payload of a duplicate frame: timestamp of the repeated snapshot
+DUPLICATE_DATA = struct.Struct("<q")
+
+SNAPSHOT = 0
+DUPLICATE = 1
+FRAME_KINDS = {FRAME_MAGIC: SNAPSHOT, DUPLICATE_MAGIC: DUPLICATE}
+
+COMPRESSION_LEVEL = 6
+ZSTD_LEVEL = 19
+# New segments in a directory containing this file embed it as zstd dictionary
+DICTIONARY_FILE = "dsn.zdict"
+DICTIONARY_SIZE = 112640
+DICTIONARY_SAMPLES = 2000
+
+# Remembers the last stored snapshot between scraper invocations
+DEDUP_STATE_FILE = ".last_snapshot.json"
+TIMESTAMP_PATTERN = re.compile(rb"<timestamp>[^<]*</timestamp>")
+
+
+def member_timestamp(name: str) -> int:
+    """Unix timestamp encoded in a scraper file name like 2025-06-01T12_00_05+00_00.xml"""
+    stem = path.splitext(path.basename(name))[0]
+    return int(dt.datetime.fromisoformat(stem.replace("_", ":")).timestamp())
+
+
+def segment_name(timestamp: int) -> str:
+    """Name of the daily segment a snapshot taken at timestamp belongs to"""
+    day = dt.datetime.fromtimestamp(timestamp, dt.timezone.utc).date()
+    return f"{day.isoformat()}{SEGMENT_SUFFIX}"
+
+
+def is_segment(file_path: str) -> bool:
+    return file_path.endswith(SEGMENT_SUFFIX)
+
+
+def snapshot_digest(payload: bytes) -> str:
+    """Content hash of a snapshot with its <timestamp> normalized out"""
+    return hashlib.sha256(TIMESTAMP_PATTERN.sub(b"", payload)).hexdigest()
+
+
+class Codec:
+    """Compression of the frames of one segment, zlib or zstd with a dictionary"""
+
+    def __init__(self, dictionary: bytes | None = None):
+        self.dictionary = dictionary
+        if dictionary is None:
+            self.compress = lambda payload: zlib.compress(payload, COMPRESSION_LEVEL)
+            self.decompress = zlib.decompress
+            return
+        if zstd is None:
+            raise ImportError("zstandard is required for dictionary compressed segments")
+        dict_data = zstd.ZstdCompressionDict(dictionary)
+        self.compress = zstd.ZstdCompressor(level=ZSTD_LEVEL, dict_data=dict_data).compress
+        self.decompress = zstd.ZstdDecompressor(dict_data=dict_data).decompress
+
+    def header(self) -> bytes:
+        if self.dictionary is None:
+            return FILE_MAGIC
+        return ZSTD_FILE_MAGIC + DICTIONARY_HEADER.pack(len(self.dictionary)) + self.dictionary
+
+
+def _read_header(f) -> tuple[Codec, int] | None:
+    """Returns the codec of a segment and the offset of its first frame"""
+    f.seek(0)
+    magic = f.read(len(FILE_MAGIC))
+    if magic == FILE_MAGIC:
+        return Codec(), len(FILE_MAGIC)
+    if magic == ZSTD_FILE_MAGIC:
+        raw = f.read(DICTIONARY_HEADER.size)
+        if len(raw) < DICTIONARY_HEADER.size:
+            return None
+        (dict_len,) = DICTIONARY_HEADER.unpack(raw)
+        dictionary = f.read(dict_len)
+        if len(dictionary) < dict_len:
+            return None
+        return Codec(dictionary), f.tell()
+    if len(magic) < len(FILE_MAGIC):
+        return None
+    raise ValueError(f"Not a DSN segment: {f.name}")
+
+
+def _encode(magic: bytes, timestamp: int, name: str, data: bytes) -> bytes:
+    name_bytes = name.encode()
+    crc = zlib.crc32(data, zlib.crc32(name_bytes))
+    header = FRAME_HEADER.pack(magic, timestamp, len(name_bytes), len(data), crc)
+    return b"".join((header, name_bytes, data, FRAME_END))
+
+
+def encode_frame(timestamp: int, name: str, payload: bytes, codec: Codec | None = None) -> bytes:
+    codec = codec or Codec()
+    return _encode(FRAME_MAGIC, timestamp, name, codec.compress(payload))
+
+
+def encode_duplicate(timestamp: int, name: str, original_timestamp: int) -> bytes:
+    return _encode(DUPLICATE_MAGIC, timestamp, name, DUPLICATE_DATA.pack(original_timestamp))
+
+
+def _read_frame(f, offset: int) -> tuple[int, int, str, bytes, int] | None:
+    """Read the frame at offset, returns (kind, timestamp, name, data, next offset)"""
+    f.seek(offset)
+    header = f.read(FRAME_HEADER.size)
+    if len(header) < FRAME_HEADER.size:
+        return None
+    magic, timestamp, name_len, data_len, crc = FRAME_HEADER.unpack(header)
+    kind = FRAME_KINDS.get(magic)
+    if kind is None:
+        return None
+    body = f.read(name_len + data_len + len(FRAME_END))
+    if len(body) < name_len + data_len + len(FRAME_END) or body[-len(FRAME_END):] != FRAME_END:
+        return None
+    name_bytes = body[:name_len]
+    data = body[name_len:name_len + data_len]
+    if zlib.crc32(data, zlib.crc32(name_bytes)) != crc:
+        return None
+    return kind, timestamp, name_bytes.decode(), data, f.tell()
+
+
+def _read_trailer(f, size: int) -> tuple[int, int, struct.Struct] | None:
+    """Returns (index offset, entry count, entry format) of a sealed segment"""
+    if size < len(FILE_MAGIC) + INDEX_TRAILER.size:
+        return None
+    f.seek(size - INDEX_TRAILER.size)
+    magic, index_offset, count = INDEX_TRAILER.unpack(f.read(INDEX_TRAILER.size))
+    if magic != INDEX_MAGIC:
+        return None
+    for entry in (INDEX_ENTRY, LEGACY_INDEX_ENTRY):
+        if index_offset + count * entry.size + INDEX_TRAILER.size == size:
+            return index_offset, count, entry
+    return None
+
+
+def _next_marker(chunk: bytes) -> int:
+    found = [i for i in (chunk.find(magic) for magic in FRAME_KINDS) if i != -1]
+    return min(found) if found else -1
+
+
+def _scan(f, start: int, end: int) -> tuple[list[tuple[int, int, int]], int]:
+    """Index frames between start and end, skipping over damaged regions.
+
+    Returns the index and the end of the last intact frame.
+    """
+    index = []
+    offset = start
+    last_good = start
+    while offset < end:
+        frame = _read_frame(f, offset)
+        if frame is None:
+            # Resynchronise on the next frame marker
+            f.seek(offset + 1)
+            chunk = f.read(end - offset - 1)
+            found = _next_marker(chunk)
+            if found == -1:
+                break
+            logger.warning(f"Skipping {found + 1} damaged bytes at offset {offset} in {f.name}")
+            offset += found + 1
+            continue
+        index.append((frame[1], offset, frame[0]))
+        offset = frame[4]
+        last_good = offset
+    return index, last_good
+
+
+def _append_frame(segment_path: str, make_frame, new_codec: Codec | None = None):
+    """Append a single frame to a segment, creating it with new_codec if required.
+
+    Only the header and the last few bytes of the segment are inspected, so the
+    cost does not depend on the number of snapshots already stored. A tail left
+    behind by an interrupted append is cut off before writing.
+    """
+    with open(segment_path, "ab+") as f:
+        size = f.seek(0, 2)
+        header = _read_header(f) if size else None
+        if header is None:
+            # New segment or one whose header was never completely written
+            codec = new_codec or Codec()
+            f.truncate(0)
+            f.write(codec.header())
+        else:
+            codec, data_start = header
+            f.seek(size - len(FRAME_END))
+            tail = f.read(len(FRAME_END))
+            trailer = _read_trailer(f, size)
+            if trailer is not None:
+                # Reopen sealed segment, the index is rewritten on the next seal
+                f.truncate(trailer[0])
+            elif tail != FRAME_END and size > data_start:
+                _, last_good = _scan(f, data_start, size)
+                logger.warning(f"Truncating incomplete frame in {segment_path} at {last_good}")
+                f.truncate(last_good)
+        f.write(make_frame(codec))
+        f.flush()
+        fsync(f.fileno())
+
+
+def append(segment_path: str, timestamp: int, name: str, payload: bytes, new_codec: Codec | None = None):
+    _append_frame(segment_path, lambda codec: encode_frame(timestamp, name, payload, codec), new_codec)
+
+
+def append_duplicate(segment_path: str, timestamp: int, name: str, original_timestamp: int):
+    _append_frame(segment_path, lambda _: encode_duplicate(timestamp, name, original_timestamp))
+
+
+def seal(segment_path: str):
+    """Write the timestamp index footer, making lookups O(log n) without scanning"""
+    with open(segment_path, "rb+") as f:
+        size = f.seek(0, 2)
+        if _read_trailer(f, size) is not None:
+            return
+        header = _read_header(f)
+        if header is None:
+            raise ValueError(f"Incomplete segment header: {segment_path}")
+        index, last_good = _scan(f, header[1], size)
+        f.truncate(last_good)
+        f.seek(last_good)
+        index.sort()
+        f.write(b"".join(INDEX_ENTRY.pack(*entry) for entry in index))
+        f.write(INDEX_TRAILER.pack(INDEX_MAGIC, last_good, len(index)))
+        f.flush()
+        fsync(f.fileno())
+
+
+def _restore(duplicate: tuple[int, str, int], payload: bytes) -> tuple[int, str, bytes]:
+    timestamp, name, _ = duplicate
+    stamp = f"<timestamp>{timestamp * 1000}</timestamp>".encode()
+    return timestamp, name, TIMESTAMP_PATTERN.sub(stamp, payload, count=1)
+
+
+class SegmentReader:
+    """Sequential and timestamp based access to a segment
+
+    Iterating yields stored snapshots only, duplicate markers are available
+    through duplicates() and samples().
+    """
+
+    def __init__(self, segment_path: str):
+        self.path = segment_path
+        self._file = open(segment_path, "rb")
+        try:
+            header = _read_header(self._file)
+        except ValueError:
+            self._file.close()
+            raise
+        if header is None:
+            self._file.close()
+            raise ValueError(f"Incomplete segment header: {segment_path}")
+        self._codec, data_start = header
+
+        size = self._file.seek(0, 2)
+        trailer = _read_trailer(self._file, size)
+        if trailer is not None:
+            index_offset, count, entry = trailer
+            self._file.seek(index_offset)
+            raw = self._file.read(count * entry.size)
+            entries = list(entry.iter_unpack(raw))
+            if entry is LEGACY_INDEX_ENTRY:
+                # Only snapshot frames were written before duplicate markers
+                entries = [(ts, offset, SNAPSHOT) for ts, offset in entries]
+            self.sealed = True
+        else:
+            entries, _ = _scan(self._file, data_start, size)
+            entries.sort()
+            self.sealed = False
+        self.index = [(ts, offset) for ts, offset, kind in entries if kind == SNAPSHOT]
+        self.duplicate_index = [(ts, offset) for ts, offset, kind in entries if kind == DUPLICATE]
+        self._timestamps = [ts for ts, _ in self.index]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return len(self.index)
+
+    def __iter__(self):
+        for _, offset in self.index:
+            yield self.read_at(offset)
+
+    def close(self):
+        self._file.close()
+
+    def read_at(self, offset: int) -> tuple[int, str, bytes]:
+        """Returns (timestamp, member name, payload) of the frame at offset"""
+        frame = _read_frame(self._file, offset)
+        if frame is None or frame[0] != SNAPSHOT:
+            raise ValueError(f"Corrupt frame at offset {offset} in {self.path}")
+        _, timestamp, name, data, _ = frame
+        return timestamp, name, self._codec.decompress(data)
+
+    def read_sample_at(self, offset: int) -> tuple[int, str, bytes] | None:
+        """Like read_at, but resolves duplicate frames to the payload they repeat"""
+        frame = _read_frame(self._file, offset)
+        if frame is None:
+            raise ValueError(f"Corrupt frame at offset {offset} in {self.path}")
+        kind, timestamp, name, data, _ = frame
+        if kind == SNAPSHOT:
+            return timestamp, name, self._codec.decompress(data)
+        original = DUPLICATE_DATA.unpack(data)[0]
+        snapshot = self.get(original)
+        if snapshot is None:
+            return None
+        return _restore((timestamp, name, original), snapshot[2])
+
+    def duplicates(self):
+        """Yield (capture timestamp, member name, timestamp of the repeated snapshot)"""
+        for _, offset in self.duplicate_index:
+            frame = _read_frame(self._file, offset)
+            if frame is None or frame[0] != DUPLICATE:
+                raise ValueError(f"Corrupt frame at offset {offset} in {self.path}")
+            _, timestamp, name, data, _ = frame
+            yield timestamp, name, DUPLICATE_DATA.unpack(data)[0]
+
+    def samples(self):
+        """Yield every capture in time order.
+
+        Duplicates carry the payload they repeat, with its <timestamp> set to
+        the capture time as the original timestamp is not stored.
+        """
+        duplicates = iter(sorted(self.duplicates()))
+        duplicate = next(duplicates, None)
+        last = None
+        for snapshot in self:
+            while duplicate is not None and duplicate[0] < snapshot[0]:
+                if last is not None and last[0] == duplicate[2]:
+                    yield _restore(duplicate, last[2])
+                duplicate = next(duplicates, None)
+            last = snapshot
+            yield snapshot
+        while duplicate is not None:
+            if last is not None and last[0] == duplicate[2]:
+                yield _restore(duplicate, last[2])
+            duplicate = next(duplicates, None)
+
+    def read_range(self, start: int | None = None, end: int | None = None):
+        """Yield all snapshots with start <= timestamp < end"""
+        lo = bisect.bisect_left(self._timestamps, start) if start is not None else 0
+        hi = bisect.bisect_left(self._timestamps, end) if end is not None else len(self.index)
+        for _, offset in self.index[lo:hi]:
+            yield self.read_at(offset)
+
+    def get(self, timestamp: int) -> tuple[int, str, bytes] | None:
+        i = bisect.bisect_left(self._timestamps, timestamp)
+        if i < len(self._timestamps) and self._timestamps[i] == timestamp:
+            return self.read_at(self.index[i][1])
+        return None
+
+
+def extract_all(segment_path: str, out_dir: str, include_duplicates: bool = True):
+    """Write every snapshot to out_dir under its original name, like ZipFile.extractall"""
+    with SegmentReader(segment_path) as reader:
+        for _, name, payload in (reader.samples() if include_duplicates else reader):
+            with open(path.join(out_dir, path.basename(name)), "wb") as out_file:
+                out_file.write(payload)
+
+
+def from_zip(zip_path: str, segment_path: str, dedup: bool = True, dictionary: bytes | None = None):
+    """Convert a daily zip archive written by scraper.sh into a sealed segment"""
+    codec = Codec(dictionary)
+    with zipfile.ZipFile(zip_path, "r") as zipf:
+        members = []
+        for info in zipf.infolist():
+            if info.is_dir():
+                continue
+            try:
+                members.append((member_timestamp(info.filename), info.filename))
+            except ValueError:
+                logger.warning(f"Skipping member without timestamp: {info.filename}")
+        members.sort()
+        with open(segment_path, "wb") as f:
+            f.write(codec.header())
+            last_digest = None
+            last_timestamp = None
+            for timestamp, name in members:
+                payload = zipf.read(name)
+                digest = snapshot_digest(payload) if dedup else None
+                if digest is not None and digest == last_digest:
+                    f.write(encode_duplicate(timestamp, name, last_timestamp))
+                    continue
+                f.write(encode_frame(timestamp, name, payload, codec))
+                last_digest = digest
+                last_timestamp = timestamp
+    seal(segment_path)
+
+
+def to_zip(segment_path: str, zip_path: str):
+    """Convert a segment back into a zip archive as written by scraper.sh, restoring duplicates"""
+    with SegmentReader(segment_path) as reader, \
+         zipfile.ZipFile(zip_path, "w", compression=zipfile.ZIP_DEFLATED) as zipf:
+        for _, name, payload in reader.samples():
+            zipf.writestr(name, payload)
+
+
+def recompress(segment_path: str, out_path: str, dictionary: bytes | None = None):
+    """Rewrite a segment with another codec, keeping duplicate frames as they are
+
+    The new segment is written next to out_path and only moved into place once
+    sealed, so out_path may be segment_path itself.
+    """
+    codec = Codec(dictionary)
+    tmp_path = out_path + ".tmp"
+    with SegmentReader(segment_path) as reader, open(tmp_path, "wb") as f:
+        f.write(codec.header())
+        entries = sorted([(ts, offset, SNAPSHOT) for ts, offset in reader.index]
+                         + [(ts, offset, DUPLICATE) for ts, offset in reader.duplicate_index])
+        for _, offset, kind in entries:
+            if kind == SNAPSHOT:
+                f.write(encode_frame(*reader.read_at(offset), codec))
+            else:
+                _, timestamp, name, data, _ = _read_frame(reader._file, offset)
+                f.write(_encode(DUPLICATE_MAGIC, timestamp, name, data))
+    seal(tmp_path)
+    replace(tmp_path, out_path)
+
+
+def _archive_payloads(archive_path: str):
+    if is_segment(archive_path):
+        with SegmentReader(archive_path) as reader:
+            for _, _, payload in reader:
+                yield payload
+    else:
+        with zipfile.ZipFile(archive_path, "r") as zipf:
+            for name in zipf.namelist():
+                yield zipf.read(name)
+
+
+def train_dictionary(archive_paths: list[str], size: int = DICTIONARY_SIZE, sample_count: int = DICTIONARY_SAMPLES) -> bytes:
+    """Train a zstd dictionary on snapshots spread evenly over the given archives"""
+    if zstd is None:
+        raise ImportError("zstandard is required to train dictionaries")
+    per_archive = max(sample_count // max(len(archive_paths), 1), 1)
+    samples = []
+    for archive_path in archive_paths:
+        payloads = list(_archive_payloads(archive_path))
+        step = max(len(payloads) // per_archive, 1)
+        samples.extend(payloads[::step][:per_archive])
+    logger.info(f"Training dictionary on {len(samples)} snapshots")
+    return zstd.train_dictionary(size, samples).as_bytes()
+
+
+def load_dictionary(directory: str) -> bytes | None:
+    """Dictionary new segments in directory are compressed with, if any"""
+    dict_path = path.join(directory, DICTIONARY_FILE)
+    if zstd is None or not path.isfile(dict_path):
+        return None
+    with open(dict_path, "rb") as f:
+        return f.read()
+
+
+def _load_dedup_state(out_dir: str) -> dict:
+    try:
+        with open(path.join(out_dir, DEDUP_STATE_FILE)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_dedup_state(out_dir: str, state: dict):
+    state_path = path.join(out_dir, DEDUP_STATE_FILE)
+    with open(state_path + ".tmp", "w") as f:
+        json.dump(state, f)
+    replace(state_path + ".tmp", state_path)
+
+
+def append_file(out_dir: str, file_path: str, dedup: bool = True) -> bool:
+    """Append a downloaded snapshot to the segment of its day.
+
+    A snapshot identical to the last one stored in the same segment is only
+    recorded as a duplicate. Returns whether the payload was stored.
+    """
+    name = path.basename(file_path)
+    timestamp = member_timestamp(name)
+    with open(file_path, "rb") as f:
+        payload = f.read()
+    segment = segment_name(timestamp)
+    segment_path = path.join(out_dir, segment)
+    # Only needed when the first snapshot of a day creates the segment
+    new_codec = None if path.isfile(segment_path) else Codec(load_dictionary(out_dir))
+
+    if not dedup:
+        append(segment_path, timestamp, name, payload, new_codec)
+        return True
+
+    digest = snapshot_digest(payload)
+    state = _load_dedup_state(out_dir)
+    # Duplicates may only refer to snapshots within the same segment
+    if state.get("segment") == segment and state.get("digest") == digest and path.isfile(segment_path):
+        append_duplicate(segment_path, timestamp, name, state["timestamp"])
+        logger.debug(f"{name} repeats snapshot {state['timestamp']}")
+        return False
+
+    append(segment_path, timestamp, name, payload, new_codec)
+    _save_dedup_state(out_dir, {"segment": segment, "digest": digest, "timestamp": timestamp})
+    return True
+
+
+def seal_all(directory: str, keep: str | None = None):
+    """Seal every segment in directory except keep"""
+    for f in sorted(listdir(directory)):
+        if is_segment(f) and f != keep:
+            seal(path.join(directory, f))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Manage append-only DSN Now snapshot segments"
+    )
+    parser.add_argument("-l","--log",help="Loglevel",default="info")
+    subparsers = parser.add_subparsers(help="Subcommand help", dest="subparser_name")
+
+    parser_append = subparsers.add_parser("append", help="Append a snapshot to the segment of its day")
+    parser_append.add_argument("directory", help="Directory containing daily segments")
+    parser_append.add_argument("file", help="Snapshot named after its UTC timestamp")
+    parser_append.add_argument("--no-dedup", action="store_true", help="Store the snapshot even if it repeats the previous one")
+
+    parser_seal = subparsers.add_parser("seal", help="Write the index footer of finished segments")
+    parser_seal.add_argument("directory", help="Directory containing daily segments")
+    parser_seal.add_argument("--keep", help="Segment name to leave unsealed, e.g. today's")
+
+    parser_from = subparsers.add_parser("from-zip", help="Convert daily zip archives to segments")
+    parser_from.add_argument("input", nargs="+", help="Zip archives")
+    parser_from.add_argument("output", help="Output directory")
+    parser_from.add_argument("--no-dedup", action="store_true", help="Keep repeated snapshots")
+    parser_from.add_argument("-d","--dictionary", help="Compress with this zstd dictionary")
+
+    parser_to = subparsers.add_parser("to-zip", help="Convert segments to daily zip archives")
+    parser_to.add_argument("input", nargs="+", help="Segments")
+    parser_to.add_argument("output", help="Output directory")
+
+    parser_train = subparsers.add_parser("train", help="Train a zstd dictionary on existing archives")
+    parser_train.add_argument("input", nargs="+", help="Zip archives or segments")
+    parser_train.add_argument("output", help=f"Dictionary file, place it in the raw directory as {DICTIONARY_FILE} to use it for new segments")
+    parser_train.add_argument("--size", help="Dictionary size in bytes", type=int, default=DICTIONARY_SIZE)
+    parser_train.add_argument("--samples", help="Number of snapshots to train on", type=int, default=DICTIONARY_SAMPLES)
+
+    parser_recompress = subparsers.add_parser("recompress", help="Rewrite segments with a zstd dictionary")
+    parser_recompress.add_argument("input", nargs="+", help="Segments")
+    parser_recompress.add_argument("output", help="Output directory")
+    parser_recompress.add_argument("-d","--dictionary", help="zstd dictionary, zlib is used if omitted")
+
+    parser_list = subparsers.add_parser("list", help="List the snapshots of a segment")
+    parser_list.add_argument("input", help="Segment")
+    args = parser.parse_args()
+
+    if args.log:
+        numeric_level = getattr(logging, args.log.upper(), None)
+        if not isinstance(numeric_level, int):
+            raise ValueError('Invalid log level: %s' % args.log)
+    else:
+        numeric_level = logging.INFO
+    logging.basicConfig(level=numeric_level)
+
+    match args.subparser_name:
+        case "append":
+            makedirs(args.directory, exist_ok=True)
+            append_file(args.directory, args.file, dedup=not args.no_dedup)
+        case "seal":
+            seal_all(args.directory, args.keep)
+        case "from-zip":
+            dictionary = None
+            if args.dictionary:
+                with open(args.dictionary, "rb") as dict_file:
+                    dictionary = dict_file.read()
+            for f in args.input:
+                out = path.join(args.output, path.splitext(path.basename(f))[0] + SEGMENT_SUFFIX)
+                logger.info(f"Converting {f} to {out}")
+                from_zip(f, out, dedup=not args.no_dedup, dictionary=dictionary)
+        case "to-zip":
+            for f in args.input:
+                out = path.join(args.output, path.splitext(path.basename(f))[0] + ".zip")
+                logger.info(f"Converting {f} to {out}")
+                to_zip(f, out)
+        case "train":
+            with open(args.output, "wb") as dict_file:
+                dict_file.write(train_dictionary(args.input, args.size, args.samples))
+        case "recompress":
+            dictionary = None
+            if args.dictionary:
+                with open(args.dictionary, "rb") as dict_file:
+                    dictionary = dict_file.read()
+            for f in args.input:
+                out = path.join(args.output, path.basename(f))
+                logger.info(f"Recompressing {f} to {out}")
+                recompress(f, out, dictionary)
+        case "list":
+            with SegmentReader(args.input) as reader:
+                for ts, offset in reader.index:
+                    print(f"{dt.datetime.fromtimestamp(ts, dt.timezone.utc).isoformat()} {offset}")
+                for ts, _, original in reader.duplicates():
+                    print(f"{dt.datetime.fromtimestamp(ts, dt.timezone.utc).isoformat()} duplicate of {original}")
+        case _:
+            logger.error("Specify a subcommand")
+            exit(1)
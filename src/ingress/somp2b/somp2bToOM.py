@@ -1,107 +1,211 @@
 #!/usr/bin/env python3
-
-from os import path, listdir
+"""Conversion of SOMP2B logs to OpenMetrics or parquet.
+
+Every log is read once with iterparse, clearing elements as soon as they are
+handled, into a frame of its messages. Passes are detected from the gaps
+between RX messages and the bytes sent and received during each pass are
+summed up with polars expressions. Logs are converted in a process pool, each
+to its own output file.
+"""
+
+import argparse
+import logging
+import multiprocessing as mp
 import xml.etree.ElementTree as ET
-from ...common.OpenMetric import Metric, MetricSet
-from datetime import datetime, timedelta
+import polars as pl
+from os import path, listdir, makedirs
+from functools import partial
+
+logger = logging.getLogger(__name__)
 
 DATA_DIR = path.abspath(path.join(path.dirname(__file__),"../../../data/"))
 INPUT_DIR = path.join(DATA_DIR,"somp2b/")
 OUTPUT_DIR = path.join(DATA_DIR,"openmetric/")
+PARQUET_DIR = path.join(DATA_DIR,"exports/somp2b/")
+# Pass intervals for the interval index of src/egress/intervals.py
+PASSES_FILE = path.join(DATA_DIR,"somp2b_passes.parquet")
+THREAD_COUNT = mp.cpu_count()
 
 INTERRUPT_INTERVAL = 60*60
 TIME_INCLUDED_BEFORE_RX = 10
-
-
-def get_datetime(string: str) -> datetime | None:
-    try:
-        time = datetime.strptime(string+"UTC+0000", "%Y%m%d-%H%M%S%Z%z")
-    except Exception:
-        print(f"Failed to parse time string: {string}")
-        time = None
-    return time
-
-def get_passes(tree):
-    passes = []
-    first = None
-    last = None
-    for elem in tree.iter('RX'):
-        elem_time_string = elem.get("DateTimeUTC")
-        if elem_time_string is None:
-            continue
-        elem_time = get_datetime(elem_time_string)
-        if elem_time is None:
-            continue
-
-        if first is None or last is None:
-            first = elem_time
-            last = elem_time
+TIME_FORMAT = "%Y%m%d-%H%M%S"
+
+# One row per timed message, pass_bytes is only set during passes
+EVENT_SCHEMA = {
+    "timestamp": pl.Int64,
+    "signal_direction": pl.String,
+    "message_code": pl.String,
+    "length": pl.Int64,
+    "pass_bytes": pl.Int64,
+}
+# Timed elements as read from the logs
+MESSAGE_SCHEMA = {"tag": pl.String, "time": pl.String, "length": pl.String, "message_code": pl.String}
+PASS_SCHEMA = {"file": pl.String, "start": pl.Datetime("us", "UTC"), "end": pl.Datetime("us", "UTC")}
+
+
+def read_messages(f_path: str) -> pl.DataFrame:
+    """Tag, time, length and message code of all timed elements of a SOMP2B log in document order, all as strings"""
+    columns = {c: [] for c in MESSAGE_SCHEMA}
+    depth = 0
+    root = None
+    for event, elem in ET.iterparse(f_path, events=("start", "end")):
+        if event == "start":
+            root = elem if root is None else root
+            depth += 1
             continue
-        if (elem_time - last).total_seconds() > INTERRUPT_INTERVAL:
-            passes.append((first - timedelta(seconds = TIME_INCLUDED_BEFORE_RX), last))
-            first = elem_time
-        last = elem_time
-    return passes
-
-
-ms = MetricSet()
-for f in listdir(INPUT_DIR):
-    f_path = path.join(INPUT_DIR, f)
-    with open(f_path, "r") as somp_file:
-        try:
-            tree = ET.parse(f_path).getroot()
-            if tree is None:
-                continue
-        except Exception:
-            print(f"Failed to read {f_path}")
-            continue
-
-    passes = get_passes(tree)
-
-    pass_total_bytes_rx = 0
-    pass_total_bytes_tx = 0
-    current_pass = passes.pop(0)
-    for elem in tree.iter():
-        elem_type = elem.tag
-        elem_time_string = elem.get("DateTimeUTC")
-        if elem_time_string is None:
-            continue
-        elem_time = get_datetime(elem_time_string)
-        if elem_time is None:
-            continue
-        elem_len = int(str(elem.get("length"))) if elem.get("length") else 0
-        elem_text = elem.text
-        elem_code = elem_text[1:6] if elem_text and len(elem_text) >= 5 else "None"
-        if elem_time is None or elem_len is None:
-            continue
-
-        # Reset pass
-        if elem_time > current_pass[1]:
-            current_pass = passes.pop(0) if passes else current_pass
-            pass_total_bytes_rx = 0
-            pass_total_bytes_tx = 0
-
-        if elem_time >= current_pass[0]:
-            if elem_type == "RX":
-                pass_total_bytes_rx += elem_len
-            if elem_type == "TX":
-                pass_total_bytes_tx += elem_len
-
-        direction = "down" if elem_type == "RX" else "up"
-        labels = {
-            "data_source": "SOMP2B",
-            "signal_direction": direction,
-            "message_code": elem_code
-        }
-
-        if elem_time >= current_pass[0] and elem_time <= current_pass[1]:
-            pass_total_bytes = pass_total_bytes_rx if elem_type == "RX" else pass_total_bytes_tx
-            metric = Metric(name="pass_transmitted_bytes_total", value=pass_total_bytes, labels=labels, mtype="counter", timestamp=int(elem_time.timestamp()))
-            ms.insert(metric)
-
-        metric = Metric(name="transmitted", value=elem_len, labels=labels, mtype="gauge", munit="bytes", timestamp=int(elem_time.timestamp()))
-        ms.insert(metric)
-
-out_file_path = path.join(OUTPUT_DIR, "somp2b.om")
-with open(out_file_path, "w") as out_file:
-    out_file.write(str(ms))
+        depth -= 1
+
+        time_string = elem.get("DateTimeUTC")
+        if time_string is not None:
+            columns["tag"].append(elem.tag)
+            columns["time"].append(time_string)
+            columns["length"].append(elem.get("length"))
+            # Only the message code of the text is kept, not the whole message
+            text = elem.text
+            columns["message_code"].append(text[1:6] if text is not None and len(text) >= 5 else "None")
+
+        # Drop handled elements, the tree never holds more than the open ones
+        elem.clear()
+        if depth == 1:
+            del root[:]
+    return pl.DataFrame(columns, schema=MESSAGE_SCHEMA)
+
+
+def count_bytes(messages: pl.LazyFrame) -> tuple[pl.LazyFrame, pl.LazyFrame]:
+    """Messages with their bytes per pass so far and the passes with start and end timestamps
+
+    A pass starts TIME_INCLUDED_BEFORE_RX seconds before its first RX and ends
+    with the last RX before a gap of more than INTERRUPT_INTERVAL. Other
+    messages belong to the pass of the next RX if they are not sent before its
+    start, messages after the last RX are outside of all passes.
+    """
+    is_rx = pl.col("tag") == "RX"
+    df = messages\
+        .with_columns(
+            pl.col("time").str.strptime(pl.Datetime("us", "UTC"), TIME_FORMAT, strict=False).dt.epoch("s").alias("timestamp"),
+            pl.col("length").cast(pl.Int64, strict=False).fill_null(0),
+        )\
+        .filter(pl.col("timestamp").is_not_null())
+
+    # Every RX after a gap starts a new pass, other messages take the pass of the next RX
+    previous_rx = pl.when(is_rx).then(pl.col("timestamp")).shift(1).forward_fill()
+    starts_pass = is_rx & (previous_rx.is_null() | (pl.col("timestamp") - previous_rx > INTERRUPT_INTERVAL))
+    df = df.with_columns(
+        pl.when(is_rx).then(starts_pass.cum_sum()).fill_null(strategy="backward").alias("pass")
+    )
+
+    passes = df\
+        .filter(is_rx)\
+        .group_by("pass", maintain_order=True)\
+        .agg(
+            (pl.col("timestamp").first() - TIME_INCLUDED_BEFORE_RX).alias("start"),
+            pl.col("timestamp").last().alias("end"),
+        )
+
+    in_pass = pl.col("pass").is_not_null() & (pl.col("timestamp") >= pl.col("start"))
+    running = lambda tag: pl.when(in_pass & (pl.col("tag") == tag)).then(pl.col("length")).otherwise(0).cum_sum().over("pass")
+    events = df\
+        .join(passes.select("pass", "start"), on="pass", how="left", maintain_order="left")\
+        .select(
+            "timestamp",
+            pl.when(is_rx).then(pl.lit("down")).otherwise(pl.lit("up")).alias("signal_direction"),
+            "message_code",
+            "length",
+            pl.when(in_pass).then(pl.when(is_rx).then(running("RX")).otherwise(running("TX"))).alias("pass_bytes"),
+        )\
+        .cast(EVENT_SCHEMA)
+    return events, passes.select("start", "end")
+
+
+def read_events(f_path: str) -> tuple[pl.DataFrame, list[tuple[int, int]]]:
+    """Messages of a SOMP2B log and its passes as pairs of start and end timestamps, see count_bytes"""
+    messages = read_messages(f_path)
+    events, passes = count_bytes(messages.lazy())
+    events, passes = pl.collect_all([events, passes])
+    if len(events) < len(messages):
+        logger.warning(f"Failed to parse {len(messages) - len(events)} time strings in {f_path}")
+    return events, passes.rows()
+
+
+def to_openmetrics(df: pl.DataFrame) -> str:
+    """OpenMetrics of the messages, the bytes of each and the bytes of its pass so far"""
+    if df.is_empty():
+        return "# EOF"
+    labels = pl.concat_str(
+        pl.lit('{data_source="SOMP2B",signal_direction="'), pl.col("signal_direction"),
+        pl.lit('",message_code="'), pl.col("message_code"), pl.lit('"} '),
+    )
+    families = [
+        ("# TYPE pass_transmitted_bytes_total counter", "pass_transmitted_bytes_total", "pass_bytes"),
+        ("# TYPE transmitted_bytes gauge\n# UNIT transmitted_bytes bytes", "transmitted_bytes", "length"),
+    ]
+    blocks = []
+    for family, name, value in families:
+        lines = df\
+            .filter(pl.col(value).is_not_null())\
+            .sort("message_code", "signal_direction", "timestamp", maintain_order=True)\
+            .select(pl.concat_str(pl.lit(name), labels, pl.col(value).cast(pl.String), pl.lit(" "), pl.col("timestamp").cast(pl.String)))\
+            .to_series()
+        if len(lines):
+            blocks.append(family + "\n" + lines.str.join("\n").item())
+    return "\n".join(blocks) + "\n# EOF"
+
+
+def process_file(f_path: str, out_dir: str, form: str) -> tuple[str, int, list[tuple[int, int]]]:
+    """Converts one log to its own output file, returns its name, the number of messages and the passes"""
+    name = path.basename(f_path)
+    try:
+        df, passes = read_events(f_path)
+    except ET.ParseError:
+        logger.warning(f"Failed to read {f_path}")
+        return name, 0, []
+    if form == "parquet":
+        df.write_parquet(path.join(out_dir, f"somp2b_{name}.parquet"))
+    else:
+        with open(path.join(out_dir, f"somp2b_{name}.om"), "w") as out_file:
+            out_file.write(to_openmetrics(df))
+    return name, len(df), passes
+
+
+def convert(in_dir: str = INPUT_DIR, out_dir: str = OUTPUT_DIR, form: str = "om", passes_file: str | None = PASSES_FILE, workers: int = THREAD_COUNT) -> pl.DataFrame:
+    """Converts all logs in in_dir, returns the passes of all of them"""
+    files = [path.join(in_dir, f) for f in sorted(listdir(in_dir)) if path.isfile(path.join(in_dir, f))]
+    makedirs(out_dir, exist_ok=True)
+    all_passes = []
+    # Forked workers would inherit the threads of polars in whatever state they are
+    with mp.get_context("spawn").Pool(max(min(workers, len(files)), 1)) as pool:
+        func = partial(process_file, out_dir=out_dir, form=form)
+        for name, rows, passes in pool.imap_unordered(func, files):
+            logger.info(f"Converted {name} with {rows} messages in {len(passes)} passes")
+            all_passes += [(name, start, end) for start, end in passes]
+
+    df = pl.DataFrame(all_passes, schema={"file": pl.String, "start": pl.Int64, "end": pl.Int64}, orient="row")\
+        .with_columns(pl.from_epoch(c, time_unit="s").dt.replace_time_zone("UTC") for c in ("start", "end"))\
+        .cast(PASS_SCHEMA)\
+        .sort("file", "start")
+    if passes_file:
+        df.write_parquet(passes_file)
+    return df
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert SOMP2B logs to OpenMetrics or parquet, one file per log")
+    parser.add_argument("--input", help="Directory of SOMP2B logs", default=INPUT_DIR)
+    parser.add_argument("--output", help="Output directory, ./data/openmetric or ./data/exports/somp2b by default")
+    parser.add_argument("-f", "--format", help="Output format", choices=["om", "parquet"], default="om")
+    parser.add_argument("--passes", help="Parquet file for the pass intervals", default=PASSES_FILE)
+    parser.add_argument("-w", "--workers", help="Number of logs converted in parallel", type=int, default=THREAD_COUNT)
+    parser.add_argument("-l", "--log", help="Loglevel", default="info")
+    args = parser.parse_args()
+
+    if args.log:
+        numeric_level = getattr(logging, args.log.upper(), None)
+        if not isinstance(numeric_level, int):
+            raise ValueError('Invalid log level: %s' % args.log)
+    else:
+        numeric_level = logging.INFO
+    logging.basicConfig(level=numeric_level)
+
+    out_dir = args.output or (PARQUET_DIR if args.format == "parquet" else OUTPUT_DIR)
+    passes = convert(args.input, out_dir, args.format, args.passes, args.workers)
+    logger.info(f"Wrote {len(passes)} passes to {args.passes}")